@@ -17,18 +17,24 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 try:
     from mantidsimple import *
+    MANTID = True
 except ImportError:
     def LoadRaw(filename, outws):
         pass
     def LoadSampleDetailsFromFaw(ws, filename):
         pass
 
+    MANTID = False
+
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 import logging
 import sys
 import os
 import shutil
+import SansRunIndex
+import SansAddRuns
+import SansNexusFile
 
 DEFAULT_PATH = '/Users/Cameron/Documents/AA - ISIS Docs/Experiments/'
 
@@ -140,8 +146,8 @@ class addRawDoc(QObject):
     def initFilelist(self):
         self.filelist = []
         if self.getPath():
-            for file in os.listdir(self.getPath()):
-                self.filelist.append(file)
+            self.filelist = SansRunIndex.getRunIndex(
+                                         str(self.getPath())).getFiles()
 
     def getFilelist(self):
         return self.filelist
@@ -158,39 +164,41 @@ class addRawDoc(QObject):
 
     def addRuns(self):
         """Method for doing the actual raw file adding
-        
-        Due to some vagaries in the Mantid framework it is important
-        firstly to load the initial run separately rather than add
-        to an empty workspace and then to clean up afterwards to save
-        memory. If this isn't done then currently Mantid will crash 
-        out after loading up around six workspaces.
+
+        The headers of all the runs are scanned in parallel first so
+        that every incompatible run is reported before any data is read.
+        The counts are then summed run by run into a single NumPy
+        accumulator by SansAddRuns rather than with Plus on Mantid
+        workspaces, which used to crash out after loading up around six
+        workspaces.
+
+        Within Mantid the first run is loaded as a template so the
+        instrument, sample details and logs are saved with the summed
+        counts. Outside Mantid the sum is written directly as NeXus.
         """
 
         filenamelist = self.runlistToFilenames()
         inpath = str(self.getPath())
         outpath = str(self.getOutpath())
         name = str(self.getOutname())
+        filenames = [os.path.join(inpath, str(run)) for run in filenamelist]
+
+        report = SansAddRuns.scanRuns(filenames)
+        logging.debug('addRawDoc: Run headers:\n' +
+                      '\n'.join(report.getSummary()))
+        if not report.isCompatible():
+            self.emit(SIGNAL('sigDocFail'),
+                      ('\n'.join(report.getProblems()), ))
+            return
+        runfiles = report.getRunFiles()
 
-        # Load the first run in and get # of histograms
-        filename = os.path.join(inpath, str(filenamelist[0])) 
-        LoadRaw(Filename=filename, OutputWorkspace="added")
-        LoadSampleDetailsFromRaw("added", filename)
-        numhists = mtd['added'].getNumberHistograms()
-        if numhists == 8 and self.addtransflag == False:
+        if runfiles[0].nspectra == 8 and self.addtransflag == False:
             warning = 'Are you sure you want to add transmissions?'
             self.emit(SIGNAL('sigDocWarning'), (warning, ))
             return
 
-        # Then sequentially load and add each additional run
-        for run in filenamelist[1:len(filenamelist)]:
-            filename = os.path.join(inpath, str(run))
-            LoadRaw(Filename=filename, OutputWorkspace="wtemp")                 
-            if mtd['wtemp'].getNumberHistograms() != numhists:
-                warning = 'Run %s has wrong number of histograms' % run
-                self.emit(SIGNAL('sigDocFail'), (warning, ))
-                return
-                
-            Plus("added", "wtemp", "added")
+        # Every period is summed, one RunData per period
+        added = SansAddRuns.addRunPeriods(runfiles)
 
         # Because we require a matched log file I need to grab one and
         # and write it out with a matching name. Don't need to worry
@@ -203,9 +211,22 @@ class addRawDoc(QObject):
         shutil.copyfile(logfilepath, outlogfilepath)    
 
         # Write out the new nexus file and clean up
-        SaveNexus("added", os.path.join(outpath, (name +'.nxs'))) 
-        mantid.deleteWorkspace("wtemp")
-        mantid.deleteWorkspace("added")
+        outfilepath = os.path.join(outpath, (name +'.nxs'))
+        if MANTID:
+            LoadRaw(Filename=filenames[0], OutputWorkspace="added")
+            LoadSampleDetailsFromRaw("added", filenames[0])
+            # LoadRaw gives a group of added_1, added_2 ... for a
+            # multi-period run
+            if len(added) == 1:
+                SansAddRuns.fillWorkspace(mtd['added'], added[0])
+            else:
+                for period, rundata in enumerate(added):
+                    SansAddRuns.fillWorkspace(
+                                  mtd['added_' + str(period + 1)], rundata)
+            SaveNexus("added", outfilepath) 
+            mantid.deleteWorkspace("added")
+        else:
+            SansNexusFile.saveRunData(added, outfilepath)
         self.runlist = []
 
     def getFilelistForMenu(self):
@@ -232,13 +253,18 @@ class addRawDoc(QObject):
     def runlistToFilenames(self):
         """Method to take self.runlist and rebuild filenames
 
-        Requires some thoughout how to do this best. For the moment
-        the conversion is just hardcoded.
+        Requires some thoughout how to do this best. The run index for
+        the directory is consulted first and if the run isn't found
+        there the conversion is just hardcoded.
         """
 
+        index = SansRunIndex.getRunIndex(str(self.getPath()))
         filelist = []
         for run in self.runlist:
-            filelist.append('SANS2D0000' + run + '.raw')
+            filename = index.getRunFile(str(run), 'raw')
+            if not filename:
+                filename = 'SANS2D0000' + str(run) + '.raw'
+            filelist.append(filename)
 
         return filelist
 
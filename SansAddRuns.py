@@ -0,0 +1,255 @@
+# SansAddRuns: Summation of SANS runs without Mantid workspaces
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import numpy
+from multiprocessing.pool import ThreadPool
+import SansRunData
+
+# Headers are small reads dominated by file open and seek latency on the
+# archive so more threads than cores are worthwhile
+SCAN_THREADS = 8
+
+class RunAccumulator(object):
+    """A running sum of the counts from a set of compatible runs
+
+    The accumulator is allocated once with the shape of the runs being
+    added and each run is added into it in place, so adding any number
+    of runs only ever needs the accumulator and one run in memory.
+    Good frames and proton charge are summed along with the counts.
+    """
+
+    def __init__(self, nspectra, tof):
+        self.tof = numpy.asarray(tof, dtype = numpy.float64)
+        self.counts = numpy.zeros((nspectra, len(self.tof) - 1),
+                                  dtype = numpy.int64)
+        self.monitors = {}
+        self.good_frames = 0
+        self.proton_charge = 0.0
+        self.runs = []
+        self.template = None
+        self.times = []
+
+    def add(self, rundata):
+        """Add the counts from a SansRunData.RunData"""
+
+        try:
+            assert rundata.counts.shape == self.counts.shape
+        except AssertionError:
+            raise ValueError('Run ' + str(rundata.runnumber) +
+                             ' has wrong number of histograms or bins')
+        try:
+            assert numpy.allclose(rundata.tof, self.tof)
+        except AssertionError:
+            raise ValueError('Run ' + str(rundata.runnumber) +
+                             ' has different time of flight bins')
+
+        self.counts += rundata.counts
+        for spectrum, counts in rundata.monitors.items():
+            if spectrum not in self.monitors:
+                self.monitors[spectrum] = numpy.zeros(len(counts),
+                                                      dtype = numpy.int64)
+            self.monitors[spectrum] += counts
+        self.good_frames += rundata.good_frames
+        self.proton_charge += rundata.proton_charge
+        self.runs.append(rundata.runnumber)
+        self.times.extend([when for when in (rundata.start_time,
+                                             rundata.end_time) if when])
+        if self.template is None:
+            self.template = rundata
+
+    def getRunData(self):
+        """Return the sum as a SansRunData.RunData
+
+        Run details other than the counts, frames and charge are taken
+        from the first run added. The sum runs from the earliest start
+        to the latest end of the runs added.
+        """
+
+        template = self.template or SansRunData.RunData()
+        return SansRunData.RunData(filename = '', tof = self.tof.copy(),
+                              counts = self.counts,
+                              spectra = template.spectra,
+                              monitors = self.monitors,
+                              period = template.period,
+                              nperiods = 1,
+                              runnumber = template.runnumber,
+                              title = template.title,
+                              instrument = template.instrument,
+                              good_frames = self.good_frames,
+                              proton_charge = self.proton_charge,
+                              sample = dict(template.sample),
+                              monitor_spectra = template.monitor_spectra,
+                              monitor_distances = template.monitor_distances,
+                              start_time = min(self.times or ['']),
+                              end_time = max(self.times or ['']))
+
+class CompatibilityReport(object):
+    """The result of scanning the headers of a list of runs to be added
+
+    self.runfiles holds the opened run file for each filename (None if
+    the header could not be read) and self.problems a list of messages
+    describing each unreadable run and each run whose number of
+    histograms, time channels, time of flight boundaries or periods
+    differ from the first readable run.
+    """
+
+    def __init__(self, filenames, runfiles, errors):
+        self.filenames = list(filenames)
+        self.runfiles = list(runfiles)
+        self.problems = []
+
+        if not self.filenames:
+            self.problems.append('No runs to add')
+        first = None
+        for filename, runfile, error in zip(self.filenames, self.runfiles,
+                                            errors):
+            name = os.path.basename(str(filename))
+            if runfile is None:
+                self.problems.append('Run %s could not be read: %s'
+                                     % (name, error))
+            elif first is None:
+                first = runfile
+            elif runfile.nspectra != first.nspectra:
+                self.problems.append('Run %s has wrong number of histograms'
+                                     % name)
+            elif (runfile.nchannels != first.nchannels or
+                    not numpy.allclose(runfile.tof, first.tof)):
+                self.problems.append(
+                             'Run %s has different time of flight bins' % name)
+            elif runfile.nperiods != first.nperiods:
+                self.problems.append('Run %s has %d periods not %d'
+                                     % (name, runfile.nperiods,
+                                        first.nperiods))
+
+    def isCompatible(self):
+        return not self.problems
+
+    def getProblems(self):
+        return self.problems
+
+    def getRunFiles(self):
+        return self.runfiles
+
+    def getSummary(self):
+        """Return a line per run giving its header details"""
+
+        lines = []
+        for filename, runfile in zip(self.filenames, self.runfiles):
+            name = os.path.basename(str(filename))
+            if runfile is None:
+                lines.append('%s: unreadable' % name)
+            else:
+                lines.append('%s: run %s, %d histograms, %d bins, '
+                             '%d periods, %d good frames'
+                             % (name, runfile.runnumber, runfile.nspectra,
+                                runfile.nchannels, runfile.nperiods,
+                                runfile.good_frames))
+        return lines
+
+def scanRuns(filenames, threads = SCAN_THREADS):
+    """Read the headers of a list of runs in parallel
+
+    Only the headers are read so the scan takes milliseconds even for
+    long run lists. Returns a CompatibilityReport.
+    """
+
+    filenames = list(filenames)
+    if len(filenames) > 1 and threads > 1:
+        pool = ThreadPool(min(threads, len(filenames)))
+        try:
+            results = pool.map(_openRunFile, filenames)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_openRunFile(filename) for filename in filenames]
+
+    runfiles = [runfile for runfile, error in results]
+    errors = [error for runfile, error in results]
+    return CompatibilityReport(filenames, runfiles, errors)
+
+def checkRuns(filenames):
+    """Scan the headers of every run and check they can be added
+
+    Returns the list of opened run files (see SansRunData.openRunFile).
+    Raises ValueError with the first problem found by scanRuns.
+    """
+
+    report = scanRuns(filenames)
+    if not report.isCompatible():
+        raise ValueError(report.getProblems()[0])
+    return report.getRunFiles()
+
+def addRunFiles(filenames, period = 1):
+    """Sum one period of a list of run files into a SansRunData.RunData
+
+    Every header is checked before any counts are read. The runs are
+    then read one at a time into a RunAccumulator. filenames may also
+    be the list of run files returned by checkRuns. Use addRunPeriods
+    to sum every period of multi-period runs.
+    """
+
+    runfiles = _runFiles(filenames)
+    accumulator = RunAccumulator(runfiles[0].nspectra, runfiles[0].tof)
+    for runfile in runfiles:
+        logging.debug("SansAddRuns: adding " + runfile.filename)
+        accumulator.add(runfile.load(period = period))
+    return accumulator.getRunData()
+
+def addRunPeriods(filenames):
+    """Sum every period of a list of run files
+
+    As LoadRaw and Plus do, each period is summed separately. Returns a
+    list with a SansRunData.RunData for each period, which
+    SansNexusFile.saveRunData writes as one multi-period file. Only one
+    period's accumulator is held in memory at a time.
+    """
+
+    runfiles = _runFiles(filenames)
+    return [addRunFiles(runfiles, period)
+            for period in range(1, runfiles[0].nperiods + 1)]
+
+def fillWorkspace(workspace, rundata):
+    """Copy summed counts into a Mantid workspace loaded as a template
+
+    The workspace should be the first run loaded with LoadRaw so that the
+    instrument, sample and logs are carried over to the saved file.
+    Errors are set to the square root of the counts.
+    """
+
+    errors = numpy.sqrt(rundata.counts)
+    for index in range(workspace.getNumberHistograms()):
+        workspace.dataY(index)[:] = rundata.counts[index]
+        workspace.dataE(index)[:] = errors[index]
+
+def _runFiles(filenames):
+    """Return the checked run files for filenames or opened run files"""
+
+    if filenames and hasattr(filenames[0], 'load'):
+        return filenames
+    return checkRuns(filenames)
+
+def _openRunFile(filename):
+    """Open a run header returning (runfile, None) or (None, error)"""
+
+    try:
+        return SansRunData.openRunFile(filename), None
+    except (IOError, ValueError, KeyError, IndexError,
+            ImportError) as error:
+        return None, str(error)
@@ -0,0 +1,612 @@
+# SansBatch: Running queued SANS reductions in parallel
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import multiprocessing
+from collections import namedtuple
+import SansReduce
+import SansRunIndex
+import SansMaskFile
+import SansLogFilter
+import SansRKHFile
+import SansCanSASFile
+import SansNISTFile
+import SansQBinning
+
+# For testing outside of the Mantid environment
+try:
+    from mantidsimple import *
+    MANTID = True
+except ImportError:
+    def SaveRKH(reduced, targetpath):
+        pass
+    def SaveCanSAS1D(reduced, targetpath):
+        pass
+
+    MANTID = False
+
+# A self contained description of a single reduction. Run identifiers are
+# given as run number and extension (e.g. '3325.raw') as they are passed
+# to the setters of Standard1DReductionSANS2DRearDetector. Everything a
+# worker process needs is in the job so it can be pickled and sent to a
+# process with its own copy of the reduction module state. The periods
+# of the sample, sample transmission, can and can transmission runs
+# default to 1 and logfilter, the LogFilter.getTree of the reduction's
+# log filter (nested tuples, so jobs can still be hashed), to None so
+# journals written before they were added still load.
+ReductionJob = namedtuple('ReductionJob',
+                          ['sansrun', 'sanstrans', 'bgdrun', 'bgdtrans',
+                           'directbeam', 'path', 'maskfile', 'wavlow',
+                           'wavhigh', 'gravity', 'targetdirectory',
+                           'filename', 'outputLOQ', 'outputCanSAS',
+                           'sansperiod', 'sanstransperiod', 'bgdperiod',
+                           'bgdtransperiod', 'logfilter'])
+ReductionJob.__new__.__defaults__ = (1, 1, 1, 1, None)
+
+# The outcome of running a job. status is 'done', 'skipped' (the outputs
+# were already up to date) or 'failed' and message holds the error for
+# failed jobs.
+JobResult = namedtuple('JobResult', ['job', 'status', 'message'])
+
+# States of the items in a queue journal
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+# Extension of the file written next to the outputs of a reduction
+# recording what it was reduced from. Bump the version when a change to
+# the reduction should invalidate every existing output.
+PROVENANCE_EXTENSION = '.provenance'
+PROVENANCE_VERSION = 1
+
+def jobFromReduction(reduction, targetdirectory, filename,
+                     outputLOQ = False, outputCanSAS = True):
+    """Build a ReductionJob from a Standard1DReductionSANS2DRearDetector"""
+
+    # Absolute paths so the job doesn't depend on the working directory
+    maskfile = reduction.maskfile
+    if maskfile:
+        maskfile = os.path.abspath(maskfile)
+    path = reduction.getSansRun().getPath()
+    if path:
+        path = os.path.abspath(path)
+    logfilter = reduction.getLogFilter()
+    if logfilter is not None:
+        logfilter = logfilter.getTree()
+    return ReductionJob(sansrun = _runIdentifier(reduction.getSansRun()),
+                  sanstrans = _runIdentifier(reduction.getSansTrans()),
+                  bgdrun = _runIdentifier(reduction.getBackgroundRun()),
+                  bgdtrans = _runIdentifier(reduction.getBackgroundTrans()),
+                  directbeam = _runIdentifier(reduction.getDirectBeam()),
+                  path = path,
+                  maskfile = maskfile,
+                  wavlow = reduction.getWavRangeLow(),
+                  wavhigh = reduction.getWavRangeHigh(),
+                  gravity = reduction.gravity,
+                  targetdirectory = str(targetdirectory),
+                  filename = str(filename),
+                  outputLOQ = outputLOQ,
+                  outputCanSAS = outputCanSAS,
+                  sansperiod = reduction.getSansRun().getPeriod(),
+                  sanstransperiod = reduction.getSansTrans().getPeriod(),
+                  bgdperiod = reduction.getBackgroundRun().getPeriod(),
+                  bgdtransperiod = reduction.getBackgroundTrans().getPeriod(),
+                  logfilter = logfilter)
+
+def reductionFromJob(job):
+    """Rebuild a Standard1DReductionSANS2DRearDetector from a job"""
+
+    reduction = SansReduce.Standard1DReductionSANS2DRearDetector()
+    if job.path:
+        reduction.setPathForAllRuns(job.path)
+    reduction.setSansRun(job.sansrun)
+    reduction.setSansTrans(job.sanstrans)
+    reduction.setBackgroundRun(job.bgdrun)
+    reduction.setBackgroundTrans(job.bgdtrans)
+    reduction.setDirectBeam(job.directbeam)
+    reduction.getSansRun().setPeriod(job.sansperiod)
+    reduction.getSansTrans().setPeriod(job.sanstransperiod)
+    reduction.getBackgroundRun().setPeriod(job.bgdperiod)
+    reduction.getBackgroundTrans().setPeriod(job.bgdtransperiod)
+    if job.logfilter is not None:
+        reduction.setLogFilter(SansLogFilter.filterFromTree(job.logfilter))
+    if job.maskfile:
+        reduction.setMaskfile(job.maskfile)
+    reduction.setWavRangeLow(job.wavlow)
+    reduction.setWavRangeHigh(job.wavhigh)
+    reduction.setGravity(job.gravity)
+    return reduction
+
+def writeOutputFiles(reduced, targetdirectory, filename, outputLOQ = False,
+                     outputCanSAS = True):
+    """Write out a reduced workspace in the requested formats
+
+    reduced is either the Mantid workspace from doReduction, saved with
+    SaveRKH and SaveCanSAS1D, or a SansQBinning.Q1DResult from a native
+    reduction, which is written by SansRKHFile and SansCanSASFile and
+    so doesn't need Mantid. A SansQBinning.Q2DResult from doReduction2D
+    has no 1D formats and is written as a NIST .dat file whatever
+    outputLOQ and outputCanSAS are. Returns the list of files written
+    (see outputPaths).
+    """
+
+    # Check the target directory and filename make sense
+    if not os.path.isdir(targetdirectory):
+        raise IOError("Target directory does not exist")
+    if not filename:
+        raise IOError("I don't have a filename to save to")
+
+    # Set up the path and write out the files
+    targetpath = os.path.join(targetdirectory, filename)
+    if isinstance(reduced, SansQBinning.Q2DResult):
+        SansNISTFile.writeNISTFile(targetpath + '.dat', reduced.qx,
+                                   reduced.qy, reduced.intensity,
+                                   reduced.errors)
+        return [targetpath + '.dat']
+    if isinstance(reduced, SansQBinning.Q1DResult):
+        q = 0.5 * (reduced.q[1:] + reduced.q[:-1])
+        if outputLOQ:
+            SansRKHFile.writeRKHFile(targetpath + '.LOQ', q,
+                                     reduced.intensity, reduced.errors,
+                                     filename)
+        if outputCanSAS:
+            SansCanSASFile.writeCanSASFile(targetpath + '.xml', q,
+                                           reduced.intensity, reduced.errors,
+                                           title = filename)
+    else:
+        if outputLOQ:
+            SaveRKH(reduced, targetpath + '.LOQ')
+        if outputCanSAS:
+            SaveCanSAS1D(reduced, targetpath + '.xml')
+    return outputPaths(targetdirectory, filename, outputLOQ, outputCanSAS)
+
+def outputPaths(targetdirectory, filename, outputLOQ = False,
+                outputCanSAS = True):
+    """Return the paths of the files writeOutputFiles will write"""
+
+    targetpath = os.path.join(targetdirectory, filename)
+    paths = []
+    if outputLOQ:
+        paths.append(targetpath + '.LOQ')
+    if outputCanSAS:
+        paths.append(targetpath + '.xml')
+    return paths
+
+def periodFilename(filename, period):
+    """Return the output name for one period, e.g. 3325p2 for period 2
+
+    The period goes after the run number as in the workspace names of
+    _leaveSinglePeriod.
+    """
+
+    return str(filename) + 'p' + str(period)
+
+def writePeriodFiles(result, periods, targetdirectory, filename,
+                     outputLOQ = True, outputCanSAS = False):
+    """Write each period of a doPeriodReductions result to its own files
+
+    result is a SansQBinning.Q1DResult with a row for each of periods.
+    Each row is written as by writeOutputFiles under the name given by
+    periodFilename. Returns the list of files written.
+    """
+
+    intensity = result.intensity.reshape(len(periods), -1)
+    errors = result.errors.reshape(len(periods), -1)
+    paths = []
+    for row, period in enumerate(periods):
+        paths.extend(writeOutputFiles(SansQBinning.Q1DResult(result.q,
+                                        intensity[row], errors[row], None),
+                                      targetdirectory,
+                                      periodFilename(filename, period),
+                                      outputLOQ, outputCanSAS))
+    return paths
+
+def jobProvenance(job, reduction = None):
+    """Return a description of everything the output of a job depends on
+
+    This covers the (absolute path, mtime, size) of each run file and
+    of the efficiency files the mask file names, the settings read from
+    the mask file, the period of each run, the log filter and the
+    sample's .log file it is checked against, and the wavelength range,
+    gravity, instrument, detector and output formats. Files that don't
+    exist are given as None. reduction is the job's
+    Standard1DReductionSANS2DRearDetector, rebuilt from the job if not
+    given.
+    """
+
+    if reduction is None:
+        reduction = reductionFromJob(job)
+    runs = {}
+    for name, run in (('sansrun', reduction.getSansRun()),
+                      ('sanstrans', reduction.getSansTrans()),
+                      ('bgdrun', reduction.getBackgroundRun()),
+                      ('bgdtrans', reduction.getBackgroundTrans()),
+                      ('directbeam', reduction.getDirectBeam())):
+        if not run.getFilename():
+            run.mungeNames()
+        runs[name] = _fileStamp(run._buildFullPath())
+
+    # The log is only read if there is a filter to check
+    log = None
+    if job.logfilter is not None:
+        log = _fileStamp(os.path.splitext(
+                  reduction.getSansRun()._buildFullPath())[0] + '.log')
+
+    settings = SansMaskFile.readMaskFile(job.maskfile)
+    efficiency = [_fileStamp(settings.get(name)) for name in
+                  ('DIRECT_BEAM_FILE_R', 'DIRECT_BEAM_FILE_F')]
+    return {'version' : PROVENANCE_VERSION,
+            'runs' : runs,
+            'periods' : [job.sansperiod, job.sanstransperiod,
+                         job.bgdperiod, job.bgdtransperiod],
+            'logfilter' : job.logfilter,
+            'log' : log,
+            'mask' : [list(item) for item in settings.values],
+            'efficiency' : efficiency,
+            'wavlow' : job.wavlow,
+            'wavhigh' : job.wavhigh,
+            'gravity' : job.gravity,
+            'instrument' : reduction.getInstrument(),
+            'detector' : reduction.detector,
+            'outputLOQ' : job.outputLOQ,
+            'outputCanSAS' : job.outputCanSAS}
+
+def provenanceHash(provenance):
+    """Return the SHA-1 hex digest of a jobProvenance"""
+
+    return hashlib.sha1(json.dumps(provenance, sort_keys = True)
+                        .encode('utf-8')).hexdigest()
+
+def provenancePath(job):
+    """Return the path of the provenance file of a job's outputs"""
+
+    return os.path.join(job.targetdirectory,
+                        job.filename + PROVENANCE_EXTENSION)
+
+def readProvenanceHash(job):
+    """Return the hash recorded with a job's outputs, or None"""
+
+    try:
+        provenancefile = open(provenancePath(job), 'r')
+    except IOError:
+        return None
+    try:
+        try:
+            return str(json.load(provenancefile)['hash'])
+        except (ValueError, KeyError, TypeError):
+            return None
+    finally:
+        provenancefile.close()
+
+def writeProvenance(job, provenance):
+    """Record the provenance of a job's outputs once they are written
+
+    The file is written to a temporary file and renamed into place so
+    a crash never leaves a provenance file that doesn't parse.
+    """
+
+    handle, temporary = tempfile.mkstemp(dir = job.targetdirectory,
+                                         prefix = 'tmp',
+                                         suffix = PROVENANCE_EXTENSION)
+    provenancefile = os.fdopen(handle, 'w')
+    try:
+        json.dump({'hash' : provenanceHash(provenance),
+                   'inputs' : provenance}, provenancefile, sort_keys = True,
+                  indent = 1)
+    finally:
+        provenancefile.close()
+    path = provenancePath(job)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temporary, path)
+
+def isUpToDate(job, provenance = None):
+    """Return True if a job's outputs exist and match its inputs
+
+    The hash of the job's provenance (worked out now unless given) must
+    match the one recorded when the outputs were written.
+    """
+
+    if provenance is None:
+        provenance = jobProvenance(job)
+    if not all([os.path.exists(path) for path in
+                outputPaths(job.targetdirectory, job.filename,
+                            job.outputLOQ, job.outputCanSAS)]):
+        return False
+    return readProvenanceHash(job) == provenanceHash(provenance)
+
+def runJob(job, force = False):
+    """Run a single reduction job and write its output files
+
+    This is the function run in the worker processes. Errors are caught
+    and returned in the JobResult so one bad reduction doesn't stop the
+    rest of the batch.
+
+    A job whose outputs are up to date with its inputs (see isUpToDate)
+    is skipped unless force is True. Otherwise the provenance of the
+    inputs, taken before reducing, is written with the outputs.
+    """
+
+    try:
+        reduction = reductionFromJob(job)
+        provenance = jobProvenance(job, reduction)
+        if not force and isUpToDate(job, provenance):
+            logging.debug("SansBatch: " + job.filename + " is up to date")
+            result = JobResult(job, SKIPPED, '')
+        else:
+            reduced = reduction.doReduction()
+            writeOutputFiles(reduced, job.targetdirectory, job.filename,
+                             job.outputLOQ, job.outputCanSAS)
+            writeProvenance(job, provenance)
+            result = JobResult(job, DONE, '')
+    except Exception as error:
+        logging.debug("SansBatch: reduction of " + job.sansrun +
+                      " failed: " + str(error))
+        result = JobResult(job, FAILED, str(error))
+
+    # Clear the Mantid workspaces before doing further reductions
+    if MANTID:
+        mantid.clear()
+    return result
+
+def runJobs(jobs, processes = None, callback = None, journal = None,
+            force = False):
+    """Run a list of ReductionJobs returning their JobResults in order
+
+    Jobs are run in a pool of worker processes (one per core unless
+    processes is given). Each worker runs a single job and is then
+    replaced so the module level state of the reduction scripts and any
+    Mantid workspaces never leak from one reduction into the next.
+    processes = 1 runs the jobs in this process, one after the other.
+    The pool is for plain Python processes such as the command line
+    entry point below: callers running inside a Qt application or
+    MantidPlot should pass processes = 1 rather than fork it.
+
+    callback, if given, is called with the index and JobResult of each
+    job as results arrive, in queue order.
+
+    journal, if given, is a QueueJournal already holding the jobs. Each
+    job is marked running as it starts and done or failed as it
+    finishes, so the batch can be resumed with resumeJobs if this
+    process dies part way through.
+
+    Jobs whose outputs are already up to date are skipped unless force
+    is True (see runJob).
+    """
+
+    jobs = list(jobs)
+    if journal:
+        indices = journal.getIndices(jobs)
+        tasks = [(journal.path, index, job, force)
+                 for index, job in zip(indices, jobs)]
+    else:
+        tasks = [(None, None, job, force) for job in jobs]
+    worker = _runTask
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+
+    if processes == 1:
+        results = (worker(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, maxtasksperchild = 1)
+        results = pool.imap(worker, tasks)
+
+    collected = []
+    try:
+        for index, result in enumerate(results):
+            collected.append(result)
+            if journal:
+                journal.mark(indices[index], result.status, result.message)
+            if callback:
+                callback(index, result)
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+    return collected
+
+class QueueJournal(object):
+    """A record on disk of a reduction queue and the state of each item
+
+    The journal is a JSON lines file. It starts with one line for each
+    job in the queue in the pending state and a line is appended each
+    time an item changes state, e.g.
+
+        {"index": 0, "state": "pending", "job": {"sansrun": ...}}
+        {"index": 0, "state": "running"}
+        {"index": 0, "state": "done", "message": ""}
+
+    Lines are only ever appended and each is written with a single write
+    so a crash can at worst lose the last line. Reading the journal
+    replays the lines to give the latest state of each item.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def create(self, jobs):
+        """Start a new journal holding the jobs, all pending"""
+
+        journalfile = open(self.path, 'w')
+        try:
+            for index, job in enumerate(jobs):
+                journalfile.write(json.dumps({'index' : index,
+                                              'state' : PENDING,
+                                              'job' : job._asdict()}) + '\n')
+            journalfile.flush()
+            os.fsync(journalfile.fileno())
+        finally:
+            journalfile.close()
+
+    def mark(self, index, state, message = ''):
+        """Append a change of state for an item"""
+
+        _appendLine(self.path, json.dumps({'index' : index, 'state' : state,
+                                           'message' : message}))
+
+    def read(self):
+        """Replay the journal returning a list of (job, state, message)"""
+
+        jobs = {}
+        states = {}
+        journalfile = open(self.path, 'r')
+        try:
+            for line in journalfile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partly written last line from a crash
+                    continue
+                index = record['index']
+                if 'job' in record:
+                    jobs[index] = _jobFromDict(record['job'])
+                states[index] = (str(record['state']),
+                                 str(record.get('message', '')))
+        finally:
+            journalfile.close()
+
+        return [(jobs[index],) + states[index] for index in sorted(jobs)]
+
+    def getIndices(self, jobs):
+        """Return the journal index of each of a list of jobs"""
+
+        indices = {}
+        for index, (job, state, message) in enumerate(self.read()):
+            indices.setdefault(job, []).append(index)
+        try:
+            return [indices[job].pop(0) for job in jobs]
+        except (KeyError, IndexError):
+            raise ValueError('Job is not in the journal ' + self.path)
+
+    def getUnfinishedJobs(self):
+        """Return the jobs still to be run
+
+        Jobs are unfinished unless they are done (or were skipped as up to
+        date) and every output file they write exists. Jobs left running
+        by a crash are included.
+        """
+
+        unfinished = []
+        for job, state, message in self.read():
+            if state in (DONE, SKIPPED) and all([os.path.exists(path)
+                                  for path in outputPaths(job.targetdirectory,
+                                                          job.filename,
+                                                          job.outputLOQ,
+                                                          job.outputCanSAS)]):
+                continue
+            unfinished.append(job)
+        return unfinished
+
+def runJournaledJobs(jobs, path, processes = None, callback = None,
+                     force = False):
+    """Journal a new queue of jobs to path and run them"""
+
+    journal = QueueJournal(path)
+    journal.create(jobs)
+    return runJobs(jobs, processes, callback, journal, force)
+
+def resumeJobs(path, processes = None, callback = None, force = False):
+    """Resume the queue journaled at path
+
+    Only the jobs that are not yet done, or whose output files have gone
+    missing, are run. Returns their JobResults.
+    """
+
+    journal = QueueJournal(path)
+    jobs = journal.getUnfinishedJobs()
+    logging.debug("SansBatch: resuming " + str(len(jobs)) +
+                  " reductions from " + path)
+    return runJobs(jobs, processes, callback, journal, force)
+
+def runnumberFromIdentifier(identifier):
+    """Strip the extension from a run identifier such as '3325.raw'"""
+
+    return os.path.splitext(identifier)[0]
+
+def _runIdentifier(run):
+    """Return the run number and extension of a run as a single string"""
+
+    if run.getExt():
+        return run.getRunnumber() + '.' + run.getExt()
+    return run.getRunnumber()
+
+def _runTask(task):
+    """Worker function running a job, marking it running in the journal
+
+    task is (journal path, journal index, job, force). The journal path
+    is None for jobs that aren't journaled.
+    """
+
+    path, index, job, force = task
+    if path:
+        _appendLine(path, json.dumps({'index' : index, 'state' : RUNNING}))
+    return runJob(job, force)
+
+def _fileStamp(path):
+    """Return SansRunIndex.fileStamp as a list, or None for no file"""
+
+    if not path or not os.path.isfile(path):
+        return None
+    return list(SansRunIndex.fileStamp(path))
+
+def _appendLine(path, line):
+    """Append a line to a file with a single write"""
+
+    journalfile = open(path, 'a')
+    try:
+        journalfile.write(line + '\n')
+        journalfile.flush()
+        os.fsync(journalfile.fileno())
+    finally:
+        journalfile.close()
+
+def _jobFromDict(fields):
+    """Rebuild a ReductionJob from its JSON form
+
+    json gives unicode strings which the reduction setters don't accept.
+    """
+
+    values = {}
+    for key, value in fields.items():
+        if isinstance(value, type(u'')):
+            value = str(value)
+        values[str(key)] = value
+    # The log filter tree comes back as lists, which can't be hashed
+    if values.get('logfilter') is not None:
+        values['logfilter'] = SansLogFilter.filterFromTree(
+                                  values['logfilter']).getTree()
+    return ReductionJob(**values)
+
+if __name__ == '__main__':
+    # Resume a journaled queue, e.g. after a crash:
+    #   python SansBatch.py queue.jsonl
+    for result in resumeJobs(sys.argv[1]):
+        print(result.job.sansrun + ': ' + result.status + ' ' +
+              result.message)
@@ -0,0 +1,322 @@
+# SansBeamCentre: Finding the beam centre without Mantid
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import multiprocessing
+import numpy
+from collections import namedtuple
+from multiprocessing import sharedctypes
+import SansGeometry
+import SansQBinning
+
+# The quadrants of GroupIntoQuadrants in the order of their rows
+QUADRANTS = ['Left', 'Right', 'Up', 'Down']
+
+# First step and convergence limit of the search in metres, as used by
+# the reduction script's FindBeamCentre
+STEP = 0.005
+TOLERANCE = 0.0001251
+
+# Extra radius in metres around rlow to rupp kept when picking the
+# pixels a search can reach, beyond the largest possible move
+MARGIN = 0.005
+
+# Half the width and the spacing in metres of the grid a grid search
+# looks over around the starting centre
+GRID_HALFWIDTH = 0.01
+GRID_STEP = 0.0025
+
+def quadrantGroups(geometry, rlow, rupp, indices = None):
+    """Return the quadrant of each pixel as an index into QUADRANTS
+
+    Pixels are split by their direction from the beam axis into 90
+    degree wedges centred on the left, right, up and down directions,
+    as QuadrantXML does. Pixels closer to the beam than rlow or further
+    than rupp (in metres) are given -1.
+    """
+
+    if indices is None:
+        indices = slice(None)
+    phi = geometry.phi[indices]
+    radius = geometry.radius[indices]
+    groups = numpy.where(numpy.abs(phi) > 135, 0,
+             numpy.where(numpy.abs(phi) <= 45, 1,
+             numpy.where(phi > 0, 2, 3)))
+    return numpy.where((radius >= rlow) & (radius <= rupp), groups, -1)
+
+def quadrantResidue(intensity):
+    """Return the (left - right, up - down) residues of quadrant I(Q)
+
+    intensity has a row for each of QUADRANTS. As in CalculateResidue
+    each residue is the sum of the squared differences over the Q bins
+    where both quadrants have data.
+    """
+
+    residues = []
+    for first, second in ((0, 1), (2, 3)):
+        both = (intensity[first] != 0) & (intensity[second] != 0)
+        residues.append(float(numpy.sum((intensity[first][both] -
+                                         intensity[second][both]) ** 2)))
+    return tuple(residues)
+
+# The arrays of one run needed to bin its quadrants: the counts, errors
+# and normalisation per steradian of the pixels a search can reach, and
+# the row of the geometry tables for each pixel
+QuadrantRun = namedtuple('QuadrantRun', ['counts', 'errors',
+                                         'normalisation', 'indices'])
+
+class BeamCentreFinder(object):
+    """Find the beam centre from a prepared SansNativeReduction
+
+    Each trial centre needs only a new geometry table and one binning
+    pass over the pixels that can fall between rlow and rupp (in
+    metres): the runs were loaded, masked and converted to wavelength
+    when the reduction was prepared. The quadrant I(Q) of the sample,
+    less the can if there is one, are compared with quadrantResidue.
+    Centres more than maxshift from the one the reduction was prepared
+    with may lose pixels from the annulus.
+    """
+
+    def __init__(self, reduction, rlow, rupp, maxshift = 0.05):
+        reduction.prepare()
+        self.rlow = float(rlow)
+        self.rupp = float(rupp)
+        self.bank = reduction.bank
+        self.logvalues = reduction.logvalues
+        self.settings = reduction.settings
+        self.qbins = reduction.qbins
+        self.gravity = reduction.gravity
+        self.wavelengths = reduction.sample.wavelengths
+        self.evaluations = 0
+
+        # Only pixels within reach of the annulus are binned
+        geometry = reduction.sample.geometry
+        radius = geometry.radius[reduction.sample.indices]
+        rows = numpy.nonzero(~reduction.sample.spectrummask &
+                             (radius >= self.rlow - maxshift - MARGIN) &
+                             (radius <= self.rupp + maxshift + MARGIN))[0]
+
+        # The prepared normalisation holds the solid angles at the centre
+        # it was prepared with, which are taken out here and replaced
+        # with those of each trial centre
+        self.runs = []
+        for data in (reduction.sample, reduction.can):
+            if data is None:
+                continue
+            indices = data.indices[rows]
+            self.runs.append(QuadrantRun(data.counts[rows],
+                        numpy.sqrt(data.variances[rows]),
+                        data.normalisation[rows] /
+                        data.geometry.solidangle[indices][:, numpy.newaxis],
+                        indices))
+
+    def getGeometry(self, xbeam, ybeam):
+        """Return the DetectorGeometry for a trial centre"""
+
+        position = SansGeometry.detectorPosition(self.bank, self.logvalues,
+                                                 self.settings, xbeam, ybeam)
+        return SansGeometry.getGeometry(position)
+
+    def getQuadrants(self, xbeam, ybeam):
+        """Return the quadrant I(Q) for a trial centre as a Q1DResult"""
+
+        geometry = self.getGeometry(xbeam, ybeam)
+        results = []
+        for run in self.runs:
+            results.append(SansQBinning.q1dGroups(run.counts,
+                    self.wavelengths, geometry, self.qbins,
+                    quadrantGroups(geometry, self.rlow, self.rupp,
+                                   run.indices),
+                    run.errors, run.normalisation *
+                    geometry.solidangle[run.indices][:, numpy.newaxis],
+                    self.gravity, geometry.spectra[run.indices]))
+        intensity = results[0].intensity
+        errors = results[0].errors
+        if len(results) == 2:
+            intensity = intensity - results[1].intensity
+            errors = numpy.hypot(errors, results[1].errors)
+        return SansQBinning.Q1DResult(results[0].q, intensity, errors,
+                                      results[0].normalisation)
+
+    def getResidue(self, xbeam, ybeam):
+        """Return the (x, y) residues for a trial centre"""
+
+        self.evaluations += 1
+        residue = quadrantResidue(self.getQuadrants(xbeam, ybeam).intensity)
+        logging.debug("SansBeamCentre: " + str(xbeam * 1000.0) + ", " +
+                      str(ybeam * 1000.0) + " residue " + str(residue))
+        return residue
+
+    def findCentre(self, xstart = None, ystart = None, maxiter = 20,
+                   step = STEP, tolerance = TOLERANCE):
+        """Search for the centre minimising the quadrant residues
+
+        The search starts from the centre in the mask file unless xstart
+        and ystart (in metres) are given. As in FindBeamCentre x and y
+        are stepped together, the left-right residue deciding the x step
+        and the up-down residue the y step, but a step is only taken if
+        it lowers its residue; otherwise it is reversed and halved.
+        Stops when both steps are below tolerance or after maxiter
+        trials. Returns the centre (x, y) in metres.
+        """
+
+        if xstart is None:
+            xstart = self.settings.get('XBEAM_CENTRE')
+        if ystart is None:
+            ystart = self.settings.get('YBEAM_CENTRE')
+        x, y = float(xstart), float(ystart)
+        xstep = ystep = float(step)
+        residuex, residuey = self.getResidue(x, y)
+
+        for iteration in range(maxiter):
+            if abs(xstep) < tolerance and abs(ystep) < tolerance:
+                break
+            trialx = x + xstep if abs(xstep) >= tolerance else x
+            trialy = y + ystep if abs(ystep) >= tolerance else y
+            newx, newy = self.getResidue(trialx, trialy)
+            if newx < residuex:
+                x, residuex = trialx, newx
+            else:
+                xstep = -xstep / 2.0
+            if newy < residuey:
+                y, residuey = trialy, newy
+            else:
+                ystep = -ystep / 2.0
+
+        logging.debug("SansBeamCentre: centre " + str(x * 1000.0) + ", " +
+                      str(y * 1000.0) + " after " + str(self.evaluations) +
+                      " evaluations")
+        return x, y
+
+    def gridSearch(self, xcentre = None, ycentre = None,
+                   halfwidth = GRID_HALFWIDTH, step = GRID_STEP,
+                   processes = None):
+        """Evaluate the residues over a grid of trial centres
+
+        The grid is spaced step apart out to halfwidth either side of
+        xcentre and ycentre (by default the centre in the mask file), all
+        in metres. The points are shared between a pool of processes
+        (one per core unless processes is given, processes = 1 evaluates
+        them here). Each worker builds its finder on the binned arrays
+        of this one through shared memory rather than a copy.
+
+        Returns the grid x and y values and the residues, an array with
+        an (x residue, y residue) pair for each x and y.
+        """
+
+        if xcentre is None:
+            xcentre = self.settings.get('XBEAM_CENTRE')
+        if ycentre is None:
+            ycentre = self.settings.get('YBEAM_CENTRE')
+        offsets = numpy.arange(-halfwidth, halfwidth + step / 2.0, step)
+        xs = float(xcentre) + offsets
+        ys = float(ycentre) + offsets
+        points = [(x, y) for x in xs for y in ys]
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = max(1, min(processes, len(points)))
+        if processes == 1:
+            residues = [self.getResidue(x, y) for x, y in points]
+        else:
+            pool = multiprocessing.Pool(processes, _initWorker,
+                                        (self.getSharedState(),))
+            try:
+                residues = pool.map(_gridResidue, points)
+            except:
+                pool.terminate()
+                raise
+            pool.close()
+            pool.join()
+            self.evaluations += len(points)
+
+        return xs, ys, numpy.array(residues).reshape(len(xs), len(ys), 2)
+
+    def findCentreByGrid(self, xcentre = None, ycentre = None,
+                         halfwidth = GRID_HALFWIDTH, step = GRID_STEP,
+                         processes = None, maxiter = 20,
+                         tolerance = TOLERANCE):
+        """Find the centre by a grid search refined with findCentre
+
+        gridSearch is run first. The starting x for the refinement is the
+        grid column whose left-right residue, summed over the grid, is
+        lowest and the starting y likewise from the up-down residue, so
+        a single noisy point can't pull the start away. findCentre then
+        refines it with a first step of half the grid spacing. Returns
+        the centre (x, y) in metres.
+        """
+
+        xs, ys, residues = self.gridSearch(xcentre, ycentre, halfwidth,
+                                           step, processes)
+        xstart = xs[numpy.argmin(residues[:, :, 0].sum(axis = 1))]
+        ystart = ys[numpy.argmin(residues[:, :, 1].sum(axis = 0))]
+        logging.debug("SansBeamCentre: grid search start " +
+                      str(xstart * 1000.0) + ", " + str(ystart * 1000.0))
+        return self.findCentre(xstart, ystart, maxiter, step / 2.0,
+                               tolerance)
+
+    def getSharedState(self):
+        """Return what a SharedBeamCentreFinder needs, in shared memory
+
+        The binned arrays are copied once into shared memory blocks
+        that worker processes map rather than receive as copies.
+        """
+
+        state = {}
+        for name in ('rlow', 'rupp', 'bank', 'logvalues', 'settings',
+                     'qbins', 'gravity', 'wavelengths'):
+            state[name] = getattr(self, name)
+        state['runs'] = [(_shareArray(run.counts), _shareArray(run.errors),
+                          _shareArray(run.normalisation), run.indices)
+                         for run in self.runs]
+        return state
+
+class SharedBeamCentreFinder(BeamCentreFinder):
+    """A BeamCentreFinder built in a worker from getSharedState"""
+
+    def __init__(self, state):
+        for name, value in state.items():
+            if name != 'runs':
+                setattr(self, name, value)
+        self.evaluations = 0
+        self.runs = [QuadrantRun(_sharedArray(counts), _sharedArray(errors),
+                                 _sharedArray(normalisation), indices)
+                     for counts, errors, normalisation, indices
+                     in state['runs']]
+
+# The finder of a grid search worker process
+_WORKER = None
+
+def _initWorker(state):
+    global _WORKER
+    _WORKER = SharedBeamCentreFinder(state)
+
+def _gridResidue(point):
+    return _WORKER.getResidue(*point)
+
+def _shareArray(array):
+    """Copy an array into shared memory returning (block, shape)"""
+
+    shared = sharedctypes.RawArray('d', int(array.size))
+    _sharedArray((shared, array.shape))[...] = array
+    return shared, array.shape
+
+def _sharedArray(shared):
+    """Return a NumPy view of a (block, shape) from _shareArray"""
+
+    block, shape = shared
+    return numpy.frombuffer(block, dtype = numpy.float64).reshape(shape)
@@ -0,0 +1,108 @@
+# SansCanSASFile: Writing of CanSAS 1D XML files without Mantid
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import time
+import numpy
+from xml.sax.saxutils import escape, quoteattr
+import SansRKHFile
+
+# Units of Q and of the absolutely scaled intensity
+Q_UNIT = '1/A'
+I_UNIT = '1/cm'
+
+# The document around the data, laid out as SaveCanSAS1D lays it out
+HEADER_FORMAT = ('<?xml version="1.0"?>\n'
+                 '<?xml-stylesheet type="text/xsl" '
+                 'href="cansasxml-html.xsl" ?>\n'
+                 '<SASroot version="1.0"\n'
+                 '\t\t xmlns="cansas1d/1.0"\n'
+                 '\t\t xmlns:xsi="http://www.w3.org/2001/'
+                 'XMLSchema-instance"\n'
+                 '\t\t xsi:schemaLocation="cansas1d/1.0 '
+                 'http://svn.smallangles.net/svn/canSAS/1dwg/trunk/'
+                 'cansas1d.xsd">\n'
+                 '\t<SASentry name=%s>\n'
+                 '\t\t<Title>%s</Title>\n'
+                 '\t\t<Run>%s</Run>\n'
+                 '\t\t<SASdata>\n')
+FOOTER_FORMAT = ('\t\t</SASdata>\n'
+                 '\t\t<SASsample>\n'
+                 '\t\t\t<ID>%s</ID>\n'
+                 '\t\t</SASsample>\n'
+                 '\t\t<SASinstrument>\n'
+                 '\t\t\t<name>%s</name>\n'
+                 '\t\t\t<SASsource>\n'
+                 '\t\t\t\t<radiation>Spallation Neutron Source</radiation>\n'
+                 '\t\t\t</SASsource>\n'
+                 '\t\t\t<SAScollimation/>\n'
+                 '\t\t\t<SASdetector>\n'
+                 '\t\t\t\t<name>%s</name>\n'
+                 '\t\t\t</SASdetector>\n'
+                 '\t\t</SASinstrument>\n'
+                 '\t\t<SASprocess>\n'
+                 '\t\t\t<name>SansReduce</name>\n'
+                 '\t\t\t<date>%s</date>\n'
+                 '\t\t</SASprocess>\n'
+                 '\t\t<SASnote/>\n'
+                 '\t</SASentry>\n'
+                 '</SASroot>\n')
+
+# One <Idata> point, with and without the resolution in Q
+ROW_FORMAT = ('\t\t\t<Idata><Q unit="' + Q_UNIT + '">%.6E</Q>'
+              '<I unit="' + I_UNIT + '">%.6E</I>'
+              '<Idev unit="' + I_UNIT + '">%.6E</Idev></Idata>\n')
+ROW_QDEV_FORMAT = ('\t\t\t<Idata><Q unit="' + Q_UNIT + '">%.6E</Q>'
+                   '<I unit="' + I_UNIT + '">%.6E</I>'
+                   '<Idev unit="' + I_UNIT + '">%.6E</Idev>'
+                   '<Qdev unit="' + Q_UNIT + '">%.6E</Qdev></Idata>\n')
+
+def writeCanSASFile(path, q, intensity, errors, qerrors = None,
+                    title = '', run = '', instrument = 'SANS2D',
+                    detector = 'rear-detector'):
+    """Write I(Q) to a CanSAS 1D (version 1.0) XML file
+
+    q holds the Q value of each point (bin centres rather than the
+    boundaries of a Q1DResult) with an intensity and error for each,
+    and optionally the resolution in Q. The document is written as text
+    around the <Idata> rows rather than built as a tree.
+    """
+
+    q = numpy.asarray(q, dtype = numpy.float64).ravel()
+    columns = [q, numpy.ravel(intensity), numpy.ravel(errors)]
+    rowformat = ROW_FORMAT
+    if qerrors is not None:
+        columns.append(numpy.ravel(qerrors))
+        rowformat = ROW_QDEV_FORMAT
+    try:
+        assert all([len(column) == len(q) for column in columns])
+    except AssertionError:
+        raise ValueError('Q, intensity and errors must be the same length')
+    rows = numpy.column_stack(columns)
+
+    title, run = str(title), str(run)
+    cansasfile = open(path, 'w')
+    try:
+        cansasfile.write(HEADER_FORMAT % (quoteattr(title or 'workspace'),
+                                          escape(title), escape(run)))
+        cansasfile.writelines(SansRKHFile.formatRows(rowformat, rows))
+        cansasfile.write(FOOTER_FORMAT % (escape(title), escape(instrument),
+                                          escape(detector),
+                                          time.strftime('%d-%b-%Y %H:%M:%S')))
+    finally:
+        cansasfile.close()
+    logging.debug("SansCanSASFile: wrote " + str(path))
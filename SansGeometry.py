@@ -0,0 +1,213 @@
+# SansGeometry: Precomputed pixel geometry for the SANS2D detector banks
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import math
+import numpy
+from collections import namedtuple, OrderedDict
+import SansRunData
+import SansLogFile
+
+# Pixel pitch of the SANS2D banks in metres (the last two values of the
+# 'set centre' line of the mask files)
+PIXEL_SIZE = 0.0051
+
+# Radius in mm of the arc the front detector rotates on, as in the
+# reduction script
+FRONT_DET_RADIUS = 306.0
+
+# The detector logs read by _loadDetectorLogs, in mm and degrees
+DETECTOR_LOGS = ['Rear_Det_X', 'Rear_Det_Z', 'Front_Det_X', 'Front_Det_Z',
+                 'Front_Det_Rot']
+
+# Number of geometry tables kept. Centre finding builds a new table for
+# each trial centre so only the most recent few are kept.
+CACHE_SIZE = 16
+
+# Where a bank sits for a reduction. x, y and z are the position of the
+# centre of the bank in metres with the beam along z through the origin,
+# rotation is the rotation of the bank about the vertical axis in degrees
+# and sample_z is the position of the sample along the beam.
+DetectorPosition = namedtuple('DetectorPosition', ['bank', 'x', 'y', 'z',
+                                                   'rotation', 'sample_z'])
+
+class DetectorGeometry(object):
+    """Pixel positions, angles and solid angles for one detector bank
+
+    Each array has one value per pixel in spectrum number order, so the
+    tables line up with the rows of a bank's counts. Arrays are read only
+    as one table is shared by every reduction with the same detector
+    position (see getGeometry).
+
+    self.x, self.y and self.z are the pixel centres in metres relative
+    to the beam axis. self.radius is the distance of each pixel from the
+    beam axis and self.phi its azimuthal angle in degrees (0 along +x,
+    anticlockwise looking along the beam). self.distance is the distance
+    from the sample, self.twotheta the scattering angle in radians and
+    self.solidangle the solid angle of each pixel seen from the sample
+    in steradians.
+
+    Within a bank x increases along a row of pixels and y from one row
+    to the next.
+    """
+
+    def __init__(self, position, pixelsize = PIXEL_SIZE):
+        self.position = position
+        self.bank = SansRunData.bankName(position.bank)
+        first, dimension = SansRunData.DETECTOR_BANKS[self.bank]
+        self.spectra = numpy.arange(first, first + dimension * dimension)
+        self.dimension = dimension
+
+        offsets = (numpy.arange(dimension) - (dimension - 1) / 2.0)
+        local_x = numpy.tile(offsets * pixelsize, dimension)
+        local_y = numpy.repeat(offsets * pixelsize, dimension)
+
+        # Rotate the bank about the vertical axis through its centre
+        angle = math.radians(position.rotation)
+        self.x = position.x + local_x * math.cos(angle)
+        self.y = position.y + local_y
+        self.z = position.z - local_x * math.sin(angle)
+        normal = numpy.array([math.sin(angle), 0.0, math.cos(angle)])
+
+        self.radius = numpy.hypot(self.x, self.y)
+        self.phi = numpy.degrees(numpy.arctan2(self.y, self.x))
+        path_z = self.z - position.sample_z
+        self.distance = numpy.sqrt(self.x ** 2 + self.y ** 2 + path_z ** 2)
+        self.twotheta = numpy.arccos(path_z / self.distance)
+        self.solidangle = (pixelsize * pixelsize *
+                           numpy.abs(normal[0] * self.x + normal[2] * path_z)
+                           / self.distance ** 3)
+
+        for table in (self.spectra, self.x, self.y, self.z, self.radius,
+                      self.phi, self.distance, self.twotheta,
+                      self.solidangle):
+            table.flags.writeable = False
+
+    def getRadiusMask(self, rmin = None, rmax = None):
+        """Return a boolean array, True for pixels outside rmin to rmax
+
+        This is the native equivalent of MaskInsideCylinder and
+        MaskOutsideCylinder about the beam centre. Radii are in metres
+        and a limit that is None or not positive is ignored.
+        """
+
+        masked = numpy.zeros(len(self.radius), dtype = bool)
+        if rmin is not None and rmin > 0.0:
+            masked |= self.radius < rmin
+        if rmax is not None and rmax > 0.0:
+            masked |= self.radius > rmax
+        return masked
+
+    def getIndices(self, spectra):
+        """Return the rows of the tables for a list of spectrum numbers"""
+
+        indices = numpy.asarray(spectra) - self.spectra[0]
+        try:
+            assert ((indices >= 0) & (indices < len(self.spectra))).all()
+        except AssertionError:
+            raise ValueError('Spectra not in the ' + self.bank + ' bank')
+        return indices
+
+_CACHE = OrderedDict()
+
+def getGeometry(position):
+    """Return the DetectorGeometry for a position, building it only once
+
+    The CACHE_SIZE most recently used tables are kept.
+    """
+
+    if position in _CACHE:
+        geometry = _CACHE.pop(position)
+    else:
+        geometry = DetectorGeometry(position)
+        logging.debug("SansGeometry: built table for " + str(position))
+    _CACHE[position] = geometry
+    while len(_CACHE) > CACHE_SIZE:
+        _CACHE.popitem(last = False)
+    return geometry
+
+def clearCache():
+    _CACHE.clear()
+
+def detectorPosition(bank, logvalues, settings = None, xbeam = None,
+                     ybeam = None):
+    """Work out where a bank sits from the detector logs of a run
+
+    logvalues is a dictionary of the DETECTOR_LOGS (as returned by
+    readDetectorLogs or _loadDetectorLogs). settings supplies the encoder
+    corrections, sample offset and beam centre set by the mask file and
+    may be a SansMaskFile.MaskSettings or a dictionary; missing values
+    are taken as zero. xbeam and ybeam, in metres, override the beam
+    centre of the settings.
+
+    The positions follow SetupComponentPositions in the reduction
+    script. The beam centre is moved to the origin.
+    """
+
+    def value(name):
+        if settings is None:
+            return 0.0
+        try:
+            found = settings.get(name)
+        except KeyError:
+            found = None
+        return float(found or 0.0)
+
+    logs = dict([(name, float(logvalues.get(name, 0.0)))
+                 for name in DETECTOR_LOGS])
+    if xbeam is None:
+        xbeam = value('XBEAM_CENTRE')
+    if ybeam is None:
+        ybeam = value('YBEAM_CENTRE')
+
+    bank = SansRunData.bankName(bank)
+    if bank == 'rear':
+        return DetectorPosition(bank, -xbeam, -ybeam,
+                          (logs['Rear_Det_Z'] + value('REAR_DET_Z_CORR'))
+                          / 1000.0, 0.0, value('SAMPLE_Z_CORR'))
+
+    rotation = logs['Front_Det_Rot'] + value('FRONT_DET_ROT_CORR')
+    radians = math.radians(rotation)
+    x = (logs['Rear_Det_X'] + value('REAR_DET_X_CORR') -
+         logs['Front_Det_X'] - value('FRONT_DET_X_CORR') +
+         FRONT_DET_RADIUS * math.sin(radians)) / 1000.0 - xbeam
+    y = value('FRONT_DET_Y_CORR') / 1000.0 - ybeam
+    z = (logs['Front_Det_Z'] + value('FRONT_DET_Z_CORR') +
+         FRONT_DET_RADIUS * (1 - math.cos(radians))) / 1000.0
+    return DetectorPosition(bank, x, y, z, -rotation, value('SAMPLE_Z_CORR'))
+
+def readDetectorLogs(filename):
+    """Read the last value of each of the DETECTOR_LOGS from a .log file
+
+    The file is read through the SansLogFile cache. Values default to
+    0.0 as in _loadDetectorLogs and values that aren't numbers are
+    passed over.
+    """
+
+    store = SansLogFile.readLogFile(filename)
+    logvalues = dict([(name, 0.0) for name in DETECTOR_LOGS])
+    for name in DETECTOR_LOGS:
+        if not store.hasChannel(name):
+            continue
+        for value in store.getChannel(name).values[::-1]:
+            try:
+                logvalues[name] = float(value)
+                break
+            except ValueError:
+                logging.debug("SansGeometry: bad log value " + name +
+                              " " + str(value))
+    return logvalues
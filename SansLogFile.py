@@ -0,0 +1,196 @@
+# SansLogFile: Reading of the sample environment (.log) files of a run
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import time
+import numpy
+from collections import namedtuple
+import SansRunIndex
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+# Log times are recorded to the second
+TIME_UNIT = 's'
+
+# The entries of one log channel in time order. times is an array of
+# datetime64 and values an array of floats, or of strings for channels
+# (such as Fast_Shutter) holding anything that isn't a number.
+LogChannel = namedtuple('LogChannel', ['name', 'times', 'values'])
+
+class LogStore(object):
+    """The sample environment logs of a run held as a column per channel
+
+    A SANS2D .log file has a line for each change of a logged value:
+
+        2010-03-09T19:37:19	Moderator_Temp	30
+
+    The file is read once into a LogChannel for each name so the value of
+    a channel over a range of times, or at a given time, is found by a
+    binary search rather than reading the file again. Times may be given
+    as datetime64, datetime or ISO 8601 strings.
+
+    self.start and self.end are the times of the first and last entries.
+    """
+
+    def __init__(self, filename, channels):
+        self.filename = filename
+        self.channels = dict([(channel.name, channel)
+                              for channel in channels])
+        times = [channel.times for channel in channels
+                 if len(channel.times)]
+        self.start = self.end = None
+        if times:
+            self.start = min([channeltimes[0] for channeltimes in times])
+            self.end = max([channeltimes[-1] for channeltimes in times])
+
+    def getChannelNames(self):
+        return sorted(self.channels)
+
+    def hasChannel(self, name):
+        return name in self.channels
+
+    def getChannel(self, name):
+        """Return the LogChannel for a name"""
+
+        try:
+            return self.channels[name]
+        except KeyError:
+            raise ValueError('No log ' + str(name) + ' in ' +
+                             str(self.filename))
+
+    def getValues(self, name, start = None, end = None):
+        """Return the (times, values) of a channel from start up to end
+
+        Entries at start are included and those at end are not. Either
+        limit may be None for the first or last entry.
+        """
+
+        channel = self.getChannel(name)
+        first, last = 0, len(channel.times)
+        if start is not None:
+            first = numpy.searchsorted(channel.times, asTime(start), 'left')
+        if end is not None:
+            last = numpy.searchsorted(channel.times, asTime(end), 'left')
+        return channel.times[first:last], channel.values[first:last]
+
+    def valueAt(self, name, when, default = None):
+        """Return the last value of a channel logged at or before a time
+
+        default is returned if the channel is missing or was first
+        logged after the time.
+        """
+
+        if name not in self.channels:
+            return default
+        channel = self.channels[name]
+        index = numpy.searchsorted(channel.times, asTime(when), 'right')
+        if index == 0:
+            return default
+        return channel.values[index - 1]
+
+    def lastValue(self, name, default = None):
+        """Return the last value logged for a channel, or default"""
+
+        channel = self.channels.get(name)
+        if channel is None or not len(channel.values):
+            return default
+        return channel.values[-1]
+
+def asTime(value):
+    """Convert a datetime, ISO 8601 string or datetime64 to datetime64"""
+
+    return numpy.datetime64(value, TIME_UNIT)
+
+# Parsed log files keyed on SansRunIndex.fileStamp
+_CACHE = {}
+
+def parseLogFile(path):
+    """Read a .log file into a LogStore
+
+    Each line is a time, a channel name and a value separated by white
+    space. The value is the rest of the line so may contain spaces.
+    Lines without all three parts or with a time that doesn't parse are
+    skipped, as _loadDetectorLogs skips them.
+    """
+
+    entries = {}
+    logfile = open(path, 'r')
+    try:
+        for line in logfile:
+            parts = line.split(None, 2)
+            if len(parts) != 3:
+                if line.strip():
+                    logging.debug("SansLogFile: skipping log line " + line)
+                continue
+            try:
+                when = asTime(parts[0])
+            except ValueError:
+                logging.debug("SansLogFile: bad log time " + line)
+                continue
+            name = intern(parts[1])
+            entries.setdefault(name, ([], []))
+            entries[name][0].append(when)
+            entries[name][1].append(parts[2].strip())
+    finally:
+        logfile.close()
+
+    channels = []
+    for name, (times, values) in entries.items():
+        times = numpy.array(times, dtype = 'datetime64[' + TIME_UNIT + ']')
+        # Keep entries logged at the same time in the order of the file
+        order = numpy.argsort(times, kind = 'mergesort')
+        try:
+            values = numpy.array([float(value) for value in values])
+        except ValueError:
+            values = numpy.array(values, dtype = object)
+        times = times[order]
+        values = values[order]
+        times.flags.writeable = False
+        values.flags.writeable = False
+        channels.append(LogChannel(name, times, values))
+
+    logging.debug("SansLogFile: parsed " + str(path))
+    return LogStore(os.path.abspath(str(path)), channels)
+
+def readLogFile(path):
+    """Return the LogStore of a .log file, parsing it only once
+
+    The file is parsed again if its modification time or size change. A
+    log modified within SansRunIndex.MTIME_RESOLUTION seconds may still
+    be being written by a running measurement and is not cached.
+    """
+
+    path = str(path)
+    if not os.path.isfile(path):
+        raise ValueError('Log file not found: ' + path)
+
+    key = SansRunIndex.fileStamp(path)
+    store = _CACHE.get(key)
+    if store is None:
+        store = parseLogFile(path)
+        for stale in [cached for cached in _CACHE if cached[0] == key[0]]:
+            del _CACHE[stale]
+        if time.time() - key[1] > SansRunIndex.MTIME_RESOLUTION:
+            _CACHE[key] = store
+    return store
+
+def clearCache():
+    _CACHE.clear()
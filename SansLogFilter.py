@@ -0,0 +1,321 @@
+# SansLogFilter: Selecting the good times of a run from its log channels
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import numbers
+import operator
+import numpy
+import SansLogFile
+
+class GoodTimes(object):
+    """A set of intervals of time, e.g. when a filter held
+
+    self.starts and self.ends are datetime64 arrays of the start and end
+    of each interval, sorted and not overlapping. Each interval includes
+    its start but not its end.
+    """
+
+    def __init__(self, starts, ends):
+        self.starts = numpy.asarray(starts, dtype = 'datetime64[' +
+                                    SansLogFile.TIME_UNIT + ']')
+        self.ends = numpy.asarray(ends, dtype = self.starts.dtype)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def mask(self, times):
+        """Return a boolean array, True for each of times that is good
+
+        This is how the good times are applied to the pulse times of
+        events, or the times of frames, before they are histogrammed.
+        """
+
+        times = numpy.asarray(times, dtype = self.starts.dtype)
+        index = numpy.searchsorted(self.starts, times, 'right') - 1
+        good = index >= 0
+        good[good] = times[good] < self.ends[index[good]]
+        return good
+
+    def duration(self, start, end):
+        """Return the seconds of good time between start and end"""
+
+        start, end = SansLogFile.asTime(start), SansLogFile.asTime(end)
+        overlap = (numpy.minimum(self.ends, end) -
+                   numpy.maximum(self.starts, start))
+        overlap = overlap.astype('timedelta64[s]').astype(numpy.int64)
+        return float(numpy.sum(numpy.maximum(overlap, 0)))
+
+    def fraction(self, start, end):
+        """Return the fraction of the time from start to end that is good"""
+
+        length = (SansLogFile.asTime(end) - SansLogFile.asTime(start))
+        length = float(length.astype('timedelta64[s]').astype(numpy.int64))
+        if length <= 0:
+            return float(self.mask([start])[0])
+        return self.duration(start, end) / length
+
+class LogFilter(object):
+    """A condition on the log channels of a run
+
+    Filters are built from LogValue comparisons and combined with &, |
+    and ~, e.g.
+
+        shutter = LogValue('Fast_Shutter') == 'OPEN'
+        temperature = LogValue('Julabo_1').between(24.5, 25.5)
+        logfilter = shutter & temperature
+
+    A channel keeps each value it logs until it logs the next, and a
+    condition is false before its channel's first entry. getTree gives
+    the filter in a form that can be saved and filterFromTree rebuilds
+    it.
+    """
+
+    def evaluate(self, store, times):
+        """Return a boolean array, whether the filter holds at each time"""
+
+        raise NotImplementedError
+
+    def getChannelNames(self):
+        """Return the set of channels the filter depends on"""
+
+        raise NotImplementedError
+
+    def getTree(self):
+        """Return the filter as nested tuples that can be saved as JSON
+
+        filterFromTree rebuilds the filter, so a filter can be kept with
+        a queued reduction job and compared between jobs. Being tuples
+        the tree can be hashed along with the job.
+        """
+
+        raise NotImplementedError
+
+    def goodTimes(self, store, start = None, end = None):
+        """Return the GoodTimes when the filter holds
+
+        The filter is evaluated, at once, at every time one of its
+        channels logs a value between start and end (by default the
+        first and last entries of the log store).
+        """
+
+        start = SansLogFile.asTime(start if start is not None
+                                   else store.start)
+        end = SansLogFile.asTime(end if end is not None else store.end)
+        changes = [numpy.array([start])]
+        for name in self.getChannelNames():
+            if store.hasChannel(name):
+                changes.append(store.getValues(name, start, end)[0])
+        times = numpy.unique(numpy.concatenate(changes))
+        good = self.evaluate(store, times)
+
+        # Intervals start where the filter becomes true and end where it
+        # becomes false again, or at end
+        edges = numpy.diff(numpy.concatenate(([0], good.astype(numpy.int8),
+                                              [0])))
+        bounds = numpy.concatenate((times, [end]))
+        return GoodTimes(bounds[numpy.nonzero(edges == 1)[0]],
+                         bounds[numpy.nonzero(edges == -1)[0]])
+
+    def __and__(self, other):
+        return _Combined(numpy.logical_and, self, other)
+
+    def __or__(self, other):
+        return _Combined(numpy.logical_or, self, other)
+
+    def __invert__(self):
+        return _Inverted(self)
+
+class LogValue(object):
+    """A log channel to be compared, giving a LogFilter
+
+    Equality works for any channel and the ordering comparisons and
+    between only for channels of numbers.
+    """
+
+    def __init__(self, name):
+        self.name = str(name)
+
+    def __eq__(self, value):
+        return _Comparison(self.name, operator.eq, value)
+
+    def __ne__(self, value):
+        return _Comparison(self.name, operator.ne, value)
+
+    def __lt__(self, value):
+        return _Comparison(self.name, operator.lt, value)
+
+    def __le__(self, value):
+        return _Comparison(self.name, operator.le, value)
+
+    def __gt__(self, value):
+        return _Comparison(self.name, operator.gt, value)
+
+    def __ge__(self, value):
+        return _Comparison(self.name, operator.ge, value)
+
+    __hash__ = object.__hash__
+
+    def between(self, low, high):
+        """A filter holding while low <= value <= high"""
+
+        return (self >= low) & (self <= high)
+
+# The comparisons of LogValue by the names used for them in filter trees
+COMPARISONS = {'==' : operator.eq, '!=' : operator.ne, '<' : operator.lt,
+               '<=' : operator.le, '>' : operator.gt, '>=' : operator.ge}
+
+def filterFromTree(tree):
+    """Rebuild a LogFilter from the nested tuples of LogFilter.getTree
+
+    A tree is one of
+
+        ('compare', name, '==', value)    (or any of COMPARISONS)
+        ('and', tree, tree)
+        ('or', tree, tree)
+        ('not', tree)
+
+    Lists, as a tree read back from JSON has, are accepted in place of
+    tuples. Raises a ValueError for anything else.
+    """
+
+    try:
+        kind = str(tree[0])
+        if kind == 'compare':
+            assert len(tree) == 4 and str(tree[2]) in COMPARISONS
+            value = tree[3]
+            if not isinstance(value, numbers.Number):
+                value = str(value)
+            return _Comparison(str(tree[1]), COMPARISONS[str(tree[2])],
+                               value)
+        if kind in ('and', 'or'):
+            assert len(tree) == 3
+            combine = {'and' : numpy.logical_and,
+                       'or' : numpy.logical_or}[kind]
+            return _Combined(combine, filterFromTree(tree[1]),
+                             filterFromTree(tree[2]))
+        assert kind == 'not' and len(tree) == 2
+        return _Inverted(filterFromTree(tree[1]))
+    except (AssertionError, IndexError, TypeError):
+        raise ValueError('Not a log filter: ' + str(tree))
+
+def checkRunTimes(rundata, logfilter, store):
+    """Check a histogram run was counted wholly within a filter's times
+
+    rundata is a SansRunData.RunData, or an opened run file, and store
+    the LogStore of the run. Histogram data can't be split by time, so
+    a run is only reduced if the filter held from the start to the end
+    of counting. Raises a ValueError if the run's times are unknown or
+    any of it is filtered out. Returns the GoodTimes over the run.
+    """
+
+    try:
+        assert rundata.start_time and rundata.end_time
+    except AssertionError:
+        raise ValueError('Run ' + str(rundata.runnumber) +
+                         ' has no start and end times to filter on')
+
+    goodtimes = logfilter.goodTimes(store, rundata.start_time,
+                                    rundata.end_time)
+    fraction = goodtimes.fraction(rundata.start_time, rundata.end_time)
+    logging.debug("SansLogFilter: run " + str(rundata.runnumber) + " " +
+                  str(100.0 * fraction) + "% good")
+    if fraction == 0.0:
+        raise ValueError('The log filter excludes all of run ' +
+                         str(rundata.runnumber))
+    if fraction < 1.0:
+        raise ValueError('The log filter excludes ' +
+                         str(round(100.0 * (1.0 - fraction), 1)) +
+                         '% of run ' + str(rundata.runnumber) +
+                         ' and histogram data cannot be split by time')
+    return goodtimes
+
+class _Comparison(LogFilter):
+
+    def __init__(self, name, compare, value):
+        self.name = name
+        self.compare = compare
+        self.value = value
+
+    def getChannelNames(self):
+        return set([self.name])
+
+    def getTree(self):
+        value = self.value
+        if isinstance(value, numpy.generic):
+            value = value.item()
+        if not isinstance(value, numbers.Number):
+            value = str(value)
+        names = dict([(compare, name) for name, compare
+                      in COMPARISONS.items()])
+        return ('compare', self.name, names[self.compare], value)
+
+    def evaluate(self, store, times):
+        good = numpy.zeros(len(times), dtype = bool)
+        if not store.hasChannel(self.name):
+            return good
+        channel = store.getChannel(self.name)
+        index = numpy.searchsorted(channel.times, times, 'right') - 1
+        logged = index >= 0
+        values = channel.values[index[logged]]
+        if self.compare in (operator.eq, operator.ne):
+            if values.dtype != object:
+                try:
+                    value = float(self.value)
+                except ValueError:
+                    # A number never equals a word
+                    good[logged] = self.compare is operator.ne
+                    return good
+            else:
+                value = str(self.value)
+        elif values.dtype == object:
+            raise ValueError('Log ' + self.name + ' is not numeric')
+        else:
+            value = float(self.value)
+        good[logged] = self.compare(values, value)
+        return good
+
+class _Combined(LogFilter):
+
+    def __init__(self, combine, first, second):
+        self.combine = combine
+        self.first = first
+        self.second = second
+
+    def getChannelNames(self):
+        return self.first.getChannelNames() | self.second.getChannelNames()
+
+    def getTree(self):
+        kind = 'and' if self.combine is numpy.logical_and else 'or'
+        return (kind, self.first.getTree(), self.second.getTree())
+
+    def evaluate(self, store, times):
+        return self.combine(self.first.evaluate(store, times),
+                            self.second.evaluate(store, times))
+
+class _Inverted(LogFilter):
+
+    def __init__(self, inverted):
+        self.inverted = inverted
+
+    def getChannelNames(self):
+        return self.inverted.getChannelNames()
+
+    def getTree(self):
+        return ('not', self.inverted.getTree())
+
+    def evaluate(self, store, times):
+        return ~self.inverted.evaluate(store, times)
@@ -0,0 +1,326 @@
+# SansMaskFile: Parsing and caching of SANS mask (user) files
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import time
+import numpy
+from collections import namedtuple
+import SansRunIndex
+import SansRunData
+
+try:
+    import ISISCommandInterface as SANSReduction
+except ImportError: #If testing outside of Mantid use the test module instead
+    import SANSReduction_for_testing_only as SANSReduction
+
+# The module globals of the reduction script that MaskFile sets, either
+# directly or through clearCurrentMaskDefaults and the functions called
+# for each line of the file
+MASKFILE_GLOBALS = ['USER_PATH', 'MASKFILE',
+                    'SPECMASKSTRING', 'SPECMASKSTRING_R', 'SPECMASKSTRING_F',
+                    'TIMEMASKSTRING', 'TIMEMASKSTRING_R', 'TIMEMASKSTRING_F',
+                    'RMIN', 'RMAX', 'DEF_RMIN', 'DEF_RMAX',
+                    'WAV1', 'WAV2', 'DWAV', 'Q_REBIN', 'QXY', 'QXY2', 'DQXY',
+                    'DQY', 'PHIMIN', 'PHIMAX', 'PHIMIRROR',
+                    'XBEAM_CENTRE', 'YBEAM_CENTRE', 'RESCALE',
+                    'SAMPLE_Z_CORR', 'SAMPLE_GEOM', 'SAMPLE_WIDTH',
+                    'SAMPLE_HEIGHT', 'SAMPLE_THICKNESS',
+                    'FRONT_DET_Z_CORR', 'FRONT_DET_Y_CORR',
+                    'FRONT_DET_X_CORR', 'FRONT_DET_ROT_CORR',
+                    'REAR_DET_Z_CORR', 'REAR_DET_X_CORR',
+                    'BACKMON_START', 'BACKMON_END', 'DETBANK', 'GRAVITY',
+                    'MONITORSPECTRUM', 'MONITORSPECLOCKED', 'SAMP_INTERPOLATE',
+                    'TRANS_UDET_MON', 'TRANS_UDET_DET', 'TRANS_INTERPOLATE',
+                    'TRANS_FIT', 'TRANS_WAV1', 'TRANS_WAV2',
+                    'DIRECT_BEAM_FILE_R', 'DIRECT_BEAM_FILE_F']
+
+class MaskSettings(namedtuple('MaskSettings', ['path', 'mtime', 'size',
+                                               'values'])):
+    """The reduction settings read from a mask file
+
+    values is a tuple of (name, value) pairs holding the value MaskFile
+    left in each of the MASKFILE_GLOBALS of the reduction script. The
+    values are strings, numbers, booleans or None so the settings can be
+    shared freely between reductions and applied in one step with
+    applyMaskSettings rather than parsing the file again.
+    """
+
+    __slots__ = ()
+
+    def get(self, name):
+        """Return the value of one of the reduction globals"""
+
+        return dict(self.values)[name]
+
+class BankMask(namedtuple('BankMask', ['bank', 'spectra', 'times'])):
+    """The compiled spectrum and time masks for one detector bank
+
+    spectra is a sorted array of the masked spectrum numbers and times an
+    (n, 2) array of the time of flight intervals masked in every
+    spectrum, sorted and merged so that no two overlap.
+    """
+
+    __slots__ = ()
+
+    def getSpectrumMask(self, spectra):
+        """Return a boolean array, True for each masked spectrum"""
+
+        return numpy.in1d(spectra, self.spectra)
+
+    def getBinMask(self, tof):
+        """Return a boolean array, True for each masked time of flight bin
+
+        tof holds the bin boundaries. As with MaskBins a bin is masked if
+        any part of it falls inside a masked interval.
+        """
+
+        tof = numpy.asarray(tof)
+        # Count the intervals starting and ending at each bin
+        starts = numpy.searchsorted(tof[1:], self.times[:, 0], 'right')
+        ends = numpy.searchsorted(tof[:-1], self.times[:, 1], 'left')
+        edges = numpy.zeros(len(tof), dtype = int)
+        numpy.add.at(edges, starts, 1)
+        numpy.add.at(edges, ends, -1)
+        return numpy.cumsum(edges)[:-1] > 0
+
+    def apply(self, counts, spectra, tof):
+        """Return a copy of counts with the masked spectra and bins zeroed
+
+        counts has a row for each of spectra and a column for each bin.
+        """
+
+        keep = numpy.logical_and.outer(~self.getSpectrumMask(spectra),
+                                       ~self.getBinMask(tof))
+        return numpy.where(keep, counts, 0)
+
+# Parsed and compiled mask files keyed on (absolute path, mtime, size)
+_CACHE = {}
+_COMPILED = {}
+
+def maskFileKey(path):
+    """Return the (absolute path, mtime, size) a mask file is cached on"""
+
+    return SansRunIndex.fileStamp(path)
+
+def parseMaskFile(path):
+    """Parse a mask file with the reduction script's own parser
+
+    MaskFile sets the reduction globals as it reads the file. They are
+    copied into a MaskSettings and then put back as they were, so
+    parsing a file leaves the state of the reduction script unchanged.
+    """
+
+    path = str(path)
+    if not os.path.isfile(path):
+        raise ValueError('Path to Maskfile is incorrect or broken!')
+
+    key = maskFileKey(path)
+    previous = _snapshot()
+    try:
+        directory, filename = os.path.split(key[0])
+        SANSReduction.UserPath(directory)
+        SANSReduction.MaskFile(filename)
+        values = _snapshot()
+    finally:
+        _setGlobals(previous)
+
+    logging.debug("SansMaskFile: parsed " + key[0])
+    return MaskSettings(key[0], key[1], key[2], values)
+
+def readMaskFile(path):
+    """Return the MaskSettings for a mask file, parsing it only once
+
+    The file is parsed again if its modification time or size has
+    changed since it was cached. A file modified within
+    SansRunIndex.MTIME_RESOLUTION seconds may still be being written and
+    is not cached.
+    """
+
+    return _cachedRead(_CACHE, path, parseMaskFile)
+
+def applyMaskSettings(settings):
+    """Set the reduction globals from a MaskSettings"""
+
+    _setGlobals(settings.values)
+
+def applyMaskFile(path):
+    """Read a mask file (from the cache if possible) and apply it
+
+    This replaces calling UserPath and MaskFile on the reduction script.
+    Returns the MaskSettings applied.
+    """
+
+    settings = readMaskFile(path)
+    applyMaskSettings(settings)
+    return settings
+
+def compileMaskLines(lines):
+    """Compile the MASK lines of a mask file into a BankMask per bank
+
+    Lines are interpreted as by the reduction script's Mask function:
+
+        MASK h0                 row 0 of every bank
+        MASK h190>h191          rows 190 to 191
+        MASK v0>v2              columns 0 to 2
+        MASK h57>h66+v134>v141  the block where the rows and columns cross
+        MASK s100>s200          spectra 100 to 200 (or just 100>200)
+        MASK/REAR h0            row 0 of the rear bank only
+        MASK/TIME 14500 16750   a time of flight interval in every bank
+        MASK/T/REAR 100 200     a time of flight interval in one bank
+        MASK/CLEAR              forget the spectrum masks so far
+        MASK/CLEAR/TIME         forget the time masks so far
+
+    Rows and columns count from zero within a bank. Other lines are
+    ignored. Returns a dictionary of bank name to BankMask.
+    """
+
+    banks = sorted(SansRunData.DETECTOR_BANKS)
+    spectra = dict([(bank, []) for bank in [None] + banks])
+    times = dict([(bank, []) for bank in [None] + banks])
+
+    for line in lines:
+        line = line.strip().upper()
+        if not line.startswith('MASK'):
+            continue
+        parts = line.split('/')
+        try:
+            if len(parts) == 1:
+                if len(line[4:].split()) == 1:
+                    spectra[None].append(line[4:].strip())
+            elif parts[1] == 'CLEAR':
+                cleared = spectra
+                if len(parts) == 3:
+                    cleared = times
+                for bank in cleared:
+                    cleared[bank] = []
+            elif len(parts) == 2 and parts[1].startswith('T'):
+                times[None].append(_timeInterval(parts[1].split()[1:]))
+            elif len(parts) == 2 and len(parts[1].split()) == 2:
+                detector, detail = parts[1].split()
+                spectra[SansRunData.bankName(detector)].append(detail)
+            elif len(parts) == 3 and parts[1] in ('TIME', 'T'):
+                detail = parts[2].split()
+                times[SansRunData.bankName(detail[0])].append(
+                                                 _timeInterval(detail[1:]))
+            else:
+                raise ValueError('Unrecognised masking option')
+        except (ValueError, IndexError) as error:
+            logging.debug("SansMaskFile: ignoring mask line " + line +
+                          ": " + str(error))
+
+    compiled = {}
+    for bank in banks:
+        masked = [_expandSpectra(detail, bank)
+                  for detail in spectra[None] + spectra[bank]]
+        compiled[bank] = BankMask(bank,
+                            numpy.unique(numpy.concatenate(masked + [[]]))
+                                                           .astype(int),
+                            _mergeIntervals(times[None] + times[bank]))
+    return compiled
+
+def compileMaskFile(path):
+    """Return compileMaskLines for a mask file, cached as readMaskFile"""
+
+    return _cachedRead(_COMPILED, path, _compileFile)
+
+def clearCache():
+    _CACHE.clear()
+    _COMPILED.clear()
+
+def _cachedRead(cache, path, parse):
+    """Return parse(path) from the cache, parsing the file if it changed"""
+
+    path = str(path)
+    if not os.path.isfile(path):
+        raise ValueError('Path to Maskfile is incorrect or broken!')
+
+    key = maskFileKey(path)
+    value = cache.get(key)
+    if value is None:
+        value = parse(path)
+        for stale in [cached for cached in cache if cached[0] == key[0]]:
+            del cache[stale]
+        if time.time() - key[1] > SansRunIndex.MTIME_RESOLUTION:
+            cache[key] = value
+    return value
+
+def _compileFile(path):
+    maskfile = open(path, 'r')
+    try:
+        return compileMaskLines([line for line in maskfile
+                                 if not line.startswith('!')])
+    finally:
+        maskfile.close()
+
+def _expandSpectra(detail, bank):
+    """Return the spectrum numbers for a comma separated mask detail"""
+
+    first, dimension = SansRunData.DETECTOR_BANKS[bank]
+    masked = []
+    for item in detail.split(','):
+        if not item:
+            continue
+        rows = numpy.arange(dimension)
+        columns = numpy.arange(dimension)
+        for part in item.split('+'):
+            if part[0] == 'H':
+                rows = _range(part)
+            elif part[0] == 'V':
+                columns = _range(part)
+            elif len(item.split('+')) == 1:
+                low, high = _range(part)[[0, -1]]
+                masked.append(numpy.arange(low, high + 1))
+                break
+            else:
+                raise ValueError('Cannot combine ' + item)
+        else:
+            masked.append((first + dimension * rows[:, numpy.newaxis] +
+                           columns).ravel())
+    return numpy.concatenate(masked + [[]])
+
+def _range(part):
+    """Convert 'H10' or 'H10>H20' to an array of the numbers covered"""
+
+    limits = [int(limit.lstrip('HVS')) for limit in part.split('>')]
+    return numpy.arange(limits[0], limits[-1] + 1)
+
+def _timeInterval(words):
+    start, end = [float(word) for word in words]
+    return min(start, end), max(start, end)
+
+def _mergeIntervals(intervals):
+    """Sort intervals and merge those that overlap or touch"""
+
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return numpy.array(merged, dtype = numpy.float64).reshape(-1, 2)
+
+def _snapshot():
+    """Return the current values of the MASKFILE_GLOBALS as a tuple"""
+
+    return tuple([(name, getattr(SANSReduction, name))
+                  for name in MASKFILE_GLOBALS
+                  if hasattr(SANSReduction, name)])
+
+def _setGlobals(values):
+    for name, value in values:
+        setattr(SANSReduction, name, value)
@@ -0,0 +1,57 @@
+# SansNISTFile: Writing of 2D I(Qx, Qy) in the NIST DAT format without Mantid
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import numpy
+import SansRKHFile
+
+# The header and the format of each row, one per Qx and Qy bin, as
+# written by SaveNISTDAT
+HEADER = ('Data columns Qx - Qy - I(Qx,Qy) - err(I)\n'
+          'ASCII data\n')
+ROW_FORMAT = '%.6E %.6E %.6E %.6E\n'
+
+def writeNISTFile(path, qx, qy, intensity, errors):
+    """Write a 2D I(Qx, Qy) image as NIST DAT text
+
+    qx and qy are the bin boundaries along each axis and intensity and
+    errors have a row for each Qx bin and a column for each Qy bin, as
+    in a SansQBinning.Q2DResult. Each row of the file gives the centre
+    of a bin, its intensity and error.
+    """
+
+    qx = numpy.asarray(qx, dtype = numpy.float64)
+    qy = numpy.asarray(qy, dtype = numpy.float64)
+    intensity = numpy.asarray(intensity, dtype = numpy.float64)
+    try:
+        assert intensity.shape == (len(qx) - 1, len(qy) - 1)
+        assert numpy.shape(errors) == intensity.shape
+    except AssertionError:
+        raise ValueError('Intensity and errors do not match the Q bins')
+
+    xcentres, ycentres = numpy.meshgrid(0.5 * (qx[1:] + qx[:-1]),
+                                        0.5 * (qy[1:] + qy[:-1]),
+                                        indexing = 'ij')
+    rows = numpy.column_stack((xcentres.ravel(), ycentres.ravel(),
+                               intensity.ravel(), numpy.ravel(errors)))
+    nistfile = open(path, 'w')
+    try:
+        nistfile.write(HEADER)
+        nistfile.writelines(SansRKHFile.formatRows(ROW_FORMAT, rows))
+    finally:
+        nistfile.close()
+    logging.debug("SansNISTFile: wrote " + str(path))
@@ -0,0 +1,477 @@
+# SansNativeReduction: 1D reduction of SANS2D runs without Mantid
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import math
+import os
+import numpy
+import SansRunData
+import SansMaskFile
+import SansGeometry
+import SansQBinning
+import SansTransmission
+import SansRKHFile
+import SansLogFile
+import SansLogFilter
+
+# Distance in metres from the moderator to the nominal sample position of
+# SANS2D, as in the instrument definition
+SAMPLE_DISTANCE = 19.281
+
+class WavelengthData(object):
+    """A run masked, converted to wavelength and ready to bin in Q
+
+    self.counts and self.variances have one row per pixel and one column
+    per wavelength bin, with self.wavelengths the bin boundaries.
+    self.normalisation, of the same shape, is what the counts are
+    divided by: the incident monitor, transmission and efficiency in
+    each wavelength bin times the solid angle of each pixel, times the
+    sample volume over the RESCALE factor. self.mask is True for each
+    pixel left out and self.spectrummask for those left out by the mask
+    file alone, without the RMIN and RMAX limits. self.indices gives the
+    row of self.geometry for each pixel.
+
+    For a multi-period run the rows hold the pixels of self.periods
+    periods one after another (see preparePeriods).
+    """
+
+    def __init__(self, wavelengths, counts, variances, normalisation,
+                 geometry, indices, mask, spectrummask = None, periods = 1):
+        self.wavelengths = wavelengths
+        self.counts = counts
+        self.variances = variances
+        self.normalisation = normalisation
+        self.geometry = geometry
+        self.indices = indices
+        self.mask = mask
+        if spectrummask is None:
+            spectrummask = numpy.zeros(len(indices), dtype = bool)
+        self.spectrummask = spectrummask
+        self.periods = periods
+
+    def getBins(self, wavlow, wavhigh):
+        """Return the slice of wavelength bins with centres in a range"""
+
+        centres = SansQBinning.wavelengthCentres(self.wavelengths)
+        inside = numpy.nonzero((centres >= wavlow - 1e-9) &
+                               (centres <= wavhigh + 1e-9))[0]
+        if len(inside) == 0:
+            raise ValueError('No wavelength bins between ' + str(wavlow) +
+                             ' and ' + str(wavhigh))
+        return slice(inside[0], inside[-1] + 1)
+
+    def reduce(self, qbins, wavlow = None, wavhigh = None, gravity = False):
+        """Bin the wavelengths from wavlow to wavhigh into I(Q)
+
+        Returns a SansQBinning.Q1DResult. With several periods the
+        intensity, errors and normalisation have a row for each period,
+        all binned in one pass.
+        """
+
+        if wavlow is None:
+            wavlow = self.wavelengths[0]
+        if wavhigh is None:
+            wavhigh = self.wavelengths[-1]
+        bins = self.getBins(wavlow, wavhigh)
+        wavelengths = self.wavelengths[bins.start:bins.stop + 1]
+        if self.periods > 1:
+            groups = numpy.repeat(numpy.arange(self.periods),
+                                  len(self.indices) // self.periods)
+            return SansQBinning.q1dGroups(self.counts[:, bins], wavelengths,
+                                self.geometry, qbins,
+                                numpy.where(self.mask, -1, groups),
+                                numpy.sqrt(self.variances[:, bins]),
+                                self.normalisation[:, bins], gravity,
+                                self.geometry.spectra[self.indices])
+        return SansQBinning.q1d(self.counts[:, bins], wavelengths,
+                                self.geometry, qbins,
+                                numpy.sqrt(self.variances[:, bins]),
+                                self.normalisation[:, bins], gravity,
+                                self.geometry.spectra[self.indices],
+                                self.mask)
+
+    def reduce2D(self, maxqxy, dqxy, wavlow = None, wavhigh = None,
+                 gravity = False):
+        """Bin the wavelengths from wavlow to wavhigh into I(Qx, Qy)
+
+        The image runs from -maxqxy to maxqxy in steps of dqxy on both
+        axes (see SansQBinning.qxy). Returns a SansQBinning.Q2DResult.
+        With several periods the intensity, errors and normalisation
+        have an image for each period.
+        """
+
+        if wavlow is None:
+            wavlow = self.wavelengths[0]
+        if wavhigh is None:
+            wavhigh = self.wavelengths[-1]
+        bins = self.getBins(wavlow, wavhigh)
+        wavelengths = self.wavelengths[bins.start:bins.stop + 1]
+        results = []
+        for rows in numpy.array_split(numpy.arange(len(self.indices)),
+                                      self.periods):
+            results.append(SansQBinning.qxy(self.counts[rows, bins],
+                                wavelengths, self.geometry, maxqxy, dqxy,
+                                numpy.sqrt(self.variances[rows, bins]),
+                                self.normalisation[rows, bins], gravity,
+                                self.geometry.spectra[self.indices[rows]],
+                                self.mask[rows]))
+        if len(results) == 1:
+            return results[0]
+        return SansQBinning.Q2DResult(results[0].qx, results[0].qy,
+                    numpy.array([result.intensity for result in results]),
+                    numpy.array([result.errors for result in results]),
+                    numpy.array([result.normalisation
+                                 for result in results]))
+
+def convertToWavelength(counts, tof, flightpaths, wavelengths):
+    """Rebin the time of flight spectra of many pixels onto wavelength
+
+    counts has one row per pixel on the shared tof bin boundaries and
+    flightpaths the distance in metres from the moderator to each pixel.
+    This does ConvertUnits and Rebin for every pixel at once: the
+    cumulative counts of each row are interpolated at the time of
+    flight of each wavelength boundary for that pixel, sharing counts
+    between bins in proportion to their overlap.
+    """
+
+    counts = numpy.asarray(counts, dtype = numpy.float64)
+    tof = numpy.asarray(tof, dtype = numpy.float64)
+    cumulative = numpy.zeros((counts.shape[0], counts.shape[1] + 1))
+    numpy.cumsum(counts, axis = 1, out = cumulative[:, 1:])
+
+    targets = (numpy.outer(flightpaths, wavelengths) /
+               SansTransmission.TOF_TO_WAVELENGTH)
+    index = numpy.clip(numpy.searchsorted(tof, targets) - 1, 0,
+                       len(tof) - 2)
+    fraction = numpy.clip((targets - tof[index]) /
+                          (tof[index + 1] - tof[index]), 0.0, 1.0)
+    rows = numpy.arange(counts.shape[0])[:, numpy.newaxis]
+    low = cumulative[rows, index]
+    values = low + fraction * (cumulative[rows, index + 1] - low)
+    return numpy.diff(values, axis = 1)
+
+def flightPaths(geometry, indices = None):
+    """Return the distance from the moderator to each pixel in metres"""
+
+    if indices is None:
+        indices = slice(None)
+    return (SAMPLE_DISTANCE + geometry.position.sample_z +
+            geometry.distance[indices])
+
+def sampleVolume(sample):
+    """Return the volume of a sample as ScaleByVolume works it out
+
+    sample is the dictionary of RunData.sample. Geometry 1 is a cylinder
+    lying across the beam, 2 a flat plate and 3 a disc facing the beam.
+    """
+
+    width = sample['width']
+    if sample['geometry'] == 1:
+        return sample['height'] * math.pi * width ** 2 / 4.0
+    if sample['geometry'] == 2:
+        return width * sample['height'] * sample['thickness']
+    return sample['thickness'] * math.pi * width ** 2 / 4.0
+
+def prepareRun(rundata, geometry, wavelengths, settings, bankmask = None,
+               transmission = None, efficiency = None):
+    """Mask a run, convert it to wavelength and work out its normalisation
+
+    This does the steps of Correct that come before Q1D. rundata holds
+    the pixels of one bank and the incident beam monitor, settings is a
+    SansMaskFile.MaskSettings and bankmask the SansMaskFile.BankMask for
+    the bank. transmission and efficiency, if given, are arrays with a
+    value for each wavelength bin. Returns a WavelengthData.
+    """
+
+    return preparePeriods([rundata], geometry, wavelengths, settings,
+                          bankmask, transmission, efficiency)
+
+def preparePeriods(periods, geometry, wavelengths, settings,
+                   bankmask = None, transmission = None, efficiency = None):
+    """Prepare the periods of a run together, as prepareRun does one
+
+    periods is a list of RunData for the periods of one run, holding the
+    same spectra. Their pixels are stacked period after period so every
+    period is masked and converted to wavelength in one pass, and each
+    is normalised by its own monitor. The geometry, mask, transmission
+    and efficiency are shared. Returns a WavelengthData with
+    self.periods set to the number of periods.
+    """
+
+    first = periods[0]
+    nperiods = len(periods)
+    spectra = numpy.tile(first.spectra, nperiods)
+    indices = geometry.getIndices(spectra)
+    counts = first.counts
+    if nperiods > 1:
+        counts = numpy.concatenate([rundata.counts for rundata in periods])
+    spectrummask = numpy.zeros(len(indices), dtype = bool)
+    if bankmask is not None:
+        counts = bankmask.apply(counts, spectra, first.tof)
+        spectrummask = bankmask.getSpectrumMask(spectra)
+    mask = spectrummask | geometry.getRadiusMask(settings.get('RMIN'),
+                                                 settings.get('RMAX'))[indices]
+
+    flightpaths = flightPaths(geometry, indices)
+    converted = convertToWavelength(counts, first.tof, flightpaths,
+                                    wavelengths)
+    variances = numpy.abs(converted)
+
+    spectrum = settings.get('MONITORSPECTRUM')
+    background = _backgroundRange(settings)
+    distance = SansTransmission.monitorDistance(first, spectrum)
+    incident = []
+    for rundata in periods:
+        monitor = rundata.getSpectrum(spectrum)
+        if background is not None:
+            monitor = SansTransmission.removeFlatBackground(monitor,
+                                                rundata.tof, *background)
+        incident.append(SansTransmission.rebinToWavelength(monitor,
+                                     rundata.tof, distance, wavelengths))
+    incident = numpy.array(incident)
+    if transmission is not None:
+        incident = incident * transmission
+    if efficiency is not None:
+        incident = incident * efficiency
+
+    # Each row of the normalisation is the pixel's solid angle times the
+    # incident beam of its period
+    scale = sampleVolume(first.sample) / float(settings.get('RESCALE'))
+    solidangle = geometry.solidangle[indices] * scale
+    normalisation = (solidangle.reshape(nperiods, -1, 1) *
+                     incident[:, numpy.newaxis, :]).reshape(len(indices), -1)
+    return WavelengthData(wavelengths, converted, variances, normalisation,
+                          geometry, indices, mask, spectrummask, nperiods)
+
+def subtractResults(sample, can):
+    """Subtract a can I(Q) from a sample I(Q) on the same Q bins
+
+    A sample with a row for each period has the can taken from each row.
+    Two SansQBinning.Q2DResult images on the same Qx and Qy bins are
+    subtracted in the same way.
+    """
+
+    if isinstance(sample, SansQBinning.Q2DResult):
+        try:
+            assert numpy.array_equal(sample.qx, can.qx)
+            assert numpy.array_equal(sample.qy, can.qy)
+        except AssertionError:
+            raise ValueError('Sample and can are not on the same Q bins')
+        return SansQBinning.Q2DResult(sample.qx, sample.qy,
+                                      sample.intensity - can.intensity,
+                                      numpy.hypot(sample.errors, can.errors),
+                                      sample.normalisation)
+
+    try:
+        assert numpy.array_equal(sample.q, can.q)
+    except AssertionError:
+        raise ValueError('Sample and can are not on the same Q bins')
+    return SansQBinning.Q1DResult(sample.q,
+                                  sample.intensity - can.intensity,
+                                  numpy.hypot(sample.errors, can.errors),
+                                  sample.normalisation)
+
+class SliceReduction(object):
+    """A sample minus can reduction shared between wavelength slices
+
+    WavRangeReduction loads, masks, converts and normalises the sample
+    and can again for every wavelength range it is asked for. Here that
+    is done once, by prepare, over wavlow to wavhigh on the DWAV bins of
+    the mask file. Each slice is then just a Q1D over the wavelength
+    bins it covers, so
+
+        reduction = SliceReduction(sansfile, transfile, canfile,
+                                   cantransfile, directfile, maskfile,
+                                   2.0, 14.0)
+        results = reduction.reduceSlices([(2, 4), (4, 8), (8, 14)])
+
+    gives one SansQBinning.Q1DResult per slice. Slices should start and
+    end on bin boundaries; each takes the bins whose centres lie within
+    it. Transmissions are fitted once over the full range through the
+    transmission cache. reduce2D bins a slice to I(Qx, Qy) instead.
+
+    The detector position is read from logfile, by default the .log file
+    next to the sample run. gravity defaults to the GRAVITY setting of
+    the mask file. efficiencyfile is the RKH file the bank's efficiency
+    is divided out with, by default the DIRECT_BEAM_FILE_R (or _F) of
+    the mask file; False leaves the efficiency uncorrected. logfilter,
+    a SansLogFilter.LogFilter, is checked against the sample run and its
+    log (see SansLogFilter.checkRunTimes) before the run is used.
+    period, transperiod, canperiod and cantransperiod select the period
+    of each run to use; only that period is read from multi-period runs.
+    period may also be a list of sample periods, or None for all of
+    them, which are reduced together to one I(Q) per period with the
+    can subtracted from each.
+
+    Once prepared, self.sample and self.can hold the WavelengthData of
+    the two runs, self.settings the MaskSettings and self.logvalues the
+    detector logs.
+    """
+
+    def __init__(self, sansfile, transfile, canfile, cantransfile,
+                 directfile, maskfile, wavlow, wavhigh, gravity = None,
+                 detector = 'rear', logfile = None, cache = None,
+                 efficiencyfile = None, logfilter = None, period = 1,
+                 transperiod = 1, canperiod = 1, cantransperiod = 1):
+        self.sansfile = str(sansfile)
+        self.transfile = str(transfile)
+        self.canfile = str(canfile)
+        self.cantransfile = str(cantransfile)
+        self.directfile = str(directfile)
+        self.maskfile = str(maskfile)
+        self.wavlow = float(wavlow)
+        self.wavhigh = float(wavhigh)
+        self.gravity = gravity
+        self.bank = SansRunData.bankName(detector)
+        if logfile is None:
+            logfile = os.path.splitext(self.sansfile)[0] + '.log'
+        self.logfile = str(logfile)
+        self.cache = cache
+        self.efficiencyfile = efficiencyfile
+        self.logfilter = logfilter
+        if period is not None:
+            if isinstance(period, (list, tuple)):
+                period = [int(number) for number in period]
+            else:
+                period = [int(period)]
+        self.periods = (period, int(transperiod), [int(canperiod)],
+                        int(cantransperiod))
+        self.settings = None
+        self.logvalues = None
+        self.sample = None
+        self.can = None
+
+    def prepare(self):
+        """Do the work shared by every slice, once"""
+
+        if self.sample is not None:
+            return
+        if not os.path.isfile(self.logfile):
+            raise ValueError('Detector log not found: ' + self.logfile)
+        if self.logfilter is not None:
+            SansLogFilter.checkRunTimes(
+                                  SansRunData.openRunFile(self.sansfile),
+                                  self.logfilter,
+                                  SansLogFile.readLogFile(self.logfile))
+
+        settings = SansMaskFile.readMaskFile(self.maskfile)
+        if self.gravity is None:
+            self.gravity = bool(settings.get('GRAVITY'))
+        self.qbins = SansQBinning.rebinBoundaries(settings.get('Q_REBIN'))
+        binning = (self.wavlow, settings.get('DWAV'), self.wavhigh)
+        wavelengths = SansQBinning.rebinBoundaries(binning)
+
+        self.settings = settings
+        self.logvalues = SansGeometry.readDetectorLogs(self.logfile)
+        position = SansGeometry.detectorPosition(self.bank, self.logvalues,
+                                                 settings)
+        geometry = SansGeometry.getGeometry(position)
+        bankmask = SansMaskFile.compileMaskFile(self.maskfile)[self.bank]
+        spectra = SansRunData.bankSpectra(self.bank)
+        efficiency = None
+        efficiencyfile = self.getEfficiencyFile(settings)
+        if efficiencyfile:
+            efficiency = SansRKHFile.efficiencyCorrection(efficiencyfile,
+                                                          wavelengths)[0]
+
+        prepared = []
+        for runfile, transfile, periods, transperiod in (
+                (self.sansfile, self.transfile) + self.periods[:2],
+                (self.canfile, self.cantransfile) + self.periods[2:]):
+            transmission = SansTransmission.calculateTransmission(
+                                transfile, self.directfile, binning,
+                                settings.get('TRANS_FIT'),
+                                settings.get('TRANS_WAV1'),
+                                settings.get('TRANS_WAV2'),
+                                settings.get('TRANS_UDET_MON'),
+                                settings.get('TRANS_UDET_DET'),
+                                _backgroundRange(settings), self.cache,
+                                transperiod)
+            rundata = SansRunData.loadRunPeriods(runfile, spectra[0],
+                                spectra[-1], periods,
+                                monitors = [settings.get('MONITORSPECTRUM')])
+            prepared.append(preparePeriods(rundata, geometry, wavelengths,
+                                           settings, bankmask,
+                                           transmission.transmission,
+                                           efficiency))
+        self.sample, self.can = prepared
+        logging.debug("SansNativeReduction: prepared " + self.sansfile +
+                      " from " + str(self.wavlow) + " to " +
+                      str(self.wavhigh))
+
+    def getEfficiencyFile(self, settings):
+        """Return the efficiency file to use, or None for no correction"""
+
+        if self.efficiencyfile is False:
+            return None
+        efficiencyfile = self.efficiencyfile
+        if efficiencyfile is None:
+            if self.bank == 'rear':
+                efficiencyfile = settings.get('DIRECT_BEAM_FILE_R')
+            else:
+                efficiencyfile = settings.get('DIRECT_BEAM_FILE_F')
+        if efficiencyfile is None:
+            return None
+        if not os.path.isfile(efficiencyfile):
+            raise ValueError('Efficiency file not found: ' + efficiencyfile)
+        return str(efficiencyfile)
+
+    def reduce(self, wavlow = None, wavhigh = None):
+        """Return the can subtracted I(Q) for one wavelength slice
+
+        If several sample periods were asked for the intensity and
+        errors have a row for each.
+        """
+
+        self.prepare()
+        return subtractResults(
+                    self.sample.reduce(self.qbins, wavlow, wavhigh,
+                                       self.gravity),
+                    self.can.reduce(self.qbins, wavlow, wavhigh,
+                                    self.gravity))
+
+    def reduce2D(self, wavlow = None, wavhigh = None):
+        """Return the can subtracted I(Qx, Qy) for one wavelength slice
+
+        This is the 2D reduction of WavRangeReduction after Set2D. The
+        limits of the image are the QXY2 and DQXY values set by the
+        L/QXY line of the mask file. Returns a SansQBinning.Q2DResult.
+        """
+
+        self.prepare()
+        maxqxy = self.settings.get('QXY2')
+        dqxy = self.settings.get('DQXY')
+        try:
+            assert maxqxy is not None and dqxy is not None
+        except AssertionError:
+            raise ValueError('No L/QXY limits in ' + self.maskfile)
+        return subtractResults(
+                    self.sample.reduce2D(maxqxy, dqxy, wavlow, wavhigh,
+                                         self.gravity),
+                    self.can.reduce2D(maxqxy, dqxy, wavlow, wavhigh,
+                                      self.gravity))
+
+    def reduceSlices(self, slices):
+        """Return the I(Q) for each of a list of (wavlow, wavhigh)"""
+
+        return [self.reduce(wavlow, wavhigh) for wavlow, wavhigh in slices]
+
+def _backgroundRange(settings):
+    if (settings.get('BACKMON_START') is None or
+            settings.get('BACKMON_END') is None):
+        return None
+    return (settings.get('BACKMON_START'), settings.get('BACKMON_END'))
@@ -0,0 +1,331 @@
+# SansNexusFile: A lazily sliced reader for ISIS NeXus files
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import numpy
+import SansRunData
+
+# h5py is only needed when NeXus files are read natively
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+ENTRY = 'raw_data_1'
+DETECTOR = 'detector_1'
+
+class NexusFile(object):
+    """An ISIS NeXus (HDF5) file read without Mantid
+
+    Creating the object reads only the small run, sample and spectrum
+    index datasets. Counts are read on request as a hyperslab of the
+    detector counts dataset covering just the requested period and
+    spectra, so for a rear detector reduction only the chunks holding
+    the rear detector are read and decompressed and the front detector
+    is never touched. Where the counts are stored contiguously without
+    compression the file is memory mapped instead and the slice copied
+    straight out of the page cache.
+
+    Monitors are stored in their own groups and are read separately.
+    """
+
+    def __init__(self, filename):
+        if h5py is None:
+            raise ImportError('h5py is required to read NeXus files')
+        self.filename = str(filename)
+        nexusfile = h5py.File(self.filename, 'r')
+        try:
+            self.readHeader(nexusfile[ENTRY])
+        finally:
+            nexusfile.close()
+
+    def readHeader(self, entry):
+        """Read the run details and spectrum layout from the entry"""
+
+        self.runnumber = str(_scalar(entry['run_number']))
+        self.title = _string(entry['title'])
+        self.instrument = _string(entry['instrument/name'])
+        self.good_frames = int(_scalar(entry['good_frames']))
+        self.proton_charge = float(_scalar(entry['proton_charge']))
+        self.start_time = self.end_time = ''
+        if 'start_time' in entry:
+            self.start_time = _string(entry['start_time'])
+        if 'end_time' in entry:
+            self.end_time = _string(entry['end_time'])
+        if 'periods/number' in entry:
+            self.nperiods = int(_scalar(entry['periods/number']))
+        else:
+            self.nperiods = 1
+
+        sample = entry['sample']
+        self.sample = {'geometry' : SansRunData.geometryFlag(
+                                                _string(sample['shape'])),
+                       'thickness' : float(_scalar(sample['thickness'])),
+                       'height' : float(_scalar(sample['height'])),
+                       'width' : float(_scalar(sample['width']))}
+
+        # Transmission runs may only hold monitors and no detector group
+        self.detector_spectra = numpy.zeros(0, dtype = int)
+        self.counts_shape = None
+        self.counts_dtype = numpy.dtype(numpy.int32)
+        self.counts_offset = None
+        if DETECTOR in entry:
+            detector = entry[DETECTOR]
+            tof = detector['time_of_flight']
+            self.detector_spectra = numpy.asarray(
+                               detector['spectrum_index'][...], dtype = int)
+
+            # Offset of the counts if they can be memory mapped
+            counts = detector['counts']
+            self.counts_shape = counts.shape
+            self.counts_dtype = counts.dtype
+            if counts.chunks is None and counts.compression is None:
+                self.counts_offset = counts.id.get_offset()
+        else:
+            tof = entry['instrument/dae/time_channels_1/time_of_flight']
+        self.tof = numpy.asarray(tof[...], dtype = numpy.float64)
+        self.nchannels = len(self.tof) - 1
+
+        # Map monitor spectrum numbers to their groups
+        self.monitor_groups = {}
+        self.monitor_distances = {}
+        for name in entry:
+            if name.startswith('monitor_'):
+                spectrum = int(_scalar(entry[name]['spectrum_index']))
+                self.monitor_groups[spectrum] = name
+                if 'distance' in entry[name]:
+                    self.monitor_distances[spectrum] = float(
+                                         _scalar(entry[name]['distance']))
+        self.monitor_spectra = sorted(self.monitor_groups)
+
+        self.nspectra = int(max(self.detector_spectra.tolist() +
+                                self.monitor_spectra))
+
+    def readDetector(self, first, last, period = 1):
+        """Return the counts for detector rows first to last inclusive"""
+
+        if self.counts_offset is not None:
+            counts = numpy.memmap(self.filename, dtype = self.counts_dtype,
+                                  mode = 'r', offset = self.counts_offset,
+                                  shape = self.counts_shape)
+            rows = numpy.array(counts[period - 1, first:last + 1])
+            del counts
+            return rows
+
+        nexusfile = h5py.File(self.filename, 'r')
+        try:
+            return nexusfile[ENTRY][DETECTOR]['counts'][period - 1,
+                                                        first:last + 1, :]
+        finally:
+            nexusfile.close()
+
+    def readMonitors(self, spectra, period = 1):
+        """Return a dictionary of monitor spectrum numbers to counts"""
+
+        monitors = {}
+        if not spectra:
+            return monitors
+        nexusfile = h5py.File(self.filename, 'r')
+        try:
+            for spectrum in spectra:
+                if spectrum not in self.monitor_groups:
+                    raise ValueError('Spectrum ' + str(spectrum) +
+                                     ' is not a monitor in ' + self.filename)
+                data = nexusfile[ENTRY][self.monitor_groups[spectrum]]['data']
+                monitors[spectrum] = data[period - 1, 0, :]
+        finally:
+            nexusfile.close()
+        return monitors
+
+    def load(self, spec_min = None, spec_max = None, period = 1,
+             monitors = None):
+        """Load a period of the run into a SansRunData.RunData
+
+        Arguments are as for SansRawFile.RawFile.load. Monitor spectra
+        falling inside the spectrum range are included in the counts as
+        LoadNexus would do.
+        """
+
+        spec_min, spec_max = SansRunData.normaliseSpectrumRange(
+                                         spec_min, spec_max, self.nspectra)
+        try:
+            assert 1 <= int(period) <= self.nperiods
+        except AssertionError:
+            raise ValueError('Period ' + str(period) + ' not in ' +
+                             self.filename)
+        period = int(period)
+
+        spectra = numpy.arange(spec_min, spec_max + 1)
+        counts = numpy.zeros((len(spectra), self.nchannels),
+                             dtype = self.counts_dtype)
+        filled = numpy.zeros(len(spectra), dtype = bool)
+
+        inrange = [spectrum for spectrum in self.monitor_spectra
+                   if spec_min <= spectrum <= spec_max]
+        for spectrum, data in self.readMonitors(inrange, period).items():
+            counts[spectrum - spec_min] = data
+            filled[spectrum - spec_min] = True
+
+        # The detector spectra are stored in order so the range maps to a
+        # single slice of rows
+        rows = numpy.flatnonzero((self.detector_spectra >= spec_min) &
+                                 (self.detector_spectra <= spec_max))
+        if len(rows):
+            first, last = int(rows[0]), int(rows[-1])
+            positions = self.detector_spectra[first:last + 1] - spec_min
+            counts[positions] = self.readDetector(first, last, period)
+            filled[positions] = True
+
+        if not filled.all():
+            raise ValueError('Spectra ' + str(spectra[~filled].tolist()) +
+                             ' not found in ' + self.filename)
+
+        extra = sorted(set(monitors or []) - set(spectra.tolist()))
+        monitorcounts = self.readMonitors(extra, period)
+
+        logging.debug("SansNexusFile: read spectra " + str(spec_min) + '-' +
+                      str(spec_max) + " from " + self.filename)
+        return SansRunData.RunData(filename = self.filename,
+                                   tof = self.tof.copy(),
+                                   counts = counts, spectra = spectra,
+                                   monitors = monitorcounts,
+                                   period = period,
+                                   nperiods = self.nperiods,
+                                   runnumber = self.runnumber,
+                                   title = self.title,
+                                   instrument = self.instrument,
+                                   good_frames = self.good_frames,
+                                   proton_charge = self.proton_charge,
+                                   sample = dict(self.sample),
+                                   monitor_spectra = self.monitor_spectra,
+                                   monitor_distances = self.monitor_distances,
+                                   start_time = self.start_time,
+                                   end_time = self.end_time)
+
+def loadNexus(filename, spec_min = None, spec_max = None, period = 1,
+              monitors = None):
+    """Convenience function mirroring LoadNexus for a single period"""
+
+    return NexusFile(filename).load(spec_min, spec_max, period, monitors)
+
+def saveRunData(rundata, filename):
+    """Write a SansRunData.RunData out as an ISIS style NeXus file
+
+    Only the parts of the ISIS layout read by NexusFile are written:
+    the run details, sample, detector counts with their spectrum index
+    and time of flight boundaries, and a group for each monitor. Counts
+    are written gzip compressed in chunks of eight spectra as the DAE
+    does so files can be sliced efficiently when read back.
+
+    rundata may also be a list of RunData, one for each period of a
+    multi-period run, with the same spectra and time of flight bins.
+    The run details are taken from the first, with the frames and charge
+    summed over the periods.
+    """
+
+    if h5py is None:
+        raise ImportError('h5py is required to write NeXus files')
+
+    periods = rundata
+    if not isinstance(periods, (list, tuple)):
+        periods = [periods]
+    rundata = periods[0]
+
+    monitorrows = {}
+    for spectrum in rundata.monitor_spectra:
+        if (spectrum in rundata.monitors or
+                spectrum in rundata.spectra):
+            monitorrows[spectrum] = numpy.array([period.getSpectrum(spectrum)
+                                                 for period in periods])
+    detector = numpy.array([spectrum not in monitorrows
+                            for spectrum in rundata.spectra], dtype = bool)
+
+    counts = numpy.array([numpy.asarray(period.counts)
+                          for period in periods])
+    if counts.size and counts.max() <= numpy.iinfo(numpy.int32).max:
+        counts = counts.astype(numpy.int32)
+    good_frames = sum([period.good_frames for period in periods])
+    proton_charge = sum([period.proton_charge for period in periods])
+
+    nexusfile = h5py.File(str(filename), 'w')
+    try:
+        entry = nexusfile.create_group(ENTRY)
+        entry.attrs['NX_class'] = 'NXentry'
+        entry['run_number'] = numpy.array([int(rundata.runnumber or 0)],
+                                          dtype = numpy.int32)
+        entry['title'] = numpy.array([str(rundata.title)])
+        entry['good_frames'] = numpy.array([good_frames],
+                                           dtype = numpy.int32)
+        entry['proton_charge'] = numpy.array([proton_charge],
+                                             dtype = numpy.float32)
+        entry['instrument/name'] = numpy.array([str(rundata.instrument)])
+        for name in ['start_time', 'end_time']:
+            if getattr(rundata, name):
+                entry[name] = numpy.array([str(getattr(rundata, name))])
+        entry['periods/number'] = numpy.array([len(periods)],
+                                              dtype = numpy.int32)
+        tof = numpy.asarray(rundata.tof, dtype = numpy.float32)
+        entry['instrument/dae/time_channels_1/time_of_flight'] = tof
+
+        shapes = dict([(flag, name.title()) for name, flag in
+                       SansRunData.SAMPLE_GEOMETRIES.items()])
+        sample = entry.create_group('sample')
+        sample['shape'] = numpy.array([shapes.get(
+                                  rundata.sample['geometry'], 'Unknown')])
+        for name in ['thickness', 'height', 'width']:
+            sample[name] = numpy.array([rundata.sample[name]],
+                                       dtype = numpy.float32)
+
+        if detector.any():
+            group = entry.create_group(DETECTOR)
+            group.attrs['NX_class'] = 'NXdetector'
+            data = counts[:, detector]
+            group.create_dataset('counts', data = data, compression = 'gzip',
+                                 chunks = (1, min(8, data.shape[1]),
+                                           data.shape[2]))
+            group['spectrum_index'] = numpy.asarray(
+                           rundata.spectra, dtype = numpy.int32)[detector]
+            group['time_of_flight'] = tof
+
+        for number, spectrum in enumerate(sorted(monitorrows)):
+            group = entry.create_group('monitor_' + str(number + 1))
+            group.attrs['NX_class'] = 'NXmonitor'
+            group['data'] = numpy.asarray(monitorrows[spectrum],
+                                     dtype = counts.dtype).reshape(
+                                                 len(periods), 1, -1)
+            group['spectrum_index'] = numpy.array([spectrum],
+                                                  dtype = numpy.int32)
+            group['monitor_number'] = numpy.array([number + 1],
+                                                  dtype = numpy.int32)
+            if spectrum in rundata.monitor_distances:
+                group['distance'] = numpy.array(
+                                   [rundata.monitor_distances[spectrum]],
+                                   dtype = numpy.float32)
+    finally:
+        nexusfile.close()
+    logging.debug("SansNexusFile: wrote " + str(filename))
+
+def _scalar(dataset):
+    """Return the first value of a (usually length one) dataset"""
+
+    return numpy.asarray(dataset[...]).ravel()[0]
+
+def _string(dataset):
+    value = _scalar(dataset)
+    if isinstance(value, bytes):
+        value = value.decode('latin-1')
+    return str(value).strip()
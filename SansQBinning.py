@@ -0,0 +1,307 @@
+# SansQBinning: Conversion of wavelength binned SANS data to I(Q)
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import numpy
+from collections import namedtuple
+
+# Drop of a neutron under gravity in metres per (metre of flight path)^2
+# per (Angstrom of wavelength)^2, g * m_n^2 / (2 * h^2)
+GRAVITY_DROP = (9.80665 * 1.674927e-27 ** 2 /
+                (2 * 6.62606896e-34 ** 2) * 1e-20)
+
+# The result of a reduction to I(Q). q holds the bin boundaries and
+# intensity and errors one value per bin. normalisation is the sum of the
+# normalisation over each bin (or None if none was given).
+Q1DResult = namedtuple('Q1DResult', ['q', 'intensity', 'errors',
+                                     'normalisation'])
+
+# The result of a reduction to I(Qx, Qy). qx and qy hold the bin
+# boundaries and intensity, errors and normalisation have a row for each
+# Qx bin and a column for each Qy bin.
+Q2DResult = namedtuple('Q2DResult', ['qx', 'qy', 'intensity', 'errors',
+                                     'normalisation'])
+
+def rebinBoundaries(params):
+    """Build bin boundaries from Mantid style rebin parameters
+
+    params is a sequence, or a comma separated string as held in Q_REBIN,
+    of the form x0, step, x1, step, x2 ... A positive step gives linear
+    bins of that width and a negative step logarithmic bins each wider
+    than the last by that fraction, so '.0034, .0006, 0.01, -0.06, 0.33'
+    gives linear bins to 0.01 and 6% bins from there to 0.33. Three
+    values with a single step are also accepted. As in Mantid the last
+    bin of each range is shortened to end at the limit, or merged with
+    the bin before if it would be less than a quarter of a step wide.
+    """
+
+    if isinstance(params, str):
+        params = [value for value in params.split(',') if value.strip()]
+    params = [float(value) for value in params]
+    try:
+        assert len(params) >= 3 and len(params) % 2 == 1
+    except AssertionError:
+        raise ValueError('Rebin parameters need x0, step, x1 [, step, x2]')
+
+    boundaries = [params[0]]
+    for index in range(1, len(params), 2):
+        step, end = params[index], params[index + 1]
+        try:
+            assert step != 0 and end > boundaries[-1]
+            assert step > 0 or boundaries[-1] > 0
+        except AssertionError:
+            raise ValueError('Bad rebin parameters ' + str(params))
+        current = boundaries[-1]
+        first = len(boundaries)
+        while True:
+            if step > 0:
+                width = step
+            else:
+                width = current * -step
+            if current + width >= end:
+                break
+            current += width
+            boundaries.append(current)
+        if len(boundaries) > first and end - boundaries[-1] < 0.25 * width:
+            boundaries[-1] = end
+        else:
+            boundaries.append(end)
+    return numpy.array(boundaries)
+
+def wavelengthCentres(wavelengths):
+    """Return the centres of a set of wavelength bin boundaries"""
+
+    wavelengths = numpy.asarray(wavelengths, dtype = numpy.float64)
+    return 0.5 * (wavelengths[1:] + wavelengths[:-1])
+
+def calculateQ(geometry, wavelengths, gravity = False, indices = None):
+    """Return Q for each pixel and wavelength bin
+
+    geometry is a SansGeometry.DetectorGeometry and wavelengths the bin
+    boundaries in Angstroms. The result has a row for each pixel (or for
+    each of indices if given) and a column for each wavelength bin, in
+    inverse Angstroms.
+
+    With gravity the drop of the neutrons between the sample and each
+    pixel is worked out at each wavelength and the pixel treated as
+    that much higher when the scattering angle is calculated, as Q1D
+    does with AccountForGravity.
+    """
+
+    if indices is None:
+        indices = slice(None)
+    centres = wavelengthCentres(wavelengths)
+
+    if not gravity:
+        sintheta = numpy.sin(geometry.twotheta[indices] / 2)
+        return 4 * math.pi * numpy.outer(sintheta, 1 / centres)
+
+    x = geometry.x[indices][:, numpy.newaxis]
+    z = geometry.z[indices][:, numpy.newaxis] - geometry.position.sample_z
+    flightpath = geometry.distance[indices][:, numpy.newaxis]
+    y = (geometry.y[indices][:, numpy.newaxis] +
+         GRAVITY_DROP * flightpath ** 2 * centres ** 2)
+    costwotheta = z / numpy.sqrt(x ** 2 + y ** 2 + z ** 2)
+    # sin(theta) from cos(2 theta) avoids an arccos per element
+    sintheta = numpy.sqrt(numpy.clip((1 - costwotheta) / 2, 0.0, 1.0))
+    return 4 * math.pi * sintheta / centres
+
+def calculateQxy(geometry, wavelengths, gravity = False, indices = None):
+    """Return Qx and Qy for each pixel and wavelength bin
+
+    Arguments are as for calculateQ. Q is split into its components
+    along x and y according to the direction of each pixel from the beam
+    axis, after lifting it for gravity if requested.
+    """
+
+    if indices is None:
+        indices = slice(None)
+    centres = wavelengthCentres(wavelengths)
+
+    x = geometry.x[indices][:, numpy.newaxis]
+    y = geometry.y[indices][:, numpy.newaxis]
+    if gravity:
+        flightpath = geometry.distance[indices][:, numpy.newaxis]
+        y = y + GRAVITY_DROP * flightpath ** 2 * centres ** 2
+    z = geometry.z[indices][:, numpy.newaxis] - geometry.position.sample_z
+    costwotheta = z / numpy.sqrt(x ** 2 + y ** 2 + z ** 2)
+    q = (4 * math.pi * numpy.sqrt(numpy.clip((1 - costwotheta) / 2,
+                                             0.0, 1.0)) / centres)
+
+    radius = numpy.hypot(x, y)
+    radius = numpy.where(radius > 0, radius, numpy.inf)
+    return q * x / radius, q * y / radius
+
+def qxyBoundaries(maxqxy, dqxy):
+    """Return the bin boundaries along Qx and Qy used by Qxy
+
+    Bins run from -maxqxy to maxqxy in steps of dqxy, the QXY2 and DQXY
+    values set by the L/QXY line of a mask file.
+    """
+
+    return rebinBoundaries([-maxqxy, dqxy, maxqxy])
+
+def q1d(counts, wavelengths, geometry, qbins, errors = None,
+        normalisation = None, gravity = False, spectra = None,
+        mask = None):
+    """Reduce wavelength binned counts to I(Q)
+
+    counts has one row per pixel and one column per wavelength bin, with
+    wavelengths the bin boundaries in Angstroms. The rows are the pixels
+    of geometry in spectrum order unless spectra lists the spectrum
+    number of each row. qbins is an array of Q bin boundaries or rebin
+    parameters such as the Q_REBIN string of a mask file.
+
+    errors default to the square root of the counts. normalisation, if
+    given, is an array that broadcasts against counts (for instance the
+    monitor in each wavelength bin times the solid angle of each pixel)
+    and the intensity in each Q bin is the sum of the counts divided by
+    the sum of the normalisation, otherwise it is the sum of the counts.
+    Errors are summed in quadrature. mask is a boolean array, True for
+    each row to leave out. Empty bins are returned as zero.
+
+    Every pixel and wavelength is binned at once with numpy.bincount.
+    """
+
+    counts, errors, indices = _prepare(counts, errors, geometry, spectra)
+    if not isinstance(qbins, numpy.ndarray):
+        qbins = rebinBoundaries(qbins)
+
+    q = calculateQ(geometry, wavelengths, gravity, indices)
+    _checkShape(q, counts)
+
+    nbins = len(qbins) - 1
+    bins = numpy.searchsorted(qbins, q, 'right') - 1
+    use = _usable(bins, nbins, mask)
+    intensity, errors, summed = _accumulate(bins[use], nbins, use, counts,
+                                            errors, normalisation)
+    return Q1DResult(qbins, intensity, errors, summed)
+
+def q1dGroups(counts, wavelengths, geometry, qbins, groups, errors = None,
+              normalisation = None, gravity = False, spectra = None):
+    """Reduce wavelength binned counts to one I(Q) per group of pixels
+
+    groups gives a group number (0, 1, 2 ...) for each row of counts, or
+    a negative number to leave the row out. Other arguments are as for
+    q1d. Every group is binned in the same numpy.bincount pass by
+    offsetting the Q bin index of each group. Returns a Q1DResult whose
+    intensity, errors and normalisation have a row for each group.
+    """
+
+    counts, errors, indices = _prepare(counts, errors, geometry, spectra)
+    if not isinstance(qbins, numpy.ndarray):
+        qbins = rebinBoundaries(qbins)
+    groups = numpy.asarray(groups, dtype = int)
+    ngroups = max(groups.max() + 1, 1) if len(groups) else 1
+
+    q = calculateQ(geometry, wavelengths, gravity, indices)
+    _checkShape(q, counts)
+
+    nbins = len(qbins) - 1
+    bins = numpy.searchsorted(qbins, q, 'right') - 1
+    use = _usable(bins, nbins, groups < 0)
+    bins = (groups[:, numpy.newaxis] * nbins + bins)[use]
+    intensity, errors, summed = _accumulate(bins, ngroups * nbins, use,
+                                            counts, errors, normalisation)
+    shape = (ngroups, nbins)
+    if summed is not None:
+        summed = summed.reshape(shape)
+    return Q1DResult(qbins, intensity.reshape(shape),
+                     errors.reshape(shape), summed)
+
+def qxy(counts, wavelengths, geometry, maxqxy, dqxy, errors = None,
+        normalisation = None, gravity = False, spectra = None,
+        mask = None):
+    """Reduce wavelength binned counts to a 2D I(Qx, Qy) image
+
+    This is the native equivalent of Qxy(input, output, QXY2, DQXY).
+    Other arguments are as for q1d. Every pixel and wavelength bin is
+    placed in the image at once, histogram2d style, by flattening the
+    pair of Qx and Qy bins into a single index for numpy.bincount.
+    """
+
+    counts, errors, indices = _prepare(counts, errors, geometry, spectra)
+    qbins = qxyBoundaries(maxqxy, dqxy)
+    nbins = len(qbins) - 1
+
+    qx, qy = calculateQxy(geometry, wavelengths, gravity, indices)
+    _checkShape(qx, counts)
+
+    xbins = numpy.searchsorted(qbins, qx, 'right') - 1
+    ybins = numpy.searchsorted(qbins, qy, 'right') - 1
+    use = (_usable(xbins, nbins, mask) & (ybins >= 0) & (ybins < nbins))
+    bins = xbins[use] * nbins + ybins[use]
+    intensity, errors, summed = _accumulate(bins, nbins * nbins, use,
+                                            counts, errors, normalisation)
+    shape = (nbins, nbins)
+    if summed is not None:
+        summed = summed.reshape(shape)
+    return Q2DResult(qbins, qbins.copy(), intensity.reshape(shape),
+                     errors.reshape(shape), summed)
+
+def _prepare(counts, errors, geometry, spectra):
+    """Return counts and errors as float arrays and the geometry rows"""
+
+    counts = numpy.asarray(counts, dtype = numpy.float64)
+    if errors is None:
+        errors = numpy.sqrt(numpy.abs(counts))
+    else:
+        errors = numpy.asarray(errors, dtype = numpy.float64)
+    indices = None
+    if spectra is not None:
+        indices = geometry.getIndices(spectra)
+    return counts, errors, indices
+
+def _checkShape(q, counts):
+    try:
+        assert q.shape == counts.shape
+    except AssertionError:
+        raise ValueError('Counts do not match the pixels and wavelengths')
+
+def _usable(bins, nbins, mask):
+    """Return True for each element falling in a bin and not masked"""
+
+    use = (bins >= 0) & (bins < nbins)
+    if mask is not None:
+        use &= ~numpy.asarray(mask, dtype = bool)[:, numpy.newaxis]
+    return use
+
+def _accumulate(bins, nbins, use, counts, errors, normalisation):
+    """Sum counts, errors in quadrature and normalisation into bins
+
+    Returns the intensity, errors and summed normalisation (None if no
+    normalisation was given) of each bin.
+    """
+
+    try:
+        assert errors.shape == counts.shape
+    except AssertionError:
+        raise ValueError('Errors do not match the counts')
+
+    intensity = numpy.bincount(bins, counts[use], nbins)
+    variance = numpy.bincount(bins, errors[use] ** 2, nbins)
+    summed = None
+    if normalisation is not None:
+        normalisation = numpy.broadcast_to(numpy.asarray(normalisation,
+                                                  dtype = numpy.float64),
+                                           counts.shape)
+        summed = numpy.bincount(bins, normalisation[use], nbins)
+        filled = summed > 0
+        divisor = numpy.where(filled, summed, 1.0)
+        intensity = numpy.where(filled, intensity / divisor, 0.0)
+        variance = numpy.where(filled, variance / divisor ** 2, 0.0)
+    return intensity, numpy.sqrt(variance), summed
@@ -0,0 +1,178 @@
+# SansRKHFile: Reading of RKH (COLETTE) format files without Mantid
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import numpy
+from collections import namedtuple, OrderedDict
+import SansRunIndex
+
+# Number of interpolated corrections kept. Each reduction needs one per
+# efficiency file and wavelength binning.
+CACHE_SIZE = 32
+
+# The header lines after the title and the format of each row of a 1D
+# RKH file, as written by SaveRKH
+HEADER_FORMAT = (' \n'
+                 '%5d    0    0    0    1%5d    0\n'
+                 '         0         0         0         0\n'
+                 ' 3 (F12.5,2E16.6)\n')
+ROW_FORMAT = '%12.5f%16.6E%16.6E\n'
+
+# The native writers (here, in SansCanSASFile and SansNISTFile) stream
+# their rows with formatRows: CHUNK_ROWS rows at a time are formatted
+# in a single string operation and handed to writelines, so a file is
+# never built up in memory as a whole nor written value by value.
+CHUNK_ROWS = 4096
+
+# The 1D data of an RKH file: a column of x values (wavelength for the
+# direct beam efficiency files) with a y value and error for each
+RKHData = namedtuple('RKHData', ['title', 'x', 'y', 'errors'])
+
+# Parsed files keyed on SansRunIndex.fileStamp and interpolated
+# corrections keyed on the file stamp and the wavelength binning
+_CACHE = {}
+_CORRECTIONS = OrderedDict()
+
+def parseRKHFile(path):
+    """Read the 1D data from an RKH file
+
+    The files start with five header lines, e.g.
+
+         Wed 25-Nov-2009 17:04  ...             title
+                                                (blank)
+          147    0    0    0    1  147    0     number of points first
+             0         0         0         0
+         3 (F12.5,2E16.6)                       format of the rows
+
+    followed by one row of x, y and error per point.
+    """
+
+    rkhfile = open(path, 'r')
+    try:
+        lines = rkhfile.read().splitlines()
+    finally:
+        rkhfile.close()
+
+    try:
+        assert len(lines) > 5
+        npoints = int(lines[2].split()[0])
+        rows = [[float(value) for value in line.split()[:3]]
+                for line in lines[5:5 + npoints]]
+        data = numpy.array(rows, dtype = numpy.float64)
+        assert data.shape == (npoints, 3)
+    except (AssertionError, IndexError, ValueError):
+        raise ValueError('Not a 1D RKH file: ' + str(path))
+
+    logging.debug("SansRKHFile: parsed " + str(path))
+    return RKHData(lines[0].strip(), data[:, 0], data[:, 1], data[:, 2])
+
+def formatRows(rowformat, rows):
+    """Yield the rows of a 2D array formatted CHUNK_ROWS at a time
+
+    rowformat is the % format of one row, with a conversion for each
+    column of rows.
+    """
+
+    for start in range(0, len(rows), CHUNK_ROWS):
+        block = rows[start:start + CHUNK_ROWS]
+        yield (rowformat * len(block)) % tuple(block.ravel().tolist())
+
+def writeRKHFile(path, x, y, errors, title = ''):
+    """Write 1D data to an RKH file in the layout parseRKHFile reads"""
+
+    x = numpy.asarray(x, dtype = numpy.float64).ravel()
+    columns = [x, numpy.ravel(y), numpy.ravel(errors)]
+    try:
+        assert all([len(column) == len(x) for column in columns])
+    except AssertionError:
+        raise ValueError('x, y and errors must be the same length')
+    rows = numpy.column_stack(columns)
+
+    rkhfile = open(path, 'w')
+    try:
+        rkhfile.write(' ' + str(title) + '\n' +
+                      HEADER_FORMAT % (len(x), len(x)))
+        rkhfile.writelines(formatRows(ROW_FORMAT, rows))
+    finally:
+        rkhfile.close()
+    logging.debug("SansRKHFile: wrote " + str(path))
+
+def readRKHFile(path):
+    """Return the RKHData of a file, parsing it only once
+
+    The file is parsed again if its modification time or size change.
+    """
+
+    path = str(path)
+    if not os.path.isfile(path):
+        raise ValueError('RKH file not found: ' + path)
+
+    key = SansRunIndex.fileStamp(path)
+    data = _CACHE.get(key)
+    if data is None:
+        data = parseRKHFile(path)
+        for stale in [cached for cached in _CACHE if cached[0] == key[0]]:
+            del _CACHE[stale]
+        _CACHE[key] = data
+    return data
+
+def efficiencyCorrection(path, wavelengths):
+    """Return the correction from an efficiency file for wavelength bins
+
+    wavelengths holds the bin boundaries. As in CorrectToFile the factor
+    and its error for each bin are interpolated linearly at the bin
+    centre, taking the first or last point outside the range of the
+    file. Returns (factors, errors), cached for the CACHE_SIZE most
+    recently used files and binnings. The arrays are read only.
+    """
+
+    wavelengths = numpy.asarray(wavelengths, dtype = numpy.float64)
+    key = (SansRunIndex.fileStamp(path), wavelengths.tobytes())
+    if key in _CORRECTIONS:
+        correction = _CORRECTIONS.pop(key)
+    else:
+        data = readRKHFile(path)
+        centres = 0.5 * (wavelengths[1:] + wavelengths[:-1])
+        correction = (numpy.interp(centres, data.x, data.y),
+                      numpy.interp(centres, data.x, data.errors))
+        for values in correction:
+            values.flags.writeable = False
+    _CORRECTIONS[key] = correction
+    while len(_CORRECTIONS) > CACHE_SIZE:
+        _CORRECTIONS.popitem(last = False)
+    return correction
+
+def correctToFile(values, errors, wavelengths, path):
+    """Divide wavelength binned values by the correction in an RKH file
+
+    This is the native equivalent of CorrectToFile(..., 'Wavelength',
+    'Divide'). values and errors have a column for each wavelength bin
+    (and any number of rows). Errors are combined in quadrature.
+    Returns the corrected (values, errors).
+    """
+
+    factors, factorerrors = efficiencyCorrection(path, wavelengths)
+    values = numpy.asarray(values, dtype = numpy.float64)
+    errors = numpy.asarray(errors, dtype = numpy.float64)
+    corrected = values / factors
+    return corrected, numpy.hypot(errors / factors,
+                                  corrected * factorerrors / factors)
+
+def clearCache():
+    _CACHE.clear()
+    _CORRECTIONS.clear()
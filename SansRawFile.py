@@ -0,0 +1,359 @@
+# SansRawFile: A NumPy reader for ISIS RAW files
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import datetime
+import numpy
+import SansRunData
+
+# Data compression types given by d_comp in the data section header
+COMPRESSION_NONE = 0
+COMPRESSION_BYTE_RELATIVE = 1
+
+# A byte of this value in byte relative data flags that the next four
+# bytes hold an absolute value rather than a difference
+BYTE_RELATIVE_ESCAPE = -128
+
+# Positions (in 32 bit words) of fields within the fixed header and the
+# parameter blocks of each section
+_FORMAT_VERSION = 20
+_ADDRESSES = 21
+_RUN_NUMBER = 32
+_TITLE = 33
+_START = 13
+_RPB = 93
+_RPB_GOOD_CHARGE = 7
+_RPB_GOOD_FRAMES = 9
+_RPB_END = 16
+_SPB_GEOMETRY = 2
+_SPB_THICKNESS = 3
+_SPB_HEIGHT = 4
+_SPB_WIDTH = 5
+_IVPB_L1 = 22
+_DAEP_DELAY = 23
+
+class RawFile(object):
+    """An ISIS RAW file read without Mantid
+
+    Creating the object reads the header sections (run, instrument,
+    sample environment, DAE and time channel boundaries). Counts are
+    only read when asked for and only for the spectra requested; for
+    compressed files the data section descriptors are used to seek
+    straight to the first requested spectrum so decoding the rear
+    detector of a SANS2D run never touches the front detector data.
+
+    The layout follows the ISISRAW classes used by LoadRaw. Real values
+    in the header blocks are stored as VAX F floats.
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        rawfile = open(self.filename, 'rb')
+        try:
+            self.readHeader(rawfile)
+        finally:
+            rawfile.close()
+
+    def readHeader(self, rawfile):
+        """Read the header sections of the file"""
+
+        header = _readWords(rawfile, 0, _RPB + 32)
+        self.format_version = int(header[_FORMAT_VERSION])
+        addresses = [int(word) - 1 for word in
+                     header[_ADDRESSES:_ADDRESSES + 9]]
+        (self.ad_run, self.ad_inst, self.ad_se, self.ad_dae, self.ad_tcb,
+         self.ad_user, self.ad_data, self.ad_log, self.ad_end) = addresses
+
+        self.runnumber = str(int(header[_RUN_NUMBER]))
+        self.title = header[_TITLE:_TITLE + 20].tostring().decode(
+                                                     'latin-1').strip()
+        rpb = header[_RPB:_RPB + 32]
+        self.proton_charge = float(vaxToFloat(rpb[_RPB_GOOD_CHARGE]))
+        self.good_frames = int(rpb[_RPB_GOOD_FRAMES])
+        self.start_time = _isoTime(header[_START:_START + 5])
+        self.end_time = _isoTime(rpb[_RPB_END:_RPB_END + 5])
+
+        # Instrument section: name, parameters then the detector tables
+        instrument = _readWords(rawfile, self.ad_inst, 70)
+        self.instrument = instrument[1:3].tostring().decode(
+                                                     'latin-1').strip()
+        ndet, nmon, nuse = [int(word) for word in instrument[67:70]]
+        self.l1 = float(vaxToFloat(instrument[3 + _IVPB_L1]))
+        tables = _readWords(rawfile, self.ad_inst + 70, 2 * nmon + 5 * ndet)
+        self.mdet = tables[:nmon]
+        self.spec = tables[2 * nmon:2 * nmon + ndet]
+        self.monitor_spectra = [int(self.spec[det - 1]) for det in self.mdet]
+
+        # For monitors the secondary flight path table holds the distance
+        # from the moderator
+        len2 = vaxToFloat(tables[2 * nmon + 2 * ndet:2 * nmon + 3 * ndet])
+        self.monitor_distances = dict([(int(self.spec[det - 1]),
+                                        float(len2[det - 1]))
+                                       for det in self.mdet])
+
+        # Sample environment section: sample geometry and size
+        spb = _readWords(rawfile, self.ad_se + 1, 64)
+        self.sample = {'geometry' : int(spb[_SPB_GEOMETRY]),
+                       'thickness' : float(vaxToFloat(spb[_SPB_THICKNESS])),
+                       'height' : float(vaxToFloat(spb[_SPB_HEIGHT])),
+                       'width' : float(vaxToFloat(spb[_SPB_WIDTH]))}
+
+        daep = _readWords(rawfile, self.ad_dae + 1, 64)
+
+        # Time channel section: periods, spectra and time channels
+        tcb = _readWords(rawfile, self.ad_tcb, 288)
+        self.nperiods = int(tcb[3])
+        self.nspectra = int(tcb[260])
+        self.nchannels = int(tcb[261])
+        prescale = int(tcb[287])
+        boundaries = _readWords(rawfile, self.ad_tcb + 288,
+                                self.nchannels + 1)
+        self.tof = boundaries * (prescale * 0.03125)
+        if self.format_version > 1:
+            self.tof += 4.0 * int(daep[_DAEP_DELAY])
+
+        # Data section header
+        dhdr = _readWords(rawfile, self.ad_data + 1, 32)
+        self.compression = int(dhdr[0])
+        self.descriptor_offset = int(dhdr[2])
+
+    def readSpectra(self, spectra, period = 1):
+        """Return the counts for a list of spectrum numbers
+
+        The result is an array with one row per spectrum and one column
+        per time channel. Spectrum numbers should be in increasing order
+        and are read in a single pass over the part of the file spanning
+        them.
+        """
+
+        spectra = numpy.asarray(spectra, dtype = int)
+        try:
+            assert 1 <= int(period) <= self.nperiods
+        except AssertionError:
+            raise ValueError('Period ' + str(period) + ' not in ' +
+                             self.filename)
+        if len(spectra) == 0:
+            return numpy.zeros((0, self.nchannels), dtype = numpy.int32)
+
+        # Spectrum 0 of each period is a dummy and the stored spectra
+        # have one more value than there are time channels
+        indices = (int(period) - 1) * (self.nspectra + 1) + spectra
+        nvalues = self.nchannels + 1
+        rawfile = open(self.filename, 'rb')
+        try:
+            if self.compression == COMPRESSION_NONE:
+                first = self.ad_data + 33 + indices[0] * nvalues
+                last = self.ad_data + 33 + (indices[-1] + 1) * nvalues
+                block = _readWords(rawfile, first, last - first)
+                rows = (indices - indices[0])[:, None] * nvalues
+                values = block[rows + numpy.arange(nvalues)]
+
+            elif self.compression == COMPRESSION_BYTE_RELATIVE:
+                descriptors = _readWords(rawfile, self.ad_data +
+                                         self.descriptor_offset +
+                                         2 * int(indices[0]),
+                                         2 * int(indices[-1] -
+                                                 indices[0] + 1))
+                descriptors = descriptors.reshape(-1, 2)[
+                                                indices - indices[0]]
+                lengths = descriptors[:, 0].astype(numpy.int64) * 4
+                starts = (self.ad_data + descriptors[:, 1].astype(
+                                                       numpy.int64)) * 4
+                first = int(starts.min())
+                rawfile.seek(first)
+                block = numpy.frombuffer(rawfile.read(
+                                     int((starts + lengths).max()) - first),
+                                         dtype = numpy.int8)
+                values = decompressByteRelative(block, starts - first,
+                                                lengths, nvalues)
+            else:
+                raise IOError('Unknown compression type ' +
+                              str(self.compression) + ' in ' + self.filename)
+        finally:
+            rawfile.close()
+
+        return numpy.ascontiguousarray(values[:, 1:], dtype = numpy.int32)
+
+    def load(self, spec_min = None, spec_max = None, period = 1,
+             monitors = None):
+        """Load a period of the run into a SansRunData.RunData
+
+        spec_min and spec_max follow the LoadRaw SpectrumMin and
+        SpectrumMax properties. monitors is an optional list of spectrum
+        numbers read separately from the range, which lets the incident
+        beam monitor be picked up without decoding everything in between.
+        """
+
+        spec_min, spec_max = SansRunData.normaliseSpectrumRange(
+                                         spec_min, spec_max, self.nspectra)
+        spectra = numpy.arange(spec_min, spec_max + 1)
+        counts = self.readSpectra(spectra, period)
+
+        monitorcounts = {}
+        extra = sorted(set(monitors or []) - set(spectra.tolist()))
+        if extra:
+            SansRunData.normaliseSpectrumRange(extra[0], extra[-1],
+                                               self.nspectra)
+            for spectrum, row in zip(extra,
+                                     self.readSpectra(extra, period)):
+                monitorcounts[spectrum] = row
+
+        logging.debug("SansRawFile: read spectra " + str(spec_min) + '-' +
+                      str(spec_max) + " from " + self.filename)
+        return SansRunData.RunData(filename = self.filename,
+                                   tof = self.tof.astype(numpy.float64),
+                                   counts = counts, spectra = spectra,
+                                   monitors = monitorcounts,
+                                   period = int(period),
+                                   nperiods = self.nperiods,
+                                   runnumber = self.runnumber,
+                                   title = self.title,
+                                   instrument = self.instrument,
+                                   good_frames = self.good_frames,
+                                   proton_charge = self.proton_charge,
+                                   sample = dict(self.sample),
+                                   monitor_spectra = self.monitor_spectra,
+                                   monitor_distances = self.monitor_distances,
+                                   start_time = self.start_time,
+                                   end_time = self.end_time)
+
+def loadRaw(filename, spec_min = None, spec_max = None, period = 1,
+            monitors = None):
+    """Convenience function mirroring LoadRaw for a single period"""
+
+    return RawFile(filename).load(spec_min, spec_max, period, monitors)
+
+def vaxToFloat(words):
+    """Convert VAX F floats stored as 32 bit integers to floats
+
+    A VAX F float is an IEEE single with its two 16 bit halves swapped
+    and an exponent bias larger by two.
+    """
+
+    words = numpy.asarray(words, dtype = numpy.int32).view(numpy.uint32)
+    swapped = ((words & 0xffff) << 16) | (words >> 16)
+    return swapped.astype(numpy.uint32).view(numpy.float32) / 4.0
+
+def decompressByteRelative(block, starts, lengths, nvalues):
+    """Decode byte relative compressed spectra
+
+    block is an int8 array holding the compressed data, starts and
+    lengths give the byte range of each spectrum within it and nvalues
+    is the number of values stored for each spectrum. Each value is
+    stored either as a signed byte difference from the previous value or,
+    after an escape byte of -128, as an absolute little-endian 32 bit
+    integer. The first value is relative to zero.
+
+    The decoding is done for all spectra at once with NumPy rather than
+    byte by byte: escape bytes are identified, the payload bytes that
+    follow them are dropped and the values rebuilt with a cumulative sum
+    that restarts at every absolute value. Returns an array with one row
+    per spectrum.
+    """
+
+    starts = numpy.asarray(starts, dtype = numpy.int64)
+    lengths = numpy.asarray(lengths, dtype = numpy.int64)
+    nspectra = len(starts)
+    total = int(lengths.sum())
+
+    # Gather the bytes of every spectrum into one array, padded so that
+    # an escape at the very end can be read safely
+    segstarts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    segment = numpy.repeat(numpy.arange(nspectra), lengths)
+    position = (numpy.arange(total) - segstarts[segment] +
+                starts[segment])
+    data = numpy.concatenate((block[position],
+                              numpy.zeros(4, dtype = numpy.int8)))
+
+    # -128 can also appear inside the payload of an absolute value so a
+    # candidate is only an escape if no escape precedes it within four
+    # bytes in the same spectrum. Iterate to the fixed point, each pass
+    # settles at least one more candidate in every run of candidates.
+    candidates = numpy.flatnonzero(data[:total] == BYTE_RELATIVE_ESCAPE)
+    escape = numpy.ones(len(candidates), dtype = bool)
+    for n in range(len(candidates) + 1):
+        blocked = numpy.zeros(len(candidates), dtype = bool)
+        for back in range(1, 5):
+            later = numpy.arange(back, len(candidates))
+            earlier = later - back
+            near = ((candidates[later] - candidates[earlier] <= 4) &
+                    (segment[candidates[later]] ==
+                     segment[candidates[earlier]]))
+            blocked[later] |= near & escape[earlier]
+        if numpy.array_equal(~blocked, escape):
+            break
+        escape = ~blocked
+    escapes = candidates[escape]
+
+    # Every byte that is not part of an absolute value starts a value.
+    # Padding at the end of a spectrum can hold a stray escape so payloads
+    # are not allowed to run into the next spectrum.
+    payload = numpy.zeros(total + 4, dtype = bool)
+    segment = numpy.concatenate((segment, [-1] * 4))
+    for offset in range(1, 5):
+        inside = segment[escapes + offset] == segment[escapes]
+        payload[escapes[inside] + offset] = True
+    token = ~payload[:total]
+    tokencount = numpy.cumsum(token)
+    before = numpy.concatenate(([0], tokencount))[segstarts]
+    segment = segment[:total]
+    rank = tokencount - 1 - before[segment]
+    keep = token & (rank < nvalues)
+    if numpy.any(numpy.bincount(segment[keep], minlength = nspectra)
+                 != nvalues):
+        raise IOError('Corrupt compressed spectrum data')
+
+    tokens = numpy.flatnonzero(keep)
+    isescape = numpy.zeros(total, dtype = bool)
+    isescape[escapes] = True
+    tokenescape = isescape[tokens]
+
+    raw = data.view(numpy.uint8).astype(numpy.uint32)
+    absolute = (raw[tokens + 1] | (raw[tokens + 2] << 8) |
+                (raw[tokens + 3] << 16) | (raw[tokens + 4] << 24))
+    absolute = absolute.astype(numpy.uint32).view(numpy.int32)
+    base = numpy.where(tokenescape, absolute, 0).astype(numpy.int64)
+    delta = numpy.where(tokenescape, 0, data[tokens]).astype(numpy.int64)
+
+    # Values restart at each absolute value and at each spectrum start
+    restart = tokenescape.copy()
+    restart[::nvalues] = True
+    index = numpy.arange(len(tokens))
+    last = numpy.maximum.accumulate(numpy.where(restart, index, 0))
+    running = numpy.cumsum(delta)
+    values = base[last] + running - running[last] + delta[last]
+    return values.reshape(nspectra, nvalues)
+
+def _isoTime(words):
+    """Convert a '09-MAR-2010 19:39:44' header field to ISO 8601"""
+
+    text = words.tostring().decode('latin-1').strip()
+    try:
+        return datetime.datetime.strptime(text.title(),
+                                 '%d-%b-%Y %H:%M:%S').isoformat()
+    except ValueError:
+        logging.debug("SansRawFile: bad header time " + text)
+        return ''
+
+def _readWords(rawfile, offset, count):
+    """Read count little-endian 32 bit words starting at a word offset"""
+
+    rawfile.seek(4 * int(offset))
+    words = numpy.frombuffer(rawfile.read(4 * int(count)), dtype = '<i4')
+    if len(words) != count:
+        raise IOError('Unexpected end of file in ' + rawfile.name)
+    return words
@@ -21,6 +21,13 @@ import sys
 import os
 import shutil
 from PyQt4.QtCore import *
+import SansRunIndex
+import SansRunData
+import SansMaskFile
+import SansNativeReduction
+import SansBeamCentre
+import SansLogFile
+import SansLogFilter
 
 try:
     import ISISCommandInterface as SANSReduction
@@ -30,7 +37,9 @@ except ImportError: #If testing outside of Mantid use the test module instead
 # For testing outside of the Mantid environment
 try:
     from mantidsimple import *
+    MANTID = True
 except ImportError:
+    MANTID = False
     def LoadNexus(filename, wsname):
         pass
     def LoadRaw(filename, wsname):
@@ -75,6 +84,8 @@ class AbstractScatteringRun(object):
         self.initPath()
         self.initExt()
         self.initWorkspace()
+        self.initRunData()
+        self.initPeriod()
     
         if input:
             input = str(input)
@@ -99,6 +110,12 @@ class AbstractScatteringRun(object):
     def initWorkspace(self):
         self.workspace = None
 
+    def initRunData(self):
+        self.rundata = None
+
+    def initPeriod(self):
+        self.period = 1
+
     #####################
     #Getters and Setters#
     #####################
@@ -142,6 +159,22 @@ class AbstractScatteringRun(object):
     def getExt(self):
         return self.ext
 
+    def setPeriod(self, period):
+        """Set the period of a multi-period run to use, counting from one
+
+        Only this period is read from the file.
+        """
+
+        try:
+            assert int(period) == period and int(period) >= 1
+        except (AssertionError, TypeError, ValueError):
+            raise TypeError('Period must be a whole number from 1')
+
+        self.period = int(period)
+
+    def getPeriod(self):
+        return self.period
+
     def setFilename(self, string):
         try:
             assert type(string) == str or type(string) == QString
@@ -198,11 +231,15 @@ class AbstractScatteringRun(object):
     def getWorkspaceName(self):
         return self.workspace.getName()
 
+    def getRunData(self):
+        return self.rundata
+
 
     ###################
     #Loaders and tools#
     ###################
-    def load(self, input = None):
+    def load(self, input = None, spec_min = None, spec_max = None,
+             period = None):
         """Method to load a file to a new workspace
 
         This shouldn't actually be used in practice because the 
@@ -212,10 +249,24 @@ class AbstractScatteringRun(object):
         The method will first try to use all available internal data
         elements to construct a complete path. Failing this it will
         attempt a range of possible values based on the available lists
+
+        Outside of Mantid the file is read with the native loaders into
+        a SansRunData.RunData held in self.rundata. spec_min, spec_max
+        and period (by default the one set with setPeriod) are passed on
+        to limit what is read.
         """
 
         if input:
             self.mungeNames(input)
+        if period is None:
+            period = self.getPeriod()
+
+        if not MANTID:
+            if self._testFullPath():
+                self.rundata = SansRunData.loadRunData(
+                                     self._buildFullPath(), spec_min,
+                                     spec_max, period)
+            return
 
         fullfilename = os.path.join(self.getPath(), 
                                      self.getFilename() + self.getExt())
@@ -319,10 +370,12 @@ class AbstractScatteringRun(object):
 
     def _testFullPath(self):
         """Method to test whether a target file actually exists
+
+        The test is made against the shared index of the run directory
+        rather than the filesystem so repeated tests are cheap.
         """
 
-        if os.path.exists(self._buildFullPath()): return True
-        else: return False
+        return SansRunIndex.fileExists(self._buildFullPath())
        
     def _buildWSName(self):
         """Template method for building a standard Workspace name
@@ -404,6 +457,7 @@ class AbstractReduction:
         self.initDetector()
         self.initGravity()
         self.initVerbose()
+        self.initLogFilter()
 
         self.__instrumentlist = ['SANS2D', 'LOQ', 'ZOOM']
         self.__detectorlist = ['front-detector', 'rear-detector']
@@ -502,6 +556,9 @@ class AbstractReduction:
     def initVerbose(self):
         self.verbose = False
 
+    def initLogFilter(self):
+        self.logfilter = None
+
     #####################
     #Getters and Setters#
     #####################
@@ -645,8 +702,9 @@ class AbstractReduction:
         The method currently takes a path and will attempt to determine 
         whether the file exists and whether the path is relative or absolute. 
         Aspects of the path are then placed in a number of private variables. 
-        The lower level functions UserPath(path) and MaskFile(filename) are 
-        then called.
+        The settings in the file are then applied to the lower level 
+        functions through SansMaskFile, which only parses a given file 
+        once, rather than calling UserPath(path) and MaskFile(filename).
         """
 
         try:
@@ -667,8 +725,7 @@ class AbstractReduction:
         self.__maskfile_isabs = os.path.isabs(path)
         self.__maskfile_currentdirwhenset = os.path.abspath('')
 
-        SANSReduction.UserPath(self.__maskfile_directory)
-        SANSReduction.MaskFile(self.__maskfile_filename)
+        SansMaskFile.applyMaskFile(self.maskfile)
 
     def getMaskfile(self, forceabs = False):
         """Method for returning the Maskfile path
@@ -801,6 +858,45 @@ class AbstractReduction:
         else:
             self.setVerbose(SANSReduction._VERBOSE_)
             return self.verbose
+
+    def setLogFilter(self, logfilter):
+        """Set a condition on the sample run's logs, or None for none
+
+        logfilter is a SansLogFilter.LogFilter, e.g.
+
+            SansLogFilter.LogValue('Fast_Shutter') == 'OPEN'
+
+        The sample run is only reduced if the filter held for all of the
+        time it was counting (see SansLogFilter.checkRunTimes).
+        """
+
+        try:
+            assert (logfilter is None or
+                    isinstance(logfilter, SansLogFilter.LogFilter))
+        except AssertionError:
+            raise TypeError("Log filter must be a SansLogFilter.LogFilter")
+
+        self.logfilter = logfilter
+
+    def getLogFilter(self):
+        return self.logfilter
+
+    def checkLogFilter(self, logfile = None):
+        """Check the sample run against the log filter, if one is set
+
+        logfile is the sample's log if it isn't the .log file next to
+        the run. Only the header of the run file is read. Raises a
+        ValueError if the filter excludes any of the run.
+        """
+
+        if self.getLogFilter() is None:
+            return
+        runfile = self.getSansRun()._buildFullPath()
+        if logfile is None:
+            logfile = os.path.splitext(runfile)[0] + '.log'
+        SansLogFilter.checkRunTimes(SansRunData.openRunFile(runfile),
+                                    self.getLogFilter(),
+                                    SansLogFile.readLogFile(logfile))
     
 
         
@@ -823,13 +919,11 @@ class Standard1DReductionSANS2DRearDetector(AbstractReduction):
     #The reduction routine#
     #######################
 
-    def doReduction(self):
-        """Method for actually doing the reduction
+    def checkReduction(self):
+        """Check that everything needed for a reduction is set
 
-        The method first checks that all the required information is available
-        and set, and that pointers correspond to real files. Then all the 
-        required lower level variables are set and the reduction is run.
-        In the current version nothing is plotted.
+        Raises a Warning naming the first thing that is missing or not
+        where it is expected.
         """
 
         # Check required information is available
@@ -914,6 +1008,18 @@ class Standard1DReductionSANS2DRearDetector(AbstractReduction):
             raise Warning(e)
             return False
 
+    def doReduction(self):
+        """Method for actually doing the reduction
+
+        The method first checks that all the required information is available
+        and set, and that pointers correspond to real files. Then all the 
+        required lower level variables are set and the reduction is run.
+        In the current version nothing is plotted.
+        """
+
+        self.checkReduction()
+        self.checkLogFilter()
+
         # Now actually do the setting of appropriate global variables etc.
         # We set DataPath for each sample to protect against the case where
         # files are in different directories. The way that the SANSReduction
@@ -925,7 +1031,8 @@ class Standard1DReductionSANS2DRearDetector(AbstractReduction):
         # Setting the sample
         SANSReduction.DataPath(self.getSansRun().getPath())
         SANSReduction.AssignSample(self.getSansRun().getRunnumber() + 
-                                   '.' + self.getSansRun().getExt())
+                                   '.' + self.getSansRun().getExt(),
+                                   period = self.getSansRun().getPeriod())
 
         # Setting the sample transmision
         SANSReduction.DataPath(self.getSansRun().trans.getPath())
@@ -933,12 +1040,14 @@ class Standard1DReductionSANS2DRearDetector(AbstractReduction):
                                          + '.' + 
                                          self.getSansRun().trans.getExt(),
                                          self.getDirectBeam().getRunnumber() +
-                                         '.' + self.getDirectBeam().getExt())
+                                         '.' + self.getDirectBeam().getExt(),
+                                period = self.getSansRun().trans.getPeriod())
 
         # Setting the background
         SANSReduction.DataPath(self.getBackgroundRun().getPath())
         SANSReduction.AssignCan(self.getBackgroundRun().getRunnumber() +
-                                 '.' + self.getBackgroundRun().getExt())
+                                 '.' + self.getBackgroundRun().getExt(),
+                                period = self.getBackgroundRun().getPeriod())
 
         # Setting the background transmision
         SANSReduction.DataPath(self.getBackgroundRun().trans.getPath())
@@ -946,11 +1055,11 @@ class Standard1DReductionSANS2DRearDetector(AbstractReduction):
                                          + '.' + 
                                          self.getBackgroundRun().trans.getExt(),
                                          self.getDirectBeam().getRunnumber() +
-                                         '.' + self.getDirectBeam().getExt())
+                                         '.' + self.getDirectBeam().getExt(),
+                          period = self.getBackgroundRun().trans.getPeriod())
         
-        # Set the path to the Maskfile
-        SANSReduction.UserPath(os.path.dirname(self.getMaskfile()))
-        SANSReduction.MaskFile(os.path.basename(self.getMaskfile()))
+        # Apply the Maskfile settings, parsed once and cached
+        SansMaskFile.applyMaskFile(self.getMaskfile())
 
         # Find the beam center ###DO I REALLY NEED TO DO THIS? ### Not if the maskfile is correct
         # SANSReduction.FindBeamCentre(50., 170., 2)
@@ -960,4 +1069,148 @@ class Standard1DReductionSANS2DRearDetector(AbstractReduction):
                                                                 self.getWavRangeHigh())
 
         return self.reducedworkspace
+
+    def doSliceReductions(self, slices, logfile = None,
+                          efficiencyfile = None):
+        """Reduce several wavelength slices of the same runs
+
+        slices is a list of (low, high) wavelength ranges. Calling
+        doReduction for each would load, mask, convert and correct the
+        runs again every time. Here that is done once over the whole
+        range covered by the slices, without Mantid, by a
+        SansNativeReduction.SliceReduction and each slice is then binned
+        in Q from the shared wavelength data. Returns a list of
+        SansQBinning.Q1DResult, one per slice, which is also kept as
+        self.reducedslices.
+
+        logfile gives the detector log to position the detector from if
+        it isn't the .log file next to the SANS run and efficiencyfile
+        the RKH file to correct the detector efficiency with if it isn't
+        the one named in the mask file (see SliceReduction).
+        """
+
+        self.checkReduction()
+        try:
+            slices = [(float(low), float(high)) for low, high in slices]
+            assert len(slices) > 0
+            for low, high in slices:
+                assert low < high
+        except (AssertionError, TypeError, ValueError):
+            raise ValueError('Slices must be a list of (low, high) '
+                             'wavelength ranges')
+
+        reduction = self.getNativeReduction(
+                        min([low for low, high in slices]),
+                        max([high for low, high in slices]),
+                        logfile, efficiencyfile)
+        self.reducedslices = reduction.reduceSlices(slices)
+        return self.reducedslices
+
+    def findBeamCentre(self, rlow, rupp, maxiter = 20, xstart = None,
+                       ystart = None, logfile = None,
+                       efficiencyfile = None, grid = False,
+                       processes = None):
+        """Find the beam centre without Mantid
+
+        As FindBeamCentre, rlow and rupp are the inner and outer radii
+        in mm of the annulus whose left, right, up and down quadrants
+        are compared. The runs are prepared once over the reduction's
+        wavelength range and a SansBeamCentre.BeamCentreFinder searches
+        from the centre in the mask file, or xstart and ystart in
+        metres. Returns the centre (x, y) in metres, in the form of
+        XBEAM_CENTRE and YBEAM_CENTRE. logfile and efficiencyfile are as
+        for doSliceReductions.
+
+        With grid = True a coarse grid around the starting centre is
+        evaluated first, across a pool of processes, and the best point
+        refined (see BeamCentreFinder.findCentreByGrid).
+        """
+
+        self.checkReduction()
+        reduction = self.getNativeReduction(self.getWavRangeLow(),
+                                            self.getWavRangeHigh(),
+                                            logfile, efficiencyfile)
+        finder = SansBeamCentre.BeamCentreFinder(reduction, rlow / 1000.0,
+                                                 rupp / 1000.0)
+        if grid:
+            return finder.findCentreByGrid(xstart, ystart,
+                                           processes = processes,
+                                           maxiter = maxiter)
+        return finder.findCentre(xstart, ystart, maxiter)
+
+    def doPeriodReductions(self, periods = None, logfile = None,
+                           efficiencyfile = None):
+        """Reduce several periods of the sample run together
+
+        Reducing each period of a kinetic run with doReduction would
+        load the run, and work out the geometry, masks, transmissions
+        and efficiency, again for every period. Here the periods (by
+        default all of them) are read from the file in one go and
+        reduced, without Mantid, in a single pass with the can
+        subtracted from each. Returns a SansQBinning.Q1DResult whose
+        intensity and errors have a row for each period, also kept as
+        self.reducedperiods. logfile and efficiencyfile are as for
+        doSliceReductions.
+        """
+
+        self.checkReduction()
+        if periods is None:
+            runfile = SansRunData.openRunFile(
+                                    self.getSansRun()._buildFullPath())
+            periods = range(1, runfile.nperiods + 1)
+        try:
+            periods = [int(period) for period in periods]
+            assert len(periods) > 0
+        except (AssertionError, TypeError, ValueError):
+            raise ValueError('Periods must be a list of period numbers')
+
+        reduction = self.getNativeReduction(self.getWavRangeLow(),
+                                            self.getWavRangeHigh(),
+                                            logfile, efficiencyfile,
+                                            periods)
+        self.reducedperiods = reduction.reduce()
+        return self.reducedperiods
+
+    def doReduction2D(self, logfile = None, efficiencyfile = None):
+        """Reduce the runs to a 2D I(Qx, Qy) image without Mantid
+
+        This is the reduction WavRangeReduction does after Set2D, over
+        the wavelength range of this reduction with the Qx and Qy limits
+        of the L/QXY line of the mask file. Returns a
+        SansQBinning.Q2DResult, also kept as self.reduced2D, which
+        SansBatch.writeOutputFiles can write out. logfile and
+        efficiencyfile are as for doSliceReductions.
+        """
+
+        self.checkReduction()
+        reduction = self.getNativeReduction(self.getWavRangeLow(),
+                                            self.getWavRangeHigh(),
+                                            logfile, efficiencyfile)
+        self.reduced2D = reduction.reduce2D()
+        return self.reduced2D
+
+    def getNativeReduction(self, wavlow, wavhigh, logfile = None,
+                           efficiencyfile = None, sampleperiods = None):
+        """Return a SansNativeReduction.SliceReduction of the runs
+
+        sampleperiods is a list of sample periods to reduce together,
+        by default the period set on the sample run.
+        """
+
+        if sampleperiods is None:
+            sampleperiods = self.getSansRun().getPeriod()
+        return SansNativeReduction.SliceReduction(
+                        self.getSansRun()._buildFullPath(),
+                        self.getSansTrans()._buildFullPath(),
+                        self.getBackgroundRun()._buildFullPath(),
+                        self.getBackgroundTrans()._buildFullPath(),
+                        self.getDirectBeam()._buildFullPath(),
+                        self.getMaskfile(), wavlow, wavhigh,
+                        self.gravity, self.detector, logfile,
+                        efficiencyfile = efficiencyfile,
+                        logfilter = self.getLogFilter(),
+                        period = sampleperiods,
+                        transperiod = self.getSansTrans().getPeriod(),
+                        canperiod = self.getBackgroundRun().getPeriod(),
+                        cantransperiod = self.getBackgroundTrans().getPeriod())
  
@@ -21,6 +21,7 @@
 # Global Variables the user may wish to set
 #
 DEFAULT_IN_PATH = '/Users/Cameron/Documents/AA-ISIS-Docs/Experiments/'
+DEFAULT_QUEUE_JOURNAL = '~/.sansreduce_queue.jsonl'
 
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
@@ -28,8 +29,9 @@ import logging
 import sys
 import os
 import shutil
-from copy import deepcopy
 import SansReduce
+import SansRunIndex
+import SansBatch
 import lablogpost
 
 # Import the UI
@@ -87,6 +89,7 @@ class SansReduceDoc(SansReduce.Standard1DReductionSANS2DRearDetector):
         self.blog = False
         self.queue = False
         self.reductionQueue = []
+        self.queueJournal = DEFAULT_QUEUE_JOURNAL
         self.queueViewVisible = False
         self.outPath = ''
         self._inPathFileList = ''
@@ -350,7 +353,7 @@ class SansReduceDoc(SansReduce.Standard1DReductionSANS2DRearDetector):
     def getRunListForMenu(self):
         """Method for returning a list of runs for the menus"""
 
-        filesindir = os.listdir(self.getInPath())
+        filesindir = SansRunIndex.getRunIndex(self.getInPath()).getFiles()
         files = filter(self.includeRun, filesindir)
 
         filesformenu = []
@@ -375,8 +378,19 @@ class SansReduceDoc(SansReduce.Standard1DReductionSANS2DRearDetector):
         self.reductionQueue = []
 
     def queueReduction(self):
-        reductionToQueue = deepcopy(self)
-        self.reductionQueue.append(reductionToQueue)
+        """Add the current reduction to the queue
+
+        The queue holds SansBatch.ReductionJob records rather than copies
+        of the document. A record is a small immutable tuple of the run
+        identifiers, paths, maskfile, direct beam and output options so
+        queuing is quick and the queue grows linearly.
+        """
+
+        filename = self.getSansRun().rstrip('-add')
+        self.reductionQueue.append(SansBatch.jobFromReduction(
+                                       self.currentReduction,
+                                       self.getOutPath(), filename,
+                                       self.outputLOQ, self.outputCanSAS))
         # self.initForNewDocAfterQueuing
 
     def getReductionQueueLength(self):
@@ -391,15 +405,31 @@ class SansReduceDoc(SansReduce.Standard1DReductionSANS2DRearDetector):
         method is required for building the queue table in the UI.
         """
 
-        if index > len(self.reductionQueue):
+        if index >= len(self.reductionQueue):
             raise ValueError("Don't have that many reductions queued")
 
-        list = []
-        list.append(self.reductionQueue[index].getSansRun())
-        list.append(self.reductionQueue[index].getSansTrans())
-        list.append(self.reductionQueue[index].getBackgroundRun())
-        list.append(self.reductionQueue[index].getBackgroundTrans())
-        return list
+        job = self.reductionQueue[index]
+        return [SansBatch.runnumberFromIdentifier(job.sansrun),
+                SansBatch.runnumberFromIdentifier(job.sanstrans),
+                SansBatch.runnumberFromIdentifier(job.bgdrun),
+                SansBatch.runnumberFromIdentifier(job.bgdtrans)]
+
+    def setMaskfileForQueue(self, path):
+        """Change the maskfile for every reduction in the queue"""
+
+        path = str(path)
+        if not os.path.exists(path):
+            raise ValueError('Path to Maskfile is incorrect or broken!')
+        path = os.path.abspath(path)
+        self.reductionQueue = [job._replace(maskfile = path)
+                               for job in self.reductionQueue]
+
+    def setDirectBeamForQueue(self, run):
+        """Change the direct beam run for every reduction in the queue"""
+
+        run = str(run)
+        self.reductionQueue = [job._replace(directbeam = run)
+                               for job in self.reductionQueue]
 
     def writeOutputFiles(self, reduced, targetdirectory, filename):
         """Method for writing required output files after reduction
@@ -410,41 +440,66 @@ class SansReduceDoc(SansReduce.Standard1DReductionSANS2DRearDetector):
         effectively global to a queued set of reductions. This should be
         fine in most circumstances.
         """
-        # Check the target directory and filename make sense
-        if not os.path.isdir(targetdirectory):
-            raise IOError("Target directory does not exist")
-        if not filename:
-            raise IOError("I don't have a filename to save to")
-
-        # Set up the path and write out the files
-        targetpath = os.path.join(targetdirectory, filename)
-        if self.outputLOQ:
-            SaveRKH(reduced, targetpath + '.LOQ')
-        if self.outputCanSAS:
-            SaveCanSAS1D(reduced, targetpath + '.xml')
-        
 
-    def doSingleReduction(self):
-        """Method for doing a single reduction
-        """
+        SansBatch.writeOutputFiles(reduced, targetdirectory, filename,
+                                   self.outputLOQ, self.outputCanSAS)
+
+    def getSingleReductionJob(self):
+        """Return the SansBatch.ReductionJob for the current reduction"""
 
-        logging.debug("Doc:doSingleReduction: starting")
-        # Do the actual reduction
-        reduced = self.currentReduction.doReduction()
         targetdirectory, filename = os.path.split(self.getOutPath())
-        
+
         # Construct a filename from run number if required
         if self.useRunnumberForOutput:
             filename = self.getSansRun().rstrip('-add')
 
-        # Write out the required files
-        self.writeOutputFiles(reduced, targetdirectory, filename)
+        return SansBatch.jobFromReduction(self.currentReduction,
+                                          targetdirectory, filename,
+                                          self.outputLOQ, self.outputCanSAS)
+
+    def isSingleReductionUpToDate(self):
+        """Return True if the current reduction's outputs are up to date
+
+        The outputs must exist and have been reduced from the same
+        inputs (see SansBatch.isUpToDate). The view asks this before
+        calling doSingleReduction so the user can choose to reduce
+        again while the current reduction is still intact.
+        """
+
+        self.currentReduction.checkReduction()
+        job = self.getSingleReductionJob()
+        return SansBatch.isUpToDate(job, SansBatch.jobProvenance(job,
+                                                   self.currentReduction))
+
+    def doSingleReduction(self, force = False):
+        """Method for doing a single reduction
+
+        If the output files are up to date (see
+        isSingleReductionUpToDate) nothing is done and the current
+        reduction is left as it is, unless force is True. Returns
+        SansBatch.DONE or SansBatch.SKIPPED. After a reduction the
+        current reduction is reset for the next one.
+        """
+
+        logging.debug("Doc:doSingleReduction: starting")
+        self.currentReduction.checkReduction()
+        job = self.getSingleReductionJob()
+        provenance = SansBatch.jobProvenance(job, self.currentReduction)
+        if not force and SansBatch.isUpToDate(job, provenance):
+            logging.debug("Doc:doSingleReduction: " + job.filename +
+                          " is up to date")
+            return SansBatch.SKIPPED
+
+        # Do the actual reduction and write out the required files
+        reduced = self.currentReduction.doReduction()
+        self.writeOutputFiles(reduced, job.targetdirectory, job.filename)
+        SansBatch.writeProvenance(job, provenance)
 
         # If the reduction is to be blogged out
         if self.getBlogReduction():
             post_id =self.arrangeOutputPostsToBlog(os.path.join(
-                                                      targetdirectory,
-                                                      filename))
+                                                      job.targetdirectory,
+                                                      job.filename))
             self.appendReductionToReductionPost(post_id)
             self.closeAndPostReductionPost()
             self.blogreductionpost = None
@@ -453,49 +508,99 @@ class SansReduceDoc(SansReduce.Standard1DReductionSANS2DRearDetector):
         self.initCurrentReduction()
         if MANTID:
             mantid.clear()
+        return SansBatch.DONE
 
-    def doQueuedReductions(self):
-        """Method for carrying out the reductions in the queue"""
+    def setQueueJournal(self, path):
+        """Set the file the reduction queue is journaled to"""
+
+        if type(path) != str and type(path) != QString:
+            raise TypeError("Path must be a string or QString")
+        self.queueJournal = str(path)
+
+    def getQueueJournal(self):
+        return os.path.expanduser(self.queueJournal)
+
+    def doQueuedReductions(self, processes = 1, force = False):
+        """Method for carrying out the reductions in the queue
+
+        The queued SansBatch.ReductionJob records are run in this
+        process, one after the other, by default. Forking worker
+        processes from a running Qt application and Mantid framework is
+        not safe, and on Windows each worker would start the host
+        executable again, so a pool (see SansBatch.runJobs) is only used
+        if processes is set above 1. Batches that need the pool are
+        better run from the command line with SansBatch. Results come
+        back in queue order so the blog table matches the queue.
+        Reductions that fail are reported together once the rest have
+        completed.
+
+        The queue and the progress of each reduction are journaled to
+        the queue journal so an interrupted batch can be picked up again
+        with resumeQueuedReductions.
+
+        Reductions whose outputs are up to date with their inputs are
+        skipped unless force is True.
+        """
+
+        self.processResults(SansBatch.runJournaledJobs(
+                                       self.getReductionQueue(),
+                                       self.getQueueJournal(), processes,
+                                       force = force))
+
+    def resumeQueuedReductions(self, processes = 1, force = False):
+        """Carry on with the reductions in the queue journal
+
+        Reductions already done whose output files exist are skipped.
+        The queue is replaced by the reductions in the journal. As for
+        doQueuedReductions they run in this process unless processes is
+        set above 1.
+        """
+
+        journal = SansBatch.QueueJournal(self.getQueueJournal())
+        self.reductionQueue = [job for job, state, message
+                               in journal.read()]
+        self.processResults(SansBatch.resumeJobs(self.getQueueJournal(),
+                                                 processes, force = force))
+
+    def processResults(self, results):
+        """Blog the successful reductions and report any failures
+
+        Reductions skipped as up to date were blogged when they were
+        done and are left out.
+        """
 
         if self.getBlogReduction():
             self.initialiseReductionPost()
 
-        for reduction in self.getReductionQueue():
-            reduced = reduction.currentReduction.doReduction()
-            targetdirectory = self.getOutPath()
-        
-        # Construct a filename from run number if required
-            if self.useRunnumberForOutput:
-                filename = reduction.getSansRun().rstrip('-add')
+        failed = []
+        for result in results:
+            job = result.job
+            if result.status == SansBatch.SKIPPED:
+                continue
+            if result.status != SansBatch.DONE:
+                failed.append(job.sansrun + ': ' + result.message)
+                continue
 
-        # Write out the required files
-            self.writeOutputFiles(reduced, targetdirectory, filename)
-
-        # If the reduction is to be blogged out
+            # If the reduction is to be blogged out
             if self.getBlogReduction():
-                post_id = reduction.arrangeOutputPostsToBlog(os.path.join(
-                                                      targetdirectory,
-                                                      filename))
+                post_id = self.arrangeOutputPostsToBlog(os.path.join(
+                                                      job.targetdirectory,
+                                                      job.filename),
+                                                      job.filename)
                 self.blogreductionposttable.appendRow(
-                        [reduction.getSansRun(), 
-                         reduction.getSansTrans(),
-                         reduction.getBackgroundRun(),
-                         reduction.getBackgroundTrans(),
+                        [SansBatch.runnumberFromIdentifier(job.sansrun),
+                         SansBatch.runnumberFromIdentifier(job.sanstrans),
+                         SansBatch.runnumberFromIdentifier(job.bgdrun),
+                         SansBatch.runnumberFromIdentifier(job.bgdtrans),
                          '[blog]' + post_id + '[/blog]'])
 
-            # Clear the Mantid workspace before doing further reductions
-            if MANTID:
-                mantid.clear()
-
         #Close up the blog post when done if required
         if self.getBlogReduction():
             self.closeAndPostReductionPost()
             self.blogreductionpost = None
 
-
-
-            # TODO - some monitoring and error catching here in case
-            # some reductions don't proceed properly
+        if failed:
+            raise Warning('Reductions failed:\n' + '\n'.join(failed))
 
     ################################
     # Blogging convenience methods #
@@ -512,13 +617,14 @@ class SansReduceDoc(SansReduce.Standard1DReductionSANS2DRearDetector):
             raise Warning("Failed to upload %s to blog" % filepath)
             return False
  
-    def arrangeOutputPostsToBlog(self, targetpath):
+    def arrangeOutputPostsToBlog(self, targetpath, sansrun = None):
         """Method to set up the output post in the blog
 
         First the data is posted to the appropriate blog and
         the data numbers appended to a list. The actual post
         that will contain the data is then created and the 
-        post_id returned.
+        post_id returned. sansrun is used for the title in place
+        of the current SANS run for queued reductions.
         """
 
         datapostlist = []
@@ -534,7 +640,7 @@ class SansReduceDoc(SansReduce.Standard1DReductionSANS2DRearDetector):
         outputblogpost = lablogpost.LaBLogPost()
         outputblogpost.set_username(self.blogusername)
         if self.getUseRunnumberForOutput():
-            outputblogpost.set_title(self.getSansRun() + 
+            outputblogpost.set_title((sansrun or self.getSansRun()) + 
                                      ' - reduced SANS data')
         else:
             outputblog.post.set_title(os.path.basename(targetpath) +
@@ -905,7 +1011,17 @@ class SansReduceView(QWidget):
 
         if not self.doc.getQueue():
             logging.debug("View:doReduceOrQueue: Starting single reduction")
-            self.doc.doSingleReduction()
+            force = False
+            if self.doc.isSingleReductionUpToDate():
+                answer = QMessageBox.question(self, 'Already reduced',
+                             'The output files are up to date with these '
+                             'runs and settings.\nReduce them again?',
+                             QMessageBox.Yes | QMessageBox.No,
+                             QMessageBox.No)
+                if answer != QMessageBox.Yes:
+                    return
+                force = True
+            self.doc.doSingleReduction(force)
 
         else:
             logging.debug("View:doReduceOrQueue: Starting to queue reduction")
@@ -977,8 +1093,7 @@ class QueueWindowView(QWidget):
                     'Select Mask File',
                     self.doc.getInPath())
         self.ui.maskFileLineEdit.setText(maskfilepath)
-        for reduction in self.doc.getReductionQueue():
-            reduction.setMaskfile(maskfilepath)
+        self.doc.setMaskfileForQueue(maskfilepath)
 
     def changeDirectBeamForQueue(self):
         """Method for changing the direct beam run for queue
@@ -993,8 +1108,7 @@ class QueueWindowView(QWidget):
                                                          self.doc.getInPath())
         directbeamrun = os.path.basename(str(directbeampath)).lstrip('SANS2D0')
         self.ui.directBeamLineEdit.setText(directbeamrun)
-        for reduction in self.doc.getReductionQueue():
-            reduction.setDirectBeam(directbeamrun)
+        self.doc.setDirectBeamForQueue(directbeamrun)
            
     def cancelReductionQueue(self):
         """Method for cancelling the queue
@@ -0,0 +1,191 @@
+# SansRunData: A container for SANS run data loaded outside of Mantid
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import numpy
+
+# Sample geometry flags as used by Mantid's SampleGeometry
+SAMPLE_GEOMETRIES = {'cylinder' : 1, 'flat plate' : 2, 'disc' : 3}
+
+# The SANS2D detector banks as (first spectrum, pixels along each side).
+# Spectrum numbers run along each row of pixels in turn (the Horizontal
+# orientation of runs from 684 onwards).
+DETECTOR_BANKS = {'rear' : (9, 192), 'front' : (36873, 192)}
+
+# Names the reduction scripts and mask files use for each bank
+DETECTOR_NAMES = {'REAR' : 'rear', 'MAIN' : 'rear', 'REAR-DETECTOR' : 'rear',
+                  'MAIN-DETECTOR-BANK' : 'rear', 'FRONT' : 'front',
+                  'HAB' : 'front', 'FRONT-DETECTOR' : 'front'}
+
+class RunData(object):
+    """The counts and run details from a single period of a SANS run
+
+    This is the native equivalent of the workspace that LoadRaw or
+    LoadNexus would create. It holds NumPy arrays rather than Mantid
+    objects so it can be used on machines without Mantid.
+
+    self.tof is the array of time of flight bin boundaries in
+    microseconds, shared by every spectrum.
+
+    self.counts is a 2D array of counts with one row per spectrum and
+    one column per time of flight bin. self.spectra holds the spectrum
+    number for each row.
+
+    self.monitors is a dictionary mapping monitor spectrum numbers to
+    their counts for monitors that were requested separately from the
+    main spectrum range. self.monitor_spectra lists the spectrum numbers
+    of every monitor in the file whether loaded or not and
+    self.monitor_distances maps them to their distance in metres from
+    the moderator where the file records it.
+
+    self.sample is a dictionary holding the sample 'geometry' flag,
+    'thickness', 'height' and 'width' in the form set by
+    LoadSampleDetailsFromRaw.
+
+    self.start_time and self.end_time are when counting started and
+    stopped as ISO 8601 strings ('2010-03-09T19:39:44'), or '' if the
+    file doesn't record them.
+    """
+
+    def __init__(self, filename = '', tof = None, counts = None,
+                 spectra = None, monitors = None, period = 1, nperiods = 1,
+                 runnumber = '', title = '', instrument = '',
+                 good_frames = 0, proton_charge = 0.0, sample = None,
+                 monitor_spectra = None, monitor_distances = None,
+                 start_time = '', end_time = ''):
+        self.filename = filename
+        self.tof = tof
+        self.counts = counts
+        self.spectra = spectra
+        self.monitors = monitors or {}
+        self.monitor_spectra = list(monitor_spectra or [])
+        self.monitor_distances = dict(monitor_distances or {})
+        self.period = period
+        self.nperiods = nperiods
+        self.runnumber = runnumber
+        self.title = title
+        self.instrument = instrument
+        self.good_frames = good_frames
+        self.proton_charge = proton_charge
+        self.sample = sample or {'geometry' : 0, 'thickness' : 0.0,
+                                 'height' : 0.0, 'width' : 0.0}
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def getNumberHistograms(self):
+        return len(self.spectra)
+
+    def getSpectrumIndex(self, spectrum):
+        """Return the row of self.counts holding a spectrum number"""
+
+        index = int(spectrum) - int(self.spectra[0])
+        if (index < 0 or index >= len(self.spectra) or
+                self.spectra[index] != spectrum):
+            raise ValueError('Spectrum ' + str(spectrum) + ' not loaded')
+        return index
+
+    def getSpectrum(self, spectrum):
+        """Return the counts for a spectrum number"""
+
+        if spectrum in self.monitors:
+            return self.monitors[spectrum]
+        return self.counts[self.getSpectrumIndex(spectrum)]
+
+    def getBinCentres(self):
+        return 0.5 * (self.tof[1:] + self.tof[:-1])
+
+def openRunFile(filename):
+    """Open a raw or NeXus file without Mantid
+
+    Only the header of the file is read. The object returned has the
+    run details, nspectra, nchannels, nperiods and tof as attributes and
+    a load method taking the arguments of loadRunData.
+    """
+
+    ext = os.path.splitext(str(filename))[1].lower()
+    if ext == '.raw':
+        import SansRawFile
+        return SansRawFile.RawFile(filename)
+    if ext in ('.nxs', '.nx5'):
+        import SansNexusFile
+        return SansNexusFile.NexusFile(filename)
+    raise ValueError('No native loader for ' + str(filename))
+
+def loadRunData(filename, spec_min = None, spec_max = None, period = 1,
+                monitors = None):
+    """Load a run from a raw or NeXus file without Mantid
+
+    Arguments follow _loadRawData in SANSReduction. spec_min and
+    spec_max limit the spectra that are decoded, period selects a single
+    period from a multi-period run and monitors is an optional list of
+    monitor spectrum numbers to load alongside the spectrum range.
+    """
+
+    return openRunFile(filename).load(spec_min, spec_max, period, monitors)
+
+def loadRunPeriods(filename, spec_min = None, spec_max = None,
+                   periods = None, monitors = None):
+    """Load several periods of a run, reading the file header only once
+
+    periods is a list of period numbers, by default every period of the
+    run. Other arguments are as for loadRunData. Returns a list with a
+    RunData for each period.
+    """
+
+    runfile = openRunFile(filename)
+    if periods is None:
+        periods = range(1, runfile.nperiods + 1)
+    return [runfile.load(spec_min, spec_max, period, monitors)
+            for period in periods]
+
+def normaliseSpectrumRange(spec_min, spec_max, nspectra):
+    """Fill in defaults for a spectrum range and check it
+
+    Spectrum numbers run from 1 to nspectra. Returns (spec_min, spec_max).
+    """
+
+    if spec_min is None:
+        spec_min = 1
+    if spec_max is None:
+        spec_max = nspectra
+    spec_min = int(spec_min)
+    spec_max = int(spec_max)
+    try:
+        assert 1 <= spec_min <= spec_max <= nspectra
+    except AssertionError:
+        raise ValueError('Spectrum range ' + str(spec_min) + '-' +
+                         str(spec_max) + ' outside 1-' + str(nspectra))
+    return spec_min, spec_max
+
+def geometryFlag(shape):
+    """Convert a sample shape name to a Mantid geometry flag"""
+
+    return SAMPLE_GEOMETRIES.get(str(shape).strip().lower(), 0)
+
+def bankName(detector):
+    """Return 'rear' or 'front' for any of the DETECTOR_NAMES"""
+
+    try:
+        return DETECTOR_NAMES[str(detector).strip().upper()]
+    except KeyError:
+        raise ValueError('Unrecognised detector ' + str(detector))
+
+def bankSpectra(bank):
+    """Return the spectrum numbers of a detector bank in order"""
+
+    first, dimension = DETECTOR_BANKS[bankName(bank)]
+    return numpy.arange(first, first + dimension * dimension)
@@ -0,0 +1,203 @@
+# SansRunIndex: A shared index of the run files held in SANS data
+# directories
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import time
+
+# File types that are indexed against their run number
+RUN_FILE_EXTENSIONS = ['raw', 'nxs', 'log']
+
+# A directory modified less than this many seconds before it was listed
+# may have changed again without its mtime moving on (filesystems with
+# coarse timestamps) so it is listed again on the next lookup.
+MTIME_RESOLUTION = 2.0
+
+class RunDirectoryIndex(object):
+    """An index of the run files held in a single directory
+
+    A cycle directory on the archive can hold tens of thousands of files
+    and listing it, or probing it with os.path.exists for each candidate
+    filename, is slow. The index lists the directory once and holds the
+    filenames as a set, along with a dictionary mapping each run number
+    to the files available for that run keyed by extension, e.g.
+
+        {'3328' : {'raw' : 'SANS2D00003328.raw',
+                   'nxs' : 'SANS2D00003328.nxs',
+                   'log' : 'SANS2D00003328.log'}}
+
+    The modification time of the directory is recorded when it is listed
+    and checked (a single stat) before each lookup. Creating, removing or
+    renaming a file changes the directory mtime so the index is rebuilt
+    the next time it is used. invalidate() forces a rebuild.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.invalidate()
+
+    def invalidate(self):
+        """Throw away the current listing so the next lookup rebuilds it"""
+
+        self.mtime = None
+        self.scantime = None
+        self.files = frozenset()
+        self.runs = {}
+
+    def refresh(self):
+        """Rebuild the index if the directory has changed since listing
+
+        Returns True if the directory was listed again.
+        """
+
+        directory = self.path or os.curdir
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            self.invalidate()
+            return False
+
+        if (mtime == self.mtime and
+                self.scantime - mtime > MTIME_RESOLUTION):
+            return False
+
+        try:
+            filenames = os.listdir(directory)
+        except OSError:
+            self.invalidate()
+            return False
+
+        runs = {}
+        for filename in filenames:
+            runnumber, ext = splitRunFilename(filename)
+            if runnumber and ext in RUN_FILE_EXTENSIONS:
+                # Prefer the full SANS2D name if a short name also exists
+                existing = runs.setdefault(runnumber, {}).get(ext)
+                if not existing or filename.upper().startswith('SANS2D'):
+                    runs[runnumber][ext] = filename
+
+        self.files = frozenset(filenames)
+        self.runs = runs
+        self.mtime = mtime
+        self.scantime = time.time()
+        logging.debug("SansRunIndex: indexed " + str(len(filenames)) +
+                      " files in " + directory)
+        return True
+
+    def exists(self, filename):
+        """Test whether a file of the given name is in the directory"""
+
+        self.refresh()
+        return filename in self.files
+
+    def getFiles(self):
+        """Return a sorted list of every file in the directory"""
+
+        self.refresh()
+        return sorted(self.files)
+
+    def getRunFile(self, runnumber, ext):
+        """Return the filename for a run number and extension or None
+
+        The run number may be given with or without leading zeros and
+        may carry the '-add' modifier.
+        """
+
+        self.refresh()
+        runnumber = normaliseRunnumber(str(runnumber))
+        return self.runs.get(runnumber, {}).get(ext)
+
+    def getRunFiles(self, runnumber):
+        """Return the dictionary of extension to filename for a run"""
+
+        self.refresh()
+        return dict(self.runs.get(normaliseRunnumber(str(runnumber)), {}))
+
+    def getRunnumbers(self, ext = None):
+        """Return the run numbers in the directory, optionally only those
+        with a file of the given extension
+        """
+
+        self.refresh()
+        if ext:
+            return [run for run in self.runs if ext in self.runs[run]]
+        return list(self.runs.keys())
+
+def normaliseRunnumber(runnumber):
+    """Strip any SANS2D prefix and leading zeros from a run number"""
+
+    if runnumber.upper().startswith('SANS2D'):
+        runnumber = runnumber[6:]
+    return runnumber.lstrip('0')
+
+def splitRunFilename(filename):
+    """Split a filename into a run number and extension
+
+    Both 'SANS2D00003328.raw' and '3328.raw' give ('3328', 'raw') and
+    added files such as 'SANS2D00003328-add.nxs' give ('3328-add', 'nxs').
+    Files that don't look like runs return ('', ext).
+    """
+
+    base, ext = os.path.splitext(filename)
+    ext = ext.lstrip('.').lower()
+    runnumber = normaliseRunnumber(base)
+    number = runnumber
+    if number.endswith('-add'):
+        number = number[:-4]
+    if not number.isdigit():
+        return '', ext
+    return runnumber, ext
+
+# Indexes are shared so that the GUIs and the reduction objects all
+# consult the same listing of a directory
+_INDEXES = {}
+
+def getRunIndex(path):
+    """Return the shared RunDirectoryIndex for a directory"""
+
+    key = os.path.abspath(str(path) or os.curdir)
+    if key not in _INDEXES:
+        _INDEXES[key] = RunDirectoryIndex(key)
+    return _INDEXES[key]
+
+def fileExists(fullpath):
+    """Index backed replacement for os.path.exists on run files
+
+    Paths without a filename component (e.g. 'data/') fall back to
+    os.path.exists.
+    """
+
+    fullpath = str(fullpath)
+    directory, filename = os.path.split(fullpath)
+    if not filename:
+        return os.path.exists(fullpath)
+    return getRunIndex(directory).exists(filename)
+
+def fileStamp(path):
+    """Return (absolute path, mtime, size) identifying a file's contents
+
+    Used as a cache key for anything read from the file.
+    """
+
+    stat = os.stat(str(path))
+    return os.path.abspath(str(path)), stat.st_mtime, stat.st_size
+
+def clearIndexes():
+    """Drop every shared index"""
+
+    _INDEXES.clear()
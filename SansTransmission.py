@@ -0,0 +1,393 @@
+# SansTransmission: Transmission fits and a persistent cache of them
+#
+# Copyright (C) 2010 Cameron Neylon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import hashlib
+import tempfile
+import numpy
+from collections import namedtuple
+import SansRunIndex
+import SansRunData
+import SansQBinning
+
+# Where fits are kept between sessions and how many are kept
+DEFAULT_CACHE_DIRECTORY = '~/.sansreduce_transmission'
+DEFAULT_CACHE_SIZE = 64
+
+# Wavelength in Angstroms of a neutron taking one microsecond to travel
+# one metre (h / m_n)
+TOF_TO_WAVELENGTH = 3.956034e-3
+
+# Distances of the SANS2D monitors from the moderator in metres, for
+# files (such as NeXus files) that don't record them
+MONITOR_DISTANCES = {1 : 7.217, 2 : 17.937, 3 : 19.497, 4 : 23.281}
+
+# The fit types of TRANS_FIT
+FIT_TYPES = ['Log', 'Linear', 'Off']
+
+# Everything a transmission fit depends on. trans and direct are the
+# SansRunIndex.fileStamp of the run files so a regenerated (e.g. added)
+# run is never matched against a stale fit. binning holds the wavelength
+# rebin parameters, background the flat background range (or None) and
+# period the period of the trans run.
+TransmissionKey = namedtuple('TransmissionKey',
+                             ['trans', 'direct', 'fittype', 'wavlow',
+                              'wavhigh', 'monitor', 'detector', 'binning',
+                              'background', 'period'])
+
+# A transmission as a function of wavelength. wavelengths holds the bin
+# boundaries in Angstroms and transmission and errors one value per bin.
+TransmissionFit = namedtuple('TransmissionFit', ['wavelengths',
+                                                 'transmission', 'errors'])
+
+def transmissionKey(transfile, directfile, fittype, wavlow, wavhigh,
+                    monitor, detector, binning = None, background = None,
+                    period = 1):
+    """Build the TransmissionKey for a pair of run files"""
+
+    if binning is not None:
+        binning = tuple([float(value) for value in
+                         _rebinParameters(binning)])
+    if background is not None:
+        background = tuple([float(value) for value in background])
+    return TransmissionKey(SansRunIndex.fileStamp(transfile),
+                           SansRunIndex.fileStamp(directfile),
+                           str(fittype), float(wavlow), float(wavhigh),
+                           int(monitor), int(detector), binning, background,
+                           int(period))
+
+class TransmissionCache(object):
+    """Transmission fits kept on disk and shared between processes
+
+    Each fit is stored in its own .npz file in the cache directory,
+    named by a hash of its TransmissionKey, so the cache outlives
+    mantid.clear() and restarts of the program and is shared by the
+    worker processes of a batch. Files are written to a temporary name
+    and renamed into place so a reader never sees a partial file.
+
+    The modification time of each file is updated when it is read and
+    once there are more than size files the least recently used are
+    removed.
+    """
+
+    def __init__(self, directory = DEFAULT_CACHE_DIRECTORY,
+                 size = DEFAULT_CACHE_SIZE):
+        self.directory = os.path.expanduser(str(directory))
+        self.size = size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def getPath(self, key):
+        """Return the file a fit with this key is stored in"""
+
+        name = hashlib.sha1(repr(tuple(key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.npz')
+
+    def get(self, key):
+        """Return the cached TransmissionFit for a key or None"""
+
+        path = self.getPath(key)
+        try:
+            stored = numpy.load(path)
+            try:
+                if str(stored['key']) != repr(tuple(key)):
+                    return None
+                fit = TransmissionFit(stored['wavelengths'],
+                                      stored['transmission'],
+                                      stored['errors'])
+            finally:
+                stored.close()
+            os.utime(path, None)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        logging.debug("SansTransmission: cached fit for " + str(key))
+        return fit
+
+    def put(self, key, fit):
+        """Store a TransmissionFit and evict the least recently used"""
+
+        handle, temppath = tempfile.mkstemp(suffix = '.npz',
+                                            dir = self.directory)
+        os.close(handle)
+        try:
+            numpy.savez(temppath, key = numpy.array(repr(tuple(key))),
+                        wavelengths = fit.wavelengths,
+                        transmission = fit.transmission,
+                        errors = fit.errors)
+            os.rename(temppath, self.getPath(key))
+        except:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used fits beyond the cache size"""
+
+        entries = []
+        for name in os.listdir(self.directory):
+            # Leave files other processes are still writing
+            if name.startswith('tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+        entries.sort()
+        for mtime, path in entries[:max(0, len(entries) - self.size)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+
+    def getFit(self, key, calculate):
+        """Return the fit for a key, calling calculate() on a miss"""
+
+        fit = self.get(key)
+        if fit is None:
+            fit = calculate()
+            self.put(key, fit)
+        return fit
+
+_CACHE = None
+
+def getCache():
+    """Return the TransmissionCache in the default directory"""
+
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = TransmissionCache()
+    return _CACHE
+
+def removeFlatBackground(counts, tof, start, end):
+    """Subtract a flat background from a time of flight spectrum
+
+    The background is the mean count rate in the bins whose centres lie
+    between start and end (in microseconds), as FlatBackground does for
+    the BACK/MON/TIMES range. Each bin loses that rate times its width.
+    """
+
+    counts = numpy.asarray(counts, dtype = numpy.float64)
+    tof = numpy.asarray(tof, dtype = numpy.float64)
+    widths = numpy.diff(tof)
+    centres = 0.5 * (tof[1:] + tof[:-1])
+    inrange = (centres >= start) & (centres <= end)
+    if not inrange.any():
+        raise ValueError('No bins between ' + str(start) + ' and ' +
+                         str(end))
+    rate = counts[inrange].sum() / widths[inrange].sum()
+    return counts - rate * widths
+
+def rebinToWavelength(counts, tof, distance, wavelengths):
+    """Rebin a time of flight spectrum onto wavelength bin boundaries
+
+    distance is the flight path from the moderator in metres. Counts are
+    shared between overlapping bins in proportion to the overlap, as
+    Rebin does, by interpolating the cumulative counts at the new
+    boundaries. Returns the counts in each wavelength bin.
+    """
+
+    edges = TOF_TO_WAVELENGTH * numpy.asarray(tof, dtype = numpy.float64) \
+            / distance
+    cumulative = numpy.concatenate([[0.0], numpy.cumsum(counts)])
+    return numpy.diff(numpy.interp(wavelengths, edges, cumulative))
+
+def monitorDistance(rundata, spectrum):
+    """Return the distance of a monitor from the moderator in metres"""
+
+    if spectrum in rundata.monitor_distances:
+        return rundata.monitor_distances[spectrum]
+    try:
+        return MONITOR_DISTANCES[spectrum]
+    except KeyError:
+        raise ValueError('No distance known for monitor ' + str(spectrum))
+
+def monitorRatio(rundata, wavelengths, monitor = 2, detector = 3,
+                 background = None):
+    """Return the ratio of two monitors of a run in wavelength bins
+
+    monitor is the incident beam monitor (TRANS_UDET_MON) and detector
+    the transmission monitor (TRANS_UDET_DET). Each has the flat
+    background over the background (start, end) range removed and is
+    rebinned to wavelength before the ratio is taken. Returns the ratio
+    and its variance; bins with no incident counts are returned as zero
+    with infinite variance.
+    """
+
+    spectra = []
+    variances = []
+    for spectrum in (monitor, detector):
+        counts = numpy.asarray(rundata.getSpectrum(spectrum),
+                               dtype = numpy.float64)
+        variance = counts.copy()
+        if background is not None:
+            counts = removeFlatBackground(counts, rundata.tof, *background)
+        distance = monitorDistance(rundata, spectrum)
+        spectra.append(rebinToWavelength(counts, rundata.tof, distance,
+                                         wavelengths))
+        variances.append(rebinToWavelength(variance, rundata.tof, distance,
+                                           wavelengths))
+
+    incident, transmitted = spectra
+    valid = (incident > 0) & (transmitted > 0)
+    divisor = numpy.where(valid, incident, 1.0)
+    ratio = numpy.where(valid, transmitted / divisor, 0.0)
+    relative = (variances[0] / divisor ** 2 +
+                variances[1] / numpy.where(valid, transmitted, 1.0) ** 2)
+    return ratio, numpy.where(valid, ratio ** 2 * relative, numpy.inf)
+
+def fitTransmission(wavelengths, transmission, variance, fittype = 'Log',
+                    wavlow = None, wavhigh = None):
+    """Fit a transmission against wavelength
+
+    fittype is one of FIT_TYPES. 'Log' fits a straight line to the log of
+    the transmission and 'Linear' to the transmission itself, weighted by
+    the inverse variance, using the bins whose centres lie between
+    wavlow and wavhigh (the TRANS_WAV1 and TRANS_WAV2 range). The fit is
+    evaluated over every bin. 'Off' returns the data unfitted. Returns a
+    TransmissionFit.
+    """
+
+    try:
+        assert fittype in FIT_TYPES
+    except AssertionError:
+        raise ValueError('Fit type must be one of ' + ', '.join(FIT_TYPES))
+
+    wavelengths = numpy.asarray(wavelengths, dtype = numpy.float64)
+    transmission = numpy.asarray(transmission, dtype = numpy.float64)
+    variance = numpy.asarray(variance, dtype = numpy.float64)
+    if fittype == 'Off':
+        return TransmissionFit(wavelengths, transmission,
+                               numpy.sqrt(numpy.where(
+                                   numpy.isfinite(variance), variance, 0.0)))
+
+    centres = SansQBinning.wavelengthCentres(wavelengths)
+    use = numpy.isfinite(variance) & (variance > 0) & (transmission > 0)
+    if wavlow is not None:
+        use &= centres >= wavlow
+    if wavhigh is not None:
+        use &= centres <= wavhigh
+    if use.sum() < 2:
+        raise ValueError('Too few transmission points to fit')
+
+    if fittype == 'Log':
+        values = numpy.log(transmission[use])
+        weights = transmission[use] ** 2 / variance[use]
+    else:
+        values = transmission[use]
+        weights = 1.0 / variance[use]
+    intercept, slope, covariance = _fitLine(centres[use], values, weights)
+
+    fitted = intercept + slope * centres
+    fitvariance = (covariance[0, 0] + 2 * covariance[0, 1] * centres +
+                   covariance[1, 1] * centres ** 2)
+    errors = numpy.sqrt(fitvariance)
+    if fittype == 'Log':
+        fitted = numpy.exp(fitted)
+        errors = fitted * errors
+    return TransmissionFit(wavelengths, fitted, errors)
+
+def transmissionFromRuns(trans, direct, wavelengths, fittype = 'Log',
+                         wavlow = None, wavhigh = None, monitor = 2,
+                         detector = 3, background = None):
+    """Calculate the fitted transmission from a trans and a direct run
+
+    trans and direct are SansRunData.RunData holding the monitor
+    spectra. The transmission is the ratio of the transmitted to the
+    incident monitor of the trans run over the same ratio for the direct
+    run, as CalculateTransmission gives. See monitorRatio and
+    fitTransmission for the other arguments.
+    """
+
+    wavelengths = numpy.asarray(wavelengths, dtype = numpy.float64)
+    sample, samplevar = monitorRatio(trans, wavelengths, monitor, detector,
+                                     background)
+    empty, emptyvar = monitorRatio(direct, wavelengths, monitor, detector,
+                                   background)
+    valid = (sample > 0) & (empty > 0)
+    divisor = numpy.where(valid, empty, 1.0)
+    transmission = numpy.where(valid, sample / divisor, 0.0)
+    variance = numpy.where(valid, transmission ** 2 *
+                           (samplevar / numpy.where(valid, sample, 1.0) ** 2 +
+                            emptyvar / divisor ** 2), numpy.inf)
+    return fitTransmission(wavelengths, transmission, variance, fittype,
+                           wavlow, wavhigh)
+
+def calculateTransmission(transfile, directfile, binning, fittype = 'Log',
+                          wavlow = None, wavhigh = None, monitor = 2,
+                          detector = 3, background = None, cache = None,
+                          period = 1):
+    """Calculate a transmission from run files without Mantid
+
+    binning gives the wavelength bins as rebin parameters, e.g.
+    (WAV1, DWAV, WAV2). Only the two monitor spectra are read from each
+    file. The fit is looked up in, and stored to, cache (a
+    TransmissionCache, by default the shared one from getCache) so a
+    pair of runs used by many reductions is only fitted once. Pass
+    cache = False to always calculate. period selects the period of a
+    multi-period trans run; only that period is read.
+    """
+
+    wavelengths = SansQBinning.rebinBoundaries(_rebinParameters(binning))
+    if wavlow is None:
+        wavlow = wavelengths[0]
+    if wavhigh is None:
+        wavhigh = wavelengths[-1]
+
+    def calculate():
+        spectra = sorted([monitor, detector])
+        trans = SansRunData.loadRunData(transfile, spectra[0], spectra[1],
+                                        period)
+        direct = SansRunData.loadRunData(directfile, spectra[0], spectra[1])
+        return transmissionFromRuns(trans, direct, wavelengths, fittype,
+                                    wavlow, wavhigh, monitor, detector,
+                                    background)
+
+    if cache is False:
+        return calculate()
+    if cache is None:
+        cache = getCache()
+    key = transmissionKey(transfile, directfile, fittype, wavlow, wavhigh,
+                          monitor, detector, binning, background, period)
+    return cache.getFit(key, calculate)
+
+def _rebinParameters(binning):
+    """Return rebin parameters given as a string or sequence as a list"""
+
+    if isinstance(binning, str):
+        return [float(value) for value in binning.split(',')
+                if value.strip()]
+    return [float(value) for value in binning]
+
+def _fitLine(x, y, weights):
+    """Weighted least squares fit of y = intercept + slope * x
+
+    Returns the intercept, slope and their covariance matrix.
+    """
+
+    design = numpy.vstack([numpy.ones(len(x)), x]).T
+    normal = numpy.dot(design.T * weights, design)
+    covariance = numpy.linalg.inv(normal)
+    intercept, slope = numpy.dot(covariance,
+                                 numpy.dot(design.T * weights, y))
+    return intercept, slope, covariance
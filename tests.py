@@ -19,6 +19,28 @@ import unittest
 import os
 import SansReduce
 import SansReduceGui
+import SansRunIndex
+import SansRunData
+import SansRawFile
+import SansNexusFile
+import SansAddRuns
+import SansBatch
+import SansMaskFile
+import SansGeometry
+import SansQBinning
+import SansTransmission
+import SansNativeReduction
+import SansRKHFile
+import SansCanSASFile
+import SansBeamCentre
+import SansLogFile
+import SansLogFilter
+import numpy
+import tempfile
+import shutil
+import xml.etree.ElementTree as ElementTree
+import time
+import json
 
 # Tests for SansReduce.py
 # 
@@ -568,6 +590,72 @@ class SansReduceGuiDocTest(unittest.TestCase):
         self.testdoc.setOutPath('/')
         self.assertEqual(self.testdoc.getOutPath(), '/')
         
+    def testQueueReduction(self):
+        """Test that queued reductions are stored as job records"""
+
+        self.testdoc.setInPath('test_data')
+        self.testdoc.setSansRun('3325.raw')
+        self.testdoc.setSansTrans('3328.raw')
+        self.testdoc.setBackgroundRun('3333.raw')
+        self.testdoc.setBackgroundTrans('3328.nxs')
+        self.testdoc.setDirectBeam('3332.raw')
+        self.testdoc.queueReduction()
+        self.testdoc.setSansRun('3326.nxs')
+        self.testdoc.queueReduction()
+
+        self.assertEqual(self.testdoc.getReductionQueueLength(), 2)
+        self.assertEqual(self.testdoc.getQueueElement(0),
+                         ['3325', '3328', '3333', '3328'])
+        self.assertEqual(self.testdoc.getQueueElement(1)[0], '3326')
+        self.assertRaises(ValueError, self.testdoc.getQueueElement, 2)
+        self.assertEqual(type(self.testdoc.getReductionQueue()[0]),
+                         SansBatch.ReductionJob)
+
+        self.testdoc.setDirectBeamForQueue('3331.nxs')
+        self.testdoc.setMaskfileForQueue('test_data/MASKSANS2D_095B.txt')
+        self.assertEqual([job.directbeam for job in
+                          self.testdoc.getReductionQueue()],
+                         ['3331.nxs', '3331.nxs'])
+        self.assertEqual(self.testdoc.getReductionQueue()[1].maskfile,
+                         os.path.abspath('test_data/MASKSANS2D_095B.txt'))
+        self.assertRaises(ValueError, self.testdoc.setMaskfileForQueue,
+                          'false/path')
+        self.testdoc.clearReductionQueue()
+        self.assertEqual(self.testdoc.getReductionQueueLength(), 0)
+
+    def testSkipUpToDateReduction(self):
+        """Test that a reduction already done is found and not rerun"""
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.testdoc.setInPath('test_data')
+            self.testdoc.setSansRun('3333.nxs')
+            self.testdoc.setSansTrans('3328.nxs')
+            self.testdoc.setBackgroundRun('3333.nxs')
+            self.testdoc.setBackgroundTrans('3331.nxs')
+            self.testdoc.setDirectBeam('3332.raw')
+            self.testdoc.setMaskfile('test_data/MASKSANS2D_095B.txt')
+            self.testdoc.setOutPath(tempdir + os.sep)
+            job = SansBatch.jobFromReduction(self.testdoc.currentReduction,
+                                             tempdir, '3333')
+            open(os.path.join(tempdir, '3333.xml'), 'w').close()
+            SansBatch.writeProvenance(job, SansBatch.jobProvenance(job))
+
+            self.assertEqual(self.testdoc.isSingleReductionUpToDate(),
+                             True)
+            self.testdoc.currentReduction.getSansRun().setPeriod(2)
+            self.assertEqual(self.testdoc.isSingleReductionUpToDate(),
+                             False)
+            self.testdoc.currentReduction.getSansRun().setPeriod(1)
+
+            reduction = self.testdoc.currentReduction
+            self.assertEqual(self.testdoc.doSingleReduction(),
+                             SansBatch.SKIPPED)
+            # Nothing was run so the reduction is left for a forced run
+            self.assertTrue(self.testdoc.currentReduction is reduction)
+        finally:
+            shutil.rmtree(tempdir)
+        
 class SansReduceGuiMenuDocTest(unittest.TestCase):
     """Test Class for Menu utility methods for SansReduceGuiDoc"""
 
@@ -654,6 +742,1275 @@ class SansReduceGuiMenuDocTest(unittest.TestCase):
         self.assertEqual(self.testdoc.getRunListForMenu(), 
                  [])
 
+class RunIndexTest(unittest.TestCase):
+    """Tests for the shared run directory index"""
+
+    def setUp(self):
+        SansRunIndex.clearIndexes()
+        self.index = SansRunIndex.getRunIndex('test_data')
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        SansRunIndex.clearIndexes()
+
+    def testSplitRunFilename(self):
+        self.assertEqual(SansRunIndex.splitRunFilename('SANS2D00003328.raw'),
+                         ('3328', 'raw'))
+        self.assertEqual(SansRunIndex.splitRunFilename('3326.nxs'),
+                         ('3326', 'nxs'))
+        self.assertEqual(SansRunIndex.splitRunFilename('3328-add.NXS'),
+                         ('3328-add', 'nxs'))
+        self.assertEqual(
+                 SansRunIndex.splitRunFilename('MASKSANS2D_095B.txt'),
+                 ('', 'txt'))
+
+    def testLookups(self):
+        self.assertEqual(self.index.exists('SANS2D00003328.raw'), True)
+        self.assertEqual(self.index.exists('SANS2D00009999.raw'), False)
+        self.assertEqual(self.index.getRunFile('3328', 'nxs'),
+                         'SANS2D00003328.nxs')
+        self.assertEqual(self.index.getRunFile('00003328', 'log'),
+                         'SANS2D00003328.log')
+        self.assertEqual(self.index.getRunFile('3326', 'nxs'), '3326.nxs')
+        self.assertEqual(self.index.getRunFile('3326', 'raw'), None)
+        self.assertEqual(SansRunIndex.getRunIndex('test_data/'), self.index)
+        self.assertEqual(SansRunIndex.fileExists(
+                   os.path.join('test_data', 'SANS2D00003331.nxs')), True)
+
+    def testIndexFollowsDirectory(self):
+        index = SansRunIndex.getRunIndex(self.tempdir)
+        self.assertEqual(index.getFiles(), [])
+        open(os.path.join(self.tempdir, 'SANS2D00001234.raw'), 'w').close()
+        index.invalidate()
+        self.assertEqual(index.getFiles(), ['SANS2D00001234.raw'])
+        self.assertEqual(index.getRunnumbers('raw'), ['1234'])
+        self.assertEqual(SansRunIndex.fileExists(
+                os.path.join(self.tempdir, 'SANS2D00001234.raw')), True)
+
+class RawFileTest(unittest.TestCase):
+    """Tests for the native ISIS RAW reader"""
+
+    def setUp(self):
+        self.rawfile = SansRawFile.RawFile(
+                                os.path.join('test_data', 'SANS2D00003328.raw'))
+
+    def testHeader(self):
+        self.assertEqual(self.rawfile.runnumber, '3328')
+        self.assertEqual(self.rawfile.instrument, 'SANS2D')
+        self.assertEqual(self.rawfile.title, 'Glur0 D2O TRANS')
+        self.assertEqual(self.rawfile.nspectra, 8)
+        self.assertEqual(self.rawfile.nchannels, 152)
+        self.assertEqual(self.rawfile.good_frames, 5480)
+        self.assertAlmostEqual(self.rawfile.proton_charge, 6.006625, 5)
+        self.assertEqual(self.rawfile.sample, {'geometry' : 3,
+                          'thickness' : 1.0, 'height' : 8.0, 'width' : 8.0})
+        self.assertEqual(list(self.rawfile.tof[:3]), [5.0, 55.0, 105.0])
+        self.assertEqual(self.rawfile.tof[-1], 100005.0)
+
+    def testLoad(self):
+        rundata = self.rawfile.load()
+        self.assertEqual(rundata.counts.shape, (8, 152))
+        self.assertEqual(list(rundata.counts.sum(axis = 1)),
+                         [39454209, 5586862, 2853141, 0, 0, 0, 0, 0])
+        self.assertEqual(list(rundata.getSpectrum(1)[:5]),
+                         [3769, 2654, 2048, 1764, 1444])
+
+        rundata = SansRunData.loadRunData(
+                              os.path.join('test_data', 'SANS2D00003328.raw'),
+                              spec_min = 3, spec_max = 4, monitors = [2])
+        self.assertEqual(list(rundata.spectra), [3, 4])
+        self.assertEqual(rundata.getSpectrum(2).sum(), 5586862)
+        self.assertEqual(rundata.getSpectrum(3).sum(), 2853141)
+        self.assertRaises(ValueError, rundata.getSpectrum, 5)
+        self.assertRaises(ValueError, self.rawfile.load, 0, 4)
+        self.assertRaises(ValueError, self.rawfile.load, 1, 9)
+        self.assertRaises(ValueError, self.rawfile.load, 1, 8, 2)
+
+    def testDecompressByteRelative(self):
+        # 1, 300 (absolute), 299, then an absolute value whose payload
+        # contains the escape byte followed by padding
+        block = numpy.array([1, -128, 44, 1, 0, 0, -1,
+                             -128, -128, -128, -128, -128, 0, 0],
+                            dtype = numpy.int8)
+        values = SansRawFile.decompressByteRelative(block, [0, 7], [7, 7], 3)
+        self.assertEqual(values.tolist(), [[1, 300, 299],
+                                           [-2139062144, -2139062144,
+                                            -2139062144]])
+
+class NexusFileTest(unittest.TestCase):
+    """Tests for the sliced NeXus reader"""
+
+    def setUp(self):
+        self.nexusfile = SansNexusFile.NexusFile(
+                                os.path.join('test_data', 'SANS2D00003333.nxs'))
+
+    def testHeader(self):
+        self.assertEqual(self.nexusfile.runnumber, '3333')
+        self.assertEqual(self.nexusfile.instrument, 'SANS2D')
+        self.assertEqual(self.nexusfile.nspectra, 73736)
+        self.assertEqual(self.nexusfile.monitor_spectra, range(1, 9))
+        self.assertEqual(self.nexusfile.sample['geometry'], 3)
+
+    def testLoad(self):
+        rundata = self.nexusfile.load(1, 12)
+        self.assertEqual(list(rundata.counts.sum(axis = 1)),
+                         [190118946, 30761161, 20914, 0, 0, 0, 0, 0,
+                          19, 21, 23, 15])
+        rundata = self.nexusfile.load(9, 36872, monitors = [2])
+        self.assertEqual(rundata.counts.shape, (36864, 152))
+        self.assertEqual(rundata.getSpectrum(2).sum(), 30761161)
+        self.assertEqual(rundata.getSpectrum(12).sum(), 15)
+        self.assertRaises(ValueError, self.nexusfile.load, 1, 73737)
+
+    def testTransmissionRunMatchesRaw(self):
+        nexus = SansRunData.loadRunData(
+                              os.path.join('test_data', 'SANS2D00003328.nxs'))
+        raw = SansRunData.loadRunData(
+                              os.path.join('test_data', 'SANS2D00003328.raw'))
+        self.assertEqual(nexus.counts.tolist(), raw.counts.tolist())
+        self.assertEqual(nexus.tof.tolist(), raw.tof.tolist())
+        self.assertEqual(nexus.good_frames, raw.good_frames)
+
+class PeriodTest(unittest.TestCase):
+    """Tests for reading a single period of a multi-period run"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'SANS2D00003328.nxs')
+        first = SansRunData.loadRunData(os.path.join('test_data',
+                                                     'SANS2D00003328.nxs'))
+        second = SansRunData.loadRunData(os.path.join('test_data',
+                                                      'SANS2D00003328.nxs'))
+        second.counts = second.counts * 2
+        SansNexusFile.saveRunData([first, second], self.path)
+        self.first = first
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testLoadPeriod(self):
+        nexusfile = SansNexusFile.NexusFile(self.path)
+        self.assertEqual(nexusfile.nperiods, 2)
+        rundata = nexusfile.load(1, 8, period = 2)
+        self.assertEqual(rundata.period, 2)
+        self.assertEqual(rundata.counts.tolist(),
+                         (self.first.counts[:8] * 2).tolist())
+        self.assertEqual(nexusfile.load(1, 8).counts.tolist(),
+                         self.first.counts[:8].tolist())
+        self.assertRaises(ValueError, nexusfile.load, 1, 8, 3)
+
+    def testSetPeriod(self):
+        run = SansReduce.AbstractSans()
+        self.assertEqual(run.getPeriod(), 1)
+        run.setPeriod(2)
+        self.assertEqual(run.getPeriod(), 2)
+        self.assertRaises(TypeError, run.setPeriod, 0)
+        self.assertRaises(TypeError, run.setPeriod, 1.5)
+        self.assertRaises(TypeError, run.setPeriod, 'two')
+
+    def testTransmissionPeriod(self):
+        direct = os.path.join('test_data', 'SANS2D00003332.raw')
+        first = SansTransmission.calculateTransmission(self.path, direct,
+                                       (2.0, 0.125, 14.0), cache = False)
+        second = SansTransmission.calculateTransmission(self.path, direct,
+                                       (2.0, 0.125, 14.0), cache = False,
+                                       period = 2)
+        # Only the weights of the direct run in the fit change
+        self.assertTrue(numpy.allclose(first.transmission,
+                                       second.transmission, rtol = 1e-3))
+        self.assertRaises(ValueError, SansTransmission.calculateTransmission,
+                          self.path, direct, (2.0, 0.125, 14.0),
+                          cache = False, period = 3)
+
+class AddRunsTest(unittest.TestCase):
+    """Tests for summing runs with SansAddRuns"""
+
+    def setUp(self):
+        self.transraw = os.path.join('test_data', 'SANS2D00003328.raw')
+        self.transnexus = os.path.join('test_data', 'SANS2D00003328.nxs')
+        self.directraw = os.path.join('test_data', 'SANS2D00003332.raw')
+        self.sans = os.path.join('test_data', 'SANS2D00003333.nxs')
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testCheckRuns(self):
+        runfiles = SansAddRuns.checkRuns([self.transraw, self.directraw])
+        self.assertEqual([runfile.runnumber for runfile in runfiles],
+                         ['3328', '3332'])
+        self.assertRaises(ValueError, SansAddRuns.checkRuns,
+                          [self.transraw, self.sans])
+        self.assertRaises(ValueError, SansAddRuns.checkRuns, [])
+
+    def testScanRuns(self):
+        report = SansAddRuns.scanRuns([self.transraw, self.sans,
+                                       self.directraw,
+                                       os.path.join('test_data', '3329.raw')])
+        self.assertEqual(report.isCompatible(), False)
+        self.assertEqual(len(report.getProblems()), 2)
+        self.assertEqual(report.getProblems()[0], 'Run SANS2D00003333.nxs '
+                         'has wrong number of histograms')
+        self.assertEqual(report.getRunFiles()[3], None)
+        self.assertEqual(report.getSummary()[2], 'SANS2D00003332.raw: run '
+                         '3332, 8 histograms, 152 bins, 1 periods, '
+                         '7293 good frames')
+        report = SansAddRuns.scanRuns([self.transraw, self.directraw])
+        self.assertEqual(report.isCompatible(), True)
+
+    def testAddRunFiles(self):
+        added = SansAddRuns.addRunFiles([self.transraw, self.transnexus,
+                                         self.directraw])
+        self.assertEqual(list(added.counts.sum(axis = 1)[:3]),
+                         [2 * 39454209 + 51691437, 2 * 5586862 + 7351216,
+                          2 * 2853141 + 4246780])
+        self.assertEqual(added.runnumber, '3328')
+
+        outfile = os.path.join(self.tempdir, '3328-add.nxs')
+        SansNexusFile.saveRunData(added, outfile)
+        reloaded = SansRunData.loadRunData(outfile)
+        self.assertEqual(reloaded.counts.tolist(), added.counts.tolist())
+        self.assertEqual(reloaded.good_frames, added.good_frames)
+        self.assertEqual(reloaded.sample, added.sample)
+
+    def testAddRunPeriods(self):
+        # Two copies of a two-period run, the second period doubled
+        first = SansRunData.loadRunData(self.transnexus)
+        second = SansRunData.loadRunData(self.transnexus)
+        second.counts = second.counts * 2
+        paths = [os.path.join(self.tempdir, name)
+                 for name in ('SANS2D00003328.nxs', 'SANS2D00003329.nxs')]
+        SansNexusFile.saveRunData([first, second], paths[0])
+        shutil.copy(paths[0], paths[1])
+
+        added = SansAddRuns.addRunPeriods(paths)
+        self.assertEqual(len(added), 2)
+        self.assertEqual(added[0].counts.tolist(),
+                         (first.counts * 2).tolist())
+        self.assertEqual(added[1].counts.tolist(),
+                         (first.counts * 4).tolist())
+        self.assertEqual(added[1].period, 2)
+
+        outfile = os.path.join(self.tempdir, '3328-add.nxs')
+        SansNexusFile.saveRunData(added, outfile)
+        nexusfile = SansRunData.openRunFile(outfile)
+        self.assertEqual(nexusfile.nperiods, 2)
+        self.assertEqual(nexusfile.load(period = 2).counts.tolist(),
+                         added[1].counts.tolist())
+
+class BatchJobTest(unittest.TestCase):
+    """Tests for building and running batch reduction jobs"""
+
+    def setUp(self):
+        self.reduction = SansReduce.Standard1DReductionSANS2DRearDetector()
+        self.reduction.setPathForAllRuns('test_data')
+        self.reduction.setSansRun('3325.raw')
+        self.reduction.setSansTrans('3328.raw')
+        self.reduction.setBackgroundRun('3333.raw')
+        self.reduction.setBackgroundTrans('3328.nxs')
+        self.reduction.setDirectBeam('3332.raw')
+        self.reduction.setMaskfile(os.path.join('test_data',
+                                                'MASKSANS2D_095B.txt'))
+        self.job = SansBatch.jobFromReduction(self.reduction, 'test_data',
+                                              '3325')
+
+    def testJobFromReduction(self):
+        self.assertEqual(self.job.sansrun, '3325.raw')
+        self.assertEqual(self.job.bgdtrans, '3328.nxs')
+        self.assertEqual(self.job.path, os.path.abspath('test_data'))
+        self.assertEqual(self.job.maskfile, os.path.abspath(
+                          os.path.join('test_data', 'MASKSANS2D_095B.txt')))
+        rebuilt = SansBatch.reductionFromJob(self.job)
+        self.assertEqual(SansBatch.jobFromReduction(rebuilt, 'test_data',
+                                                    '3325'), self.job)
+
+    def testJobPeriods(self):
+        self.assertEqual(self.job.sansperiod, 1)
+        self.reduction.getSansRun().setPeriod(2)
+        self.reduction.getBackgroundTrans().setPeriod(3)
+        job = SansBatch.jobFromReduction(self.reduction, 'test_data',
+                                         '3325')
+        rebuilt = SansBatch.reductionFromJob(job)
+        self.assertEqual(rebuilt.getSansRun().getPeriod(), 2)
+        self.assertEqual(rebuilt.getSansTrans().getPeriod(), 1)
+        self.assertEqual(rebuilt.getBackgroundTrans().getPeriod(), 3)
+        self.assertEqual(rebuilt.getLogFilter(), None)
+        # The period is part of what the outputs depend on
+        self.assertNotEqual(SansBatch.provenanceHash(
+                                SansBatch.jobProvenance(job)),
+                            SansBatch.provenanceHash(
+                                SansBatch.jobProvenance(self.job)))
+
+    def testJobLogFilter(self):
+        self.assertEqual(self.job.logfilter, None)
+        self.reduction.setLogFilter(
+                        SansLogFilter.LogValue('Fast_Shutter') == 'OPEN')
+        job = SansBatch.jobFromReduction(self.reduction, 'test_data',
+                                         '3325')
+        self.assertEqual(job.logfilter,
+                         ('compare', 'Fast_Shutter', '==', 'OPEN'))
+        rebuilt = SansBatch.reductionFromJob(job)
+        self.assertEqual(rebuilt.getLogFilter().getTree(), job.logfilter)
+        self.assertNotEqual(SansBatch.provenanceHash(
+                                SansBatch.jobProvenance(job)),
+                            SansBatch.provenanceHash(
+                                SansBatch.jobProvenance(self.job)))
+
+    def testRunJobsReportsFailures(self):
+        jobs = [self.job._replace(maskfile = 'false/path'),
+                self.job._replace(sansrun = '9999.raw',
+                                  maskfile = 'false/path')]
+        results = SansBatch.runJobs(jobs, processes = 2)
+        self.assertEqual([result.job for result in results], jobs)
+        self.assertEqual([result.status for result in results],
+                         ['failed', 'failed'])
+        self.assertEqual(results[0].message,
+                         'Path to Maskfile is incorrect or broken!')
+
+class MaskFileTest(unittest.TestCase):
+    """Tests for the parsed mask file cache"""
+
+    def setUp(self):
+        SansMaskFile.clearCache()
+        self.tempdir = tempfile.mkdtemp()
+        self.maskfile = os.path.join(self.tempdir, 'MASK.txt')
+        shutil.copy(os.path.join('test_data', 'MASKSANS2D_095B.txt'),
+                    self.maskfile)
+        # Back date the file so it is old enough to be cached
+        os.utime(self.maskfile, (time.time() - 60, time.time() - 60))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        SansMaskFile.clearCache()
+
+    def testParseMaskFile(self):
+        before = SansMaskFile._snapshot()
+        settings = SansMaskFile.parseMaskFile(self.maskfile)
+        self.assertEqual(SansMaskFile._snapshot(), before)
+        self.assertEqual(settings.path, os.path.abspath(self.maskfile))
+        self.assertEqual(settings.get('MASKFILE'), 'MASK.txt')
+        self.assertEqual(settings.get('WAV1'), 2.0)
+        self.assertEqual(settings.get('GRAVITY'), True)
+        self.assertEqual(settings.get('BACKMON_START'), 80800)
+        self.assertEqual(settings.get('SPECMASKSTRING'),
+                         ',H0,H190>H191,V0,V191,H156>H159')
+        self.assertEqual(settings.get('TIMEMASKSTRING'), ';14500 16750')
+        self.assertRaises(ValueError, SansMaskFile.parseMaskFile,
+                          'false/path')
+
+    def testReadMaskFileCached(self):
+        settings = SansMaskFile.readMaskFile(self.maskfile)
+        self.assertTrue(SansMaskFile.readMaskFile(self.maskfile) is settings)
+
+        # A changed file is parsed again
+        maskfile = open(self.maskfile, 'a')
+        maskfile.write('GRAVITY/OFF\n')
+        maskfile.close()
+        os.utime(self.maskfile, (time.time() - 30, time.time() - 30))
+        changed = SansMaskFile.readMaskFile(self.maskfile)
+        self.assertFalse(changed is settings)
+        self.assertEqual(changed.get('GRAVITY'), False)
+        self.assertEqual(len(SansMaskFile._CACHE), 1)
+
+    def testApplyMaskFile(self):
+        SansMaskFile.applyMaskFile(self.maskfile)
+        SansMaskFile.applyMaskFile(self.maskfile)
+        self.assertEqual(SansReduce.SANSReduction.SPECMASKSTRING,
+                         ',H0,H190>H191,V0,V191,H156>H159')
+        self.assertEqual(SansReduce.SANSReduction.USER_PATH,
+                         os.path.abspath(self.tempdir))
+
+    def testCompileMaskFile(self):
+        masks = SansMaskFile.compileMaskFile(self.maskfile)
+        self.assertTrue(SansMaskFile.compileMaskFile(self.maskfile) is masks)
+        rear = masks['rear']
+        # Rows 0, 156-159, 190 and 191 and columns 0 and 191
+        self.assertEqual(len(rear.spectra), 7 * 192 + 2 * 185)
+        self.assertEqual(rear.spectra[0], 9)
+        self.assertTrue(9 + 156 * 192 + 100 in rear.spectra)
+        self.assertTrue(9 + 100 * 192 + 191 in rear.spectra)
+        self.assertFalse(9 + 100 * 192 + 100 in rear.spectra)
+        self.assertEqual(masks['front'].spectra[0], 36873)
+        self.assertEqual(rear.times.tolist(), [[14500.0, 16750.0]])
+
+    def testCompileMaskLines(self):
+        masks = SansMaskFile.compileMaskLines(['mask h0',
+                                               'MASK/CLEAR',
+                                               'MASK/REAR h1>h2+v3>v4',
+                                               'mask s5>s7',
+                                               'mask/time 100 200',
+                                               'MASK/T/FRONT 150 300',
+                                               'mask/time 50 120',
+                                               'MASK/NOWHERE h0'])
+        self.assertEqual(masks['rear'].spectra.tolist(),
+                         [5, 6, 7, 9 + 192 + 3, 9 + 192 + 4,
+                          9 + 384 + 3, 9 + 384 + 4])
+        self.assertEqual(masks['front'].spectra.tolist(), [5, 6, 7])
+        self.assertEqual(masks['rear'].times.tolist(), [[50.0, 200.0]])
+        self.assertEqual(masks['front'].times.tolist(), [[50.0, 300.0]])
+
+        tof = numpy.array([0.0, 40.0, 60.0, 200.0, 250.0])
+        self.assertEqual(masks['rear'].getBinMask(tof).tolist(),
+                         [False, True, True, False])
+        counts = numpy.ones((3, 4))
+        masked = masks['rear'].apply(counts, numpy.array([4, 5, 8]), tof)
+        self.assertEqual(masked.tolist(), [[1, 0, 0, 1], [0, 0, 0, 0],
+                                           [1, 0, 0, 1]])
+
+class GeometryTest(unittest.TestCase):
+    """Tests for the precomputed detector geometry tables"""
+
+    def setUp(self):
+        SansGeometry.clearCache()
+        self.logs = SansGeometry.readDetectorLogs(
+                             os.path.join('test_data', 'SANS2D00003328.log'))
+        self.settings = {'XBEAM_CENTRE' : 0.2399, 'YBEAM_CENTRE' : -0.19765,
+                         'REAR_DET_Z_CORR' : 58.0, 'SAMPLE_Z_CORR' : 0.053}
+
+    def testReadDetectorLogs(self):
+        self.assertEqual(self.logs['Rear_Det_Z'], 6000.048)
+        self.assertEqual(self.logs['Front_Det_Rot'], -19.99141)
+
+    def testDetectorPosition(self):
+        position = SansGeometry.detectorPosition('rear', self.logs,
+                                                 self.settings)
+        self.assertEqual(position.bank, 'rear')
+        self.assertAlmostEqual(position.x, -0.2399)
+        self.assertAlmostEqual(position.z, 6.058048)
+        self.assertEqual(SansGeometry.detectorPosition('REAR', self.logs,
+                                             self.settings, 0.0, 0.0).x, 0.0)
+        front = SansGeometry.detectorPosition('front', self.logs)
+        self.assertAlmostEqual(front.rotation, 19.99141)
+
+    def testRearGeometry(self):
+        position = SansGeometry.detectorPosition('rear', self.logs,
+                                                 self.settings, 0.0, 0.0)
+        geometry = SansGeometry.getGeometry(position)
+        self.assertTrue(SansGeometry.getGeometry(position) is geometry)
+        self.assertEqual(len(geometry.x), 192 * 192)
+        self.assertEqual(geometry.spectra[0], 9)
+        self.assertAlmostEqual(geometry.x[1] - geometry.x[0], 0.0051)
+        self.assertAlmostEqual(geometry.y[192] - geometry.y[0], 0.0051)
+        self.assertAlmostEqual(geometry.radius.min(), 0.0051 / numpy.sqrt(2))
+        # The bank subtends close to its area over the distance squared
+        distance = 6.058048 - 0.053
+        self.assertAlmostEqual(geometry.solidangle.sum(),
+                               (192 * 0.0051) ** 2 / distance ** 2, 3)
+        self.assertTrue(geometry.twotheta.max() < 0.12)
+        self.assertRaises(ValueError, geometry.x.__setitem__, 0, 1.0)
+        masked = geometry.getRadiusMask(0.041, 0.3)
+        self.assertEqual(masked.tolist(), ((geometry.radius < 0.041) |
+                                           (geometry.radius > 0.3)).tolist())
+        self.assertEqual(geometry.getIndices([9, 10]).tolist(), [0, 1])
+        self.assertRaises(ValueError, geometry.getIndices, [8])
+
+class QBinningTest(unittest.TestCase):
+    """Tests for the native I(Q) reduction"""
+
+    def setUp(self):
+        self.geometry = SansGeometry.getGeometry(
+                   SansGeometry.DetectorPosition('rear', 0.0, 0.0, 4.0, 0.0,
+                                                 0.0))
+        self.wavelengths = SansQBinning.rebinBoundaries('2.0, 0.5, 14.0')
+        self.counts = numpy.ones((192 * 192, len(self.wavelengths) - 1))
+
+    def testRebinBoundaries(self):
+        self.assertEqual(SansQBinning.rebinBoundaries([0, 1, 3]).tolist(),
+                         [0, 1, 2, 3])
+        # A short last bin is merged into the one before
+        self.assertEqual(SansQBinning.rebinBoundaries('0, 1, 3.1').tolist(),
+                         [0, 1, 2, 3.1])
+        self.assertEqual(SansQBinning.rebinBoundaries('0, 1, 2.5').tolist(),
+                         [0, 1, 2, 2.5])
+        bins = SansQBinning.rebinBoundaries(
+                            '.0034, .0006, 0.01   , -0.06, 0.33 , .02, 0.6')
+        self.assertAlmostEqual(bins[11], 0.01)
+        self.assertAlmostEqual(bins[12], 0.0106)
+        self.assertAlmostEqual(bins[13], 0.0106 * 1.06)
+        self.assertEqual(bins[-1], 0.6)
+        self.assertTrue((numpy.diff(bins) > 0).all())
+        self.assertRaises(ValueError, SansQBinning.rebinBoundaries, '1, 2')
+        self.assertRaises(ValueError, SansQBinning.rebinBoundaries,
+                          '0, -0.1, 1')
+
+    def testCalculateQ(self):
+        q = SansQBinning.calculateQ(self.geometry, self.wavelengths)
+        self.assertEqual(q.shape, self.counts.shape)
+        expected = (4 * numpy.pi * numpy.sin(self.geometry.twotheta[0] / 2)
+                    / 2.25)
+        self.assertAlmostEqual(q[0, 0], expected)
+
+        # Gravity lifts the apparent position of every pixel so pixels
+        # below the beam are seen at a lower angle
+        lifted = SansQBinning.calculateQ(self.geometry, self.wavelengths,
+                                         True)
+        self.assertTrue(lifted[0, -1] < q[0, -1])
+        self.assertTrue(lifted[-1, -1] > q[-1, -1])
+        self.assertTrue(abs(lifted[0, 0] - q[0, 0]) <
+                        abs(lifted[0, -1] - q[0, -1]))
+
+    def testQ1D(self):
+        qbins = numpy.array([0.0, 0.05, 0.1, 1.0])
+        result = SansQBinning.q1d(self.counts, self.wavelengths,
+                                  self.geometry, qbins)
+        self.assertEqual(result.intensity.sum(), self.counts.size)
+        self.assertEqual(result.errors.tolist(),
+                         numpy.sqrt(result.intensity).tolist())
+        self.assertTrue(result.normalisation is None)
+
+        mask = numpy.zeros(192 * 192, dtype = bool)
+        mask[:192] = True
+        masked = SansQBinning.q1d(self.counts, self.wavelengths,
+                                  self.geometry, qbins, mask = mask)
+        self.assertEqual(masked.intensity.sum(), self.counts[192:].sum())
+
+        normalised = SansQBinning.q1d(2 * self.counts, self.wavelengths,
+                                      self.geometry, '0.0, 0.05, 0.1',
+                                      normalisation = self.counts,
+                                      gravity = True)
+        self.assertEqual(normalised.intensity.tolist(), [2.0, 2.0])
+        self.assertRaises(ValueError, SansQBinning.q1d, self.counts[1:],
+                          self.wavelengths, self.geometry, qbins)
+
+        spectra = numpy.arange(100, 200)
+        subset = SansQBinning.q1d(self.counts[91:191], self.wavelengths,
+                                  self.geometry, qbins, spectra = spectra)
+        self.assertEqual(subset.intensity.sum(), 100 * self.counts.shape[1])
+
+    def testQxy(self):
+        qx, qy = SansQBinning.calculateQxy(self.geometry, self.wavelengths)
+        q = SansQBinning.calculateQ(self.geometry, self.wavelengths)
+        self.assertTrue(numpy.allclose(numpy.hypot(qx, qy), q))
+        # The first pixel is at the bottom left looking along the beam
+        self.assertTrue(qx[0, 0] < 0 and qy[0, 0] < 0)
+
+        result = SansQBinning.qxy(self.counts, self.wavelengths,
+                                  self.geometry, 1.0, 0.02)
+        self.assertEqual(result.intensity.shape, (100, 100))
+        self.assertEqual(result.qx[0], -1.0)
+        self.assertEqual(result.qy[-1], 1.0)
+        self.assertEqual(result.intensity.sum(), self.counts.size)
+        self.assertTrue(numpy.allclose(result.errors ** 2,
+                                       result.intensity))
+        # Pixels are symmetric about the beam so the image is too
+        self.assertTrue(numpy.allclose(result.intensity,
+                                       result.intensity[::-1, ::-1]))
+
+        normalised = SansQBinning.qxy(self.counts, self.wavelengths,
+                                      self.geometry, 0.3, 0.01,
+                                      normalisation = self.counts,
+                                      gravity = True)
+        filled = normalised.normalisation > 0
+        self.assertTrue((normalised.intensity[filled] == 1.0).all())
+        self.assertTrue((normalised.intensity[~filled] == 0.0).all())
+
+class TransmissionCacheTest(unittest.TestCase):
+    """Tests for the persistent transmission fit cache"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = SansTransmission.TransmissionCache(self.tempdir, 2)
+        self.key = SansTransmission.transmissionKey(
+                             os.path.join('test_data', 'SANS2D00003328.raw'),
+                             os.path.join('test_data', 'SANS2D00003332.raw'),
+                             'Log', 2.0, 14.0, 2, 3)
+        self.fit = SansTransmission.TransmissionFit(numpy.arange(3.0),
+                                                    numpy.array([0.5, 0.6]),
+                                                    numpy.array([0.1, 0.1]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testPutAndGet(self):
+        self.assertEqual(self.cache.get(self.key), None)
+        self.cache.put(self.key, self.fit)
+        # A new cache on the same directory sees the fit
+        cache = SansTransmission.TransmissionCache(self.tempdir, 2)
+        fit = cache.get(self.key)
+        self.assertEqual(fit.transmission.tolist(), [0.5, 0.6])
+        self.assertEqual(fit.wavelengths.tolist(), [0.0, 1.0, 2.0])
+        self.assertEqual(cache.get(self.key._replace(fittype = 'Linear')),
+                         None)
+
+    def testEviction(self):
+        keys = [self.key._replace(wavlow = wavlow)
+                for wavlow in (1.0, 2.0, 3.0)]
+        for age, key in enumerate(keys[:2]):
+            self.cache.put(key, self.fit)
+            os.utime(self.cache.getPath(key), (1000 * age, 1000 * age))
+        # Reading the oldest makes it the most recently used
+        self.assertNotEqual(self.cache.get(keys[0]), None)
+        self.cache.put(keys[2], self.fit)
+        self.assertEqual(len(os.listdir(self.tempdir)), 2)
+        self.assertEqual(self.cache.get(keys[1]), None)
+        self.assertNotEqual(self.cache.get(keys[0]), None)
+
+    def testGetFit(self):
+        calls = []
+        def calculate():
+            calls.append(1)
+            return self.fit
+        self.cache.getFit(self.key, calculate)
+        fit = self.cache.getFit(self.key, calculate)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(fit.errors.tolist(), [0.1, 0.1])
+
+class TransmissionTest(unittest.TestCase):
+    """Tests for the native transmission calculation"""
+
+    def setUp(self):
+        self.trans = os.path.join('test_data', 'SANS2D00003328.raw')
+        self.direct = os.path.join('test_data', 'SANS2D00003332.raw')
+
+    def testMonitorDistances(self):
+        rundata = SansRunData.loadRunData(self.trans, 2, 3)
+        self.assertAlmostEqual(rundata.monitor_distances[2], 17.937, 3)
+        self.assertAlmostEqual(rundata.monitor_distances[3], 19.497, 3)
+
+    def testRebinToWavelength(self):
+        tof = numpy.array([0.0, 1000.0, 2000.0])
+        distance = SansTransmission.TOF_TO_WAVELENGTH * 1000.0
+        rebinned = SansTransmission.rebinToWavelength([4.0, 8.0], tof,
+                                  distance, numpy.array([0.5, 1.0, 1.5]))
+        self.assertEqual(rebinned.tolist(), [2.0, 4.0])
+        background = SansTransmission.removeFlatBackground(
+                                  [4.0, 8.0], tof, 1000.0, 2000.0)
+        self.assertEqual(background.tolist(), [-4.0, 0.0])
+
+    def testFitTransmission(self):
+        wavelengths = numpy.arange(2.0, 11.0)
+        centres = SansQBinning.wavelengthCentres(wavelengths)
+        transmission = numpy.exp(-0.1 - 0.02 * centres)
+        variance = numpy.ones(len(centres)) * 1e-4
+        fit = SansTransmission.fitTransmission(wavelengths, transmission,
+                                               variance, 'Log', 3.0, 8.0)
+        self.assertTrue(numpy.allclose(fit.transmission, transmission))
+        fit = SansTransmission.fitTransmission(wavelengths, transmission,
+                                               variance, 'Linear')
+        self.assertTrue(numpy.allclose(fit.transmission, transmission,
+                                       atol = 5e-3))
+        self.assertRaises(ValueError, SansTransmission.fitTransmission,
+                          wavelengths, transmission, variance, 'Cubic')
+
+    def testCalculateTransmission(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            cache = SansTransmission.TransmissionCache(tempdir)
+            fit = SansTransmission.calculateTransmission(self.trans,
+                                      self.direct, '2, 0.125, 14', 'Log',
+                                      background = (80800, 98000),
+                                      cache = cache)
+            self.assertEqual(len(fit.transmission), 96)
+            self.assertTrue(((fit.transmission > 0.85) &
+                             (fit.transmission < 0.9)).all())
+            self.assertEqual(len(os.listdir(tempdir)), 1)
+            unfitted = SansTransmission.calculateTransmission(self.trans,
+                                      self.direct, '2, 0.125, 14', 'Off',
+                                      background = (80800, 98000),
+                                      cache = False)
+            self.assertAlmostEqual(unfitted.transmission.mean(),
+                                   fit.transmission.mean(), 1)
+        finally:
+            shutil.rmtree(tempdir)
+
+class SliceReductionTest(unittest.TestCase):
+    """Tests for the native reduction of several wavelength slices"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = SansTransmission.TransmissionCache(self.tempdir)
+        self.efficiencyfile = os.path.join('test_data',
+                                           'DIRECT_RUN524_4m_25Nov09.dat')
+        self.reduction = SansNativeReduction.SliceReduction(
+                             os.path.join('test_data', '3326.nxs'),
+                             os.path.join('test_data', 'SANS2D00003328.nxs'),
+                             os.path.join('test_data', 'SANS2D00003333.nxs'),
+                             os.path.join('test_data', 'SANS2D00003331.nxs'),
+                             os.path.join('test_data', 'SANS2D00003332.raw'),
+                             os.path.join('test_data', 'MASKSANS2D_095B.txt'),
+                             2.0, 14.0, logfile = os.path.join('test_data',
+                                                   'SANS2D00003328.log'),
+                             cache = self.cache,
+                             efficiencyfile = self.efficiencyfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testConvertToWavelength(self):
+        tof = numpy.array([0.0, 1000.0, 2000.0, 3000.0])
+        counts = numpy.array([[4.0, 8.0, 2.0], [1.0, 1.0, 1.0]])
+        distance = SansTransmission.TOF_TO_WAVELENGTH * 1000.0
+        converted = SansNativeReduction.convertToWavelength(counts, tof,
+                                  [distance, 2 * distance],
+                                  numpy.array([0.0, 0.5, 1.5, 3.0]))
+        self.assertTrue(numpy.allclose(converted, [[2.0, 6.0, 6.0],
+                                                   [1.0, 2.0, 0.0]]))
+
+    def testReduceSlices(self):
+        results = self.reduction.reduceSlices([(2, 14), (2, 6), (6, 14)])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(self.reduction.sample.wavelengths), 97)
+        # The slices share the Q bins of the mask file and only the short
+        # wavelengths reach the highest Q
+        for result in results:
+            self.assertEqual(len(result.q), 86)
+        self.assertTrue(results[1].intensity[-6] != 0)
+        self.assertEqual(results[2].intensity[-6], 0)
+        # Transmissions were fitted once for the sample and once for the
+        # can
+        self.assertEqual(len(os.listdir(self.tempdir)), 2)
+        self.assertRaises(ValueError, self.reduction.reduce, 20, 30)
+
+    def testReduce2D(self):
+        # L/QXY 0 0.1 .005/lin in the mask file gives 40 bins a side
+        result = self.reduction.reduce2D()
+        self.assertEqual(len(result.qx), 41)
+        self.assertAlmostEqual(result.qx[0], -0.1)
+        self.assertAlmostEqual(result.qy[-1], 0.1)
+        self.assertEqual(result.intensity.shape, (40, 40))
+        self.assertTrue(result.intensity.any())
+        # The can image is taken from the sample image
+        sample = self.reduction.sample.reduce2D(0.1, 0.005,
+                                      gravity = self.reduction.gravity)
+        can = self.reduction.can.reduce2D(0.1, 0.005,
+                                      gravity = self.reduction.gravity)
+        self.assertTrue(numpy.allclose(result.intensity,
+                                       sample.intensity - can.intensity))
+        self.assertTrue(numpy.allclose(result.errors,
+                                       numpy.hypot(sample.errors,
+                                                   can.errors)))
+
+    def testDoReduction2D(self):
+        reduction = SansReduce.Standard1DReductionSANS2DRearDetector()
+        reduction.setPathForAllRuns('test_data')
+        reduction.setSansRun('3326.nxs')
+        reduction.setSansTrans('3328.nxs')
+        reduction.setBackgroundRun('3333.nxs')
+        reduction.setBackgroundTrans('3331.nxs')
+        reduction.setDirectBeam('3332.raw')
+        reduction.setMaskfile(os.path.join('test_data',
+                                           'MASKSANS2D_095B.txt'))
+        result = reduction.doReduction2D(os.path.join('test_data',
+                                                'SANS2D00003328.log'),
+                                         self.efficiencyfile)
+        self.assertEqual(result.intensity.shape, (40, 40))
+        paths = SansBatch.writeOutputFiles(result, self.tempdir, '3326',
+                                           True, True)
+        self.assertEqual(paths, [os.path.join(self.tempdir, '3326.dat')])
+        rows = numpy.loadtxt(paths[0], skiprows = 2)
+        self.assertEqual(rows.shape, (1600, 4))
+        self.assertTrue(numpy.allclose(rows[:, 2],
+                                       result.intensity.ravel()))
+        self.assertAlmostEqual(rows[0, 0], -0.0975)
+        self.assertAlmostEqual(rows[1, 1], -0.0925)
+
+    def testMissingEfficiencyFile(self):
+        # The mask file names a direct beam file that isn't in test_data
+        self.reduction.efficiencyfile = None
+        self.assertRaises(ValueError, self.reduction.prepare)
+
+    def testDoSliceReductions(self):
+        reduction = SansReduce.Standard1DReductionSANS2DRearDetector()
+        reduction.setPathForAllRuns('test_data')
+        reduction.setSansRun('3333.nxs')
+        reduction.setSansTrans('3328.nxs')
+        reduction.setBackgroundRun('3333.nxs')
+        reduction.setBackgroundTrans('3328.nxs')
+        reduction.setDirectBeam('3332.raw')
+        reduction.setMaskfile(os.path.join('test_data',
+                                           'MASKSANS2D_095B.txt'))
+        self.assertRaises(ValueError, reduction.doSliceReductions, [(4, 2)])
+        results = reduction.doSliceReductions([(2, 8), (8, 14)],
+                                              os.path.join('test_data',
+                                                  'SANS2D00003328.log'),
+                                              self.efficiencyfile)
+        self.assertEqual(len(results), 2)
+        # The can is the sample run so nothing is left
+        self.assertFalse(results[0].intensity.any())
+        # Two steps from the mask file centre at most
+        x, y = reduction.findBeamCentre(60, 280, 2,
+                                        logfile = os.path.join('test_data',
+                                                  'SANS2D00003328.log'),
+                                        efficiencyfile = self.efficiencyfile)
+        self.assertTrue(abs(x - 0.2399) <= 0.01 and abs(y + 0.19765) <= 0.01)
+
+class PeriodReductionTest(unittest.TestCase):
+    """Tests for reducing the periods of a run together"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.sansfile = os.path.join(self.tempdir, '3326.nxs')
+        first = SansRunData.loadRunData(os.path.join('test_data',
+                                                     '3326.nxs'), 1, 36872)
+        second = SansRunData.loadRunData(os.path.join('test_data',
+                                                      '3326.nxs'), 1, 36872)
+        # Twice the scattering for the same monitor counts
+        second.counts[8:] *= 2
+        SansNexusFile.saveRunData([first, second], self.sansfile)
+        self.logfile = os.path.join('test_data', 'SANS2D00003328.log')
+        self.efficiencyfile = os.path.join('test_data',
+                                           'DIRECT_RUN524_4m_25Nov09.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def getReduction(self, period):
+        return SansNativeReduction.SliceReduction(self.sansfile,
+                         os.path.join('test_data', 'SANS2D00003328.nxs'),
+                         os.path.join('test_data', 'SANS2D00003333.nxs'),
+                         os.path.join('test_data', 'SANS2D00003331.nxs'),
+                         os.path.join('test_data', 'SANS2D00003332.raw'),
+                         os.path.join('test_data', 'MASKSANS2D_095B.txt'),
+                         2.0, 14.0, logfile = self.logfile, cache = False,
+                         efficiencyfile = self.efficiencyfile,
+                         period = period)
+
+    def testReducePeriods(self):
+        reduction = self.getReduction([1, 2])
+        result = reduction.reduce()
+        self.assertEqual(result.intensity.shape, (2, len(result.q) - 1))
+        single = self.getReduction(1).reduce()
+        self.assertTrue(numpy.allclose(result.intensity[0],
+                                       single.intensity))
+        sample = reduction.sample.reduce(reduction.qbins,
+                                         gravity = reduction.gravity)
+        self.assertTrue(numpy.allclose(sample.intensity[1],
+                                       2 * sample.intensity[0]))
+
+    def testDoPeriodReductions(self):
+        reduction = SansReduce.Standard1DReductionSANS2DRearDetector()
+        reduction.setPathForAllRuns('test_data')
+        reduction.setSansRun('3326.nxs')
+        reduction.getSansRun().setPath(self.tempdir)
+        reduction.setSansTrans('3328.nxs')
+        reduction.setBackgroundRun('3333.nxs')
+        reduction.setBackgroundTrans('3331.nxs')
+        reduction.setDirectBeam('3332.raw')
+        reduction.setMaskfile(os.path.join('test_data',
+                                           'MASKSANS2D_095B.txt'))
+        self.assertRaises(ValueError, reduction.doPeriodReductions, [])
+        result = reduction.doPeriodReductions(logfile = self.logfile,
+                                   efficiencyfile = self.efficiencyfile)
+        self.assertEqual(result.intensity.shape[0], 2)
+
+        paths = SansBatch.writePeriodFiles(result, [1, 2], self.tempdir,
+                                           '3326')
+        self.assertEqual([os.path.basename(path) for path in paths],
+                         ['3326p1.LOQ', '3326p2.LOQ'])
+        written = SansRKHFile.parseRKHFile(paths[1])
+        self.assertEqual(written.title, '3326p2')
+        self.assertTrue(numpy.allclose(written.y, result.intensity[1],
+                                       rtol = 1e-6))
+
+class RKHFileTest(unittest.TestCase):
+    """Tests for reading RKH efficiency files"""
+
+    def setUp(self):
+        SansRKHFile.clearCache()
+        self.path = os.path.join('test_data',
+                                 'DIRECT_RUN524_4m_25Nov09.dat')
+
+    def testReadRKHFile(self):
+        data = SansRKHFile.readRKHFile(self.path)
+        self.assertEqual(len(data.x), 147)
+        self.assertEqual(data.x[0], 0.85)
+        self.assertAlmostEqual(data.y[0], 0.1859168)
+        self.assertAlmostEqual(data.errors[-1], 5.531579e-3)
+        self.assertTrue(SansRKHFile.readRKHFile(self.path) is data)
+        self.assertRaises(ValueError, SansRKHFile.readRKHFile,
+                          os.path.join('test_data', 'MASKSANS2D_095B.txt'))
+
+    def testEfficiencyCorrection(self):
+        wavelengths = numpy.array([0.0, 0.9, 1.1, 20.0, 30.0])
+        factors, errors = SansRKHFile.efficiencyCorrection(self.path,
+                                                           wavelengths)
+        # Outside the file the end points are used, inside the points
+        # either side of the bin centre are interpolated
+        self.assertAlmostEqual(factors[0], 0.1859168)
+        self.assertAlmostEqual(factors[1], (0.1677387 + 0.1799202) / 2)
+        self.assertAlmostEqual(factors[3], 8.362339e-2)
+        self.assertTrue(SansRKHFile.efficiencyCorrection(self.path,
+                                            wavelengths)[0] is factors)
+        corrected, correctederrors = SansRKHFile.correctToFile(
+                             numpy.ones((2, 4)), numpy.zeros((2, 4)),
+                             wavelengths, self.path)
+        self.assertTrue(numpy.allclose(corrected, 1 / factors))
+
+class OutputFileTest(unittest.TestCase):
+    """Tests for writing reduced data without Mantid"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.result = SansQBinning.Q1DResult(
+                             numpy.array([0.01, 0.02, 0.04, 0.08]),
+                             numpy.array([12.5, 3.25, 0.5]),
+                             numpy.array([0.5, 0.125, 0.0625]), None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testWriteCanSASFile(self):
+        path = os.path.join(self.tempdir, 'out.xml')
+        SansCanSASFile.writeCanSASFile(path, [0.1, 0.2], [5.0, 4.0],
+                                       [0.5, 0.25], [0.01, 0.02],
+                                       title = 'Sample & can', run = '3326')
+        namespace = '{cansas1d/1.0}'
+        entry = ElementTree.parse(path).getroot().find(namespace +
+                                                       'SASentry')
+        self.assertEqual(entry.find(namespace + 'Title').text,
+                         'Sample & can')
+        self.assertEqual(entry.find(namespace + 'Run').text, '3326')
+        rows = entry.findall(namespace + 'SASdata/' + namespace + 'Idata')
+        self.assertEqual(len(rows), 2)
+        self.assertEqual([float(rows[1].find(namespace + name).text)
+                          for name in ('Q', 'I', 'Idev', 'Qdev')],
+                         [0.2, 4.0, 0.25, 0.02])
+        self.assertEqual(rows[0].find(namespace + 'I').get('unit'),
+                         SansCanSASFile.I_UNIT)
+        self.assertRaises(ValueError, SansCanSASFile.writeCanSASFile,
+                          path, [0.1, 0.2], [5.0], [0.5])
+
+    def testWriteRKHFile(self):
+        # More rows than are formatted in one chunk
+        path = os.path.join(self.tempdir, 'out.LOQ')
+        x = numpy.arange(SansRKHFile.CHUNK_ROWS + 10) * 0.001
+        SansRKHFile.writeRKHFile(path, x, 2 * x, x / 10, 'title')
+        written = SansRKHFile.parseRKHFile(path)
+        self.assertEqual(written.title, 'title')
+        self.assertEqual(len(written.x), len(x))
+        self.assertTrue(numpy.allclose(written.y, 2 * x))
+        self.assertRaises(ValueError, SansRKHFile.writeRKHFile, path,
+                          [0.1, 0.2], [5.0], [0.5, 0.5])
+
+    def testWriteOutputFiles(self):
+        paths = SansBatch.writeOutputFiles(self.result, self.tempdir,
+                                           '3326', True, True)
+        self.assertEqual([os.path.basename(path) for path in paths],
+                         ['3326.LOQ', '3326.xml'])
+        written = SansRKHFile.parseRKHFile(paths[0])
+        self.assertTrue(numpy.allclose(written.x, [0.015, 0.03, 0.06]))
+        self.assertTrue(numpy.allclose(written.y, self.result.intensity))
+        namespace = '{cansas1d/1.0}'
+        values = [float(element.text) for element in
+                  ElementTree.parse(paths[1]).getroot().iter(namespace +
+                                                             'Idev')]
+        self.assertTrue(numpy.allclose(values, self.result.errors))
+        self.assertRaises(IOError, SansBatch.writeOutputFiles, self.result,
+                          os.path.join(self.tempdir, 'missing'), '3326')
+
+class BeamCentreTest(unittest.TestCase):
+    """Tests for the native beam centre finder"""
+
+    class Prepared(object):
+        """A prepared reduction holding a pattern centred on the beam"""
+
+        bank = 'rear'
+        gravity = False
+        can = None
+
+        def __init__(self):
+            self.logvalues = {'Rear_Det_Z' : 4000.0}
+            self.settings = {'XBEAM_CENTRE' : 0.01, 'YBEAM_CENTRE' : -0.008}
+            self.qbins = SansQBinning.rebinBoundaries('0.002, 0.001, 0.05')
+            centred = SansGeometry.getGeometry(SansGeometry.detectorPosition(
+                                     'rear', self.logvalues, None, 0.0, 0.0))
+            start = SansGeometry.getGeometry(SansGeometry.detectorPosition(
+                                     'rear', self.logvalues, self.settings))
+            counts = numpy.outer(1000 * numpy.exp(-centred.radius / 0.05),
+                                 [1.0, 0.8, 0.6])
+            self.sample = SansNativeReduction.WavelengthData(
+                             numpy.array([2.0, 4.0, 6.0, 8.0]), counts,
+                             counts, numpy.outer(start.solidangle,
+                                                 numpy.ones(3)),
+                             start, numpy.arange(len(counts)),
+                             numpy.zeros(len(counts), dtype = bool))
+
+        def prepare(self):
+            pass
+
+    def setUp(self):
+        self.finder = SansBeamCentre.BeamCentreFinder(self.Prepared(),
+                                                      0.02, 0.2)
+
+    def testQuadrants(self):
+        geometry = self.finder.getGeometry(0.0, 0.0)
+        groups = SansBeamCentre.quadrantGroups(geometry, 0.02, 0.2)
+        # Pixels along +x are Right and along +y Up
+        pixels = numpy.argsort(numpy.abs(geometry.y) +
+                               numpy.abs(geometry.x - 0.1))[0]
+        self.assertEqual(groups[pixels], 1)
+        pixels = numpy.argsort(numpy.abs(geometry.x) +
+                               numpy.abs(geometry.y - 0.1))[0]
+        self.assertEqual(groups[pixels], 2)
+        self.assertEqual(groups[numpy.argmin(geometry.radius)], -1)
+        quadrants = self.finder.getQuadrants(0.0, 0.0)
+        self.assertEqual(quadrants.intensity.shape, (4, 48))
+        self.assertEqual(SansBeamCentre.quadrantResidue(
+                             numpy.array([[1.0, 2.0], [2.0, 0.0],
+                                          [1.0, 1.0], [1.0, 1.0]])),
+                         (1.0, 0.0))
+
+    def testFindCentre(self):
+        x, y = self.finder.findCentre()
+        self.assertTrue(abs(x) < 0.0005 and abs(y) < 0.0005)
+        self.assertTrue(self.finder.evaluations <= 21)
+
+    def testGridSearch(self):
+        xs, ys, residues = self.finder.gridSearch(0.004, -0.004, 0.005,
+                                                  0.0025, processes = 2)
+        self.assertEqual(residues.shape, (5, 5, 2))
+        self.assertTrue(numpy.allclose(xs, [-0.001, 0.0015, 0.004, 0.0065,
+                                            0.009]))
+        self.assertTrue(numpy.allclose(residues[1, 3],
+                                       self.finder.getResidue(xs[1], ys[3])))
+        x, y = self.finder.findCentreByGrid(processes = 2)
+        self.assertTrue(abs(x) < 0.0005 and abs(y) < 0.0005)
+
+class LogFileTest(unittest.TestCase):
+    """Tests for the columnar sample environment log store"""
+
+    def setUp(self):
+        SansLogFile.clearCache()
+        self.path = os.path.join('test_data', 'SANS2D00003328.log')
+        self.store = SansLogFile.readLogFile(self.path)
+
+    def testReadLogFile(self):
+        self.assertTrue(SansLogFile.readLogFile(self.path) is self.store)
+        self.assertEqual(len(self.store.getChannel('Moderator_Temp').times),
+                         47)
+        self.assertEqual(self.store.start,
+                         numpy.datetime64('2010-03-09T19:36:54'))
+        self.assertTrue('Fast_Shutter' in self.store.getChannelNames())
+        self.assertRaises(ValueError, self.store.getChannel, 'Nothing')
+        self.assertRaises(ValueError, SansLogFile.readLogFile, 'false/path')
+
+    def testQueries(self):
+        self.assertEqual(self.store.lastValue('Rear_Det_Z'), 6000.048)
+        self.assertEqual(self.store.valueAt('Fast_Shutter',
+                                            '2010-03-09T19:39:41'), 'CLOSED')
+        self.assertEqual(self.store.valueAt('Fast_Shutter',
+                                            '2010-03-09T19:39:42'), 'OPEN')
+        self.assertEqual(self.store.valueAt('Fast_Shutter',
+                                            '2010-03-09T19:00:00', 'X'), 'X')
+        times, values = self.store.getValues('Sample',
+                                             '2010-03-09T19:39:22',
+                                             '2010-03-09T19:39:25')
+        self.assertEqual(list(values), [622.9525, 595.1475, 565.1775])
+        self.assertEqual(self.store.lastValue('Nothing', 0.0), 0.0)
+
+class LogFilterTest(unittest.TestCase):
+    """Tests for filtering runs on their log channels"""
+
+    def setUp(self):
+        SansLogFile.clearCache()
+        self.store = SansLogFile.readLogFile(os.path.join('test_data',
+                                                    'SANS2D00003328.log'))
+        self.run = SansRunData.openRunFile(os.path.join('test_data',
+                                                  'SANS2D00003328.raw'))
+        self.shutter = SansLogFilter.LogValue('Fast_Shutter') == 'OPEN'
+
+    def testRunTimes(self):
+        self.assertEqual(self.run.start_time, '2010-03-09T19:39:44')
+        self.assertEqual(self.run.end_time, '2010-03-09T19:48:53')
+
+    def testGoodTimes(self):
+        goodtimes = self.shutter.goodTimes(self.store)
+        self.assertEqual(list(goodtimes.starts),
+                         [numpy.datetime64('2010-03-09T19:39:42')])
+        self.assertEqual(list(goodtimes.ends),
+                         [numpy.datetime64('2010-03-09T19:48:54')])
+        self.assertEqual(goodtimes.duration('2010-03-09T19:39:44',
+                                            '2010-03-09T19:48:53'), 549.0)
+
+        warm = SansLogFilter.LogValue('Moderator_Temp') >= 31
+        self.assertEqual(list((warm & self.shutter).goodTimes(
+                                       self.store).mask(
+                                       ['2010-03-09T19:38:00',
+                                        '2010-03-09T19:40:00',
+                                        '2010-03-09T19:40:07'])),
+                         [False, True, False])
+        self.assertEqual(len((~self.shutter).goodTimes(self.store)), 1)
+        self.assertRaises(ValueError, (SansLogFilter.LogValue(
+                          'Fast_Shutter') > 1).goodTimes, self.store)
+
+    def testFilterTree(self):
+        logfilter = ~(self.shutter & (SansLogFilter.LogValue(
+                            'Moderator_Temp').between(30, 31) |
+                      (SansLogFilter.LogValue('Moderator_Temp') != 5)))
+        tree = logfilter.getTree()
+        self.assertEqual(tree[0], 'not')
+        self.assertEqual(tree[1][1], ('compare', 'Fast_Shutter', '==',
+                                      'OPEN'))
+        hash(tree)
+        # The tree survives being saved as JSON
+        rebuilt = SansLogFilter.filterFromTree(json.loads(json.dumps(tree)))
+        self.assertEqual(rebuilt.getTree(), tree)
+        self.assertEqual(list(rebuilt.goodTimes(self.store).starts),
+                         list(logfilter.goodTimes(self.store).starts))
+        self.assertRaises(ValueError, SansLogFilter.filterFromTree,
+                          ['compare', 'Fast_Shutter', '=~', 'OPEN'])
+        self.assertRaises(ValueError, SansLogFilter.filterFromTree,
+                          ['xor', tree, tree])
+
+    def testCheckRunTimes(self):
+        SansLogFilter.checkRunTimes(self.run, self.shutter, self.store)
+        self.assertRaises(ValueError, SansLogFilter.checkRunTimes,
+                          self.run, ~self.shutter, self.store)
+        self.assertRaises(ValueError, SansLogFilter.checkRunTimes,
+                          self.run, SansLogFilter.LogValue(
+                                         'Moderator_Temp').between(30.5, 32),
+                          self.store)
+
+    def testReductionLogFilter(self):
+        reduction = SansReduce.Standard1DReductionSANS2DRearDetector()
+        self.assertRaises(TypeError, reduction.setLogFilter, 'OPEN')
+        reduction.setLogFilter(self.shutter)
+        self.assertEqual(reduction.getLogFilter(), self.shutter)
+
+        # 3326 was counted before the log starts
+        native = SansNativeReduction.SliceReduction(
+                         os.path.join('test_data', '3326.nxs'),
+                         os.path.join('test_data', 'SANS2D00003328.nxs'),
+                         os.path.join('test_data', 'SANS2D00003333.nxs'),
+                         os.path.join('test_data', 'SANS2D00003331.nxs'),
+                         os.path.join('test_data', 'SANS2D00003332.raw'),
+                         os.path.join('test_data', 'MASKSANS2D_095B.txt'),
+                         2.0, 14.0, logfile = os.path.join('test_data',
+                                                    'SANS2D00003328.log'),
+                         logfilter = self.shutter)
+        self.assertRaises(ValueError, native.prepare)
+
+class QueueJournalTest(unittest.TestCase):
+    """Tests for journaling and resuming a batch of reductions"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'queue.jsonl')
+        job = SansBatch.ReductionJob(sansrun = '3325.raw',
+                  sanstrans = '3328.raw', bgdrun = '3333.raw',
+                  bgdtrans = '3328.nxs', directbeam = '3332.raw',
+                  path = os.path.abspath('test_data'),
+                  maskfile = 'false/path', wavlow = 2.0, wavhigh = 14.0,
+                  gravity = True, targetdirectory = self.tempdir,
+                  filename = '3325', outputLOQ = False,
+                  outputCanSAS = True)
+        self.jobs = [job, job._replace(sansrun = '3326.nxs',
+                                       filename = '3326')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testReadJournal(self):
+        journal = SansBatch.QueueJournal(self.path)
+        journal.create(self.jobs)
+        journal.mark(0, SansBatch.RUNNING)
+        journal.mark(0, SansBatch.DONE)
+        journal.mark(1, SansBatch.FAILED, 'broken')
+        # A partly written line left by a crash is ignored
+        open(self.path, 'a').write('{"index": 1, "sta')
+
+        self.assertEqual(journal.read(),
+                         [(self.jobs[0], 'done', ''),
+                          (self.jobs[1], 'failed', 'broken')])
+        self.assertEqual(type(journal.read()[0][0].sansrun), str)
+
+    def testUnfinishedJobs(self):
+        journal = SansBatch.QueueJournal(self.path)
+        journal.create(self.jobs)
+        journal.mark(0, SansBatch.DONE)
+        journal.mark(1, SansBatch.RUNNING)
+        self.assertEqual(journal.getUnfinishedJobs(), self.jobs)
+        open(os.path.join(self.tempdir, '3325.xml'), 'w').close()
+        self.assertEqual(journal.getUnfinishedJobs(), self.jobs[1:])
+
+    def testResumeJobs(self):
+        results = SansBatch.runJournaledJobs(self.jobs, self.path,
+                                             processes = 1)
+        self.assertEqual([result.status for result in results],
+                         ['failed', 'failed'])
+        journal = SansBatch.QueueJournal(self.path)
+        self.assertEqual([state for job, state, message in journal.read()],
+                         ['failed', 'failed'])
+
+        journal.mark(0, SansBatch.DONE)
+        open(os.path.join(self.tempdir, '3325.xml'), 'w').close()
+        results = SansBatch.resumeJobs(self.path, processes = 2)
+        self.assertEqual([result.job for result in results], self.jobs[1:])
+        self.assertEqual([state for job, state, message in journal.read()],
+                         ['done', 'failed'])
+
+    def testResumeFilteredJobs(self):
+        # Jobs with a log filter go through the journal and back
+        logfilter = (SansLogFilter.LogValue('Fast_Shutter') == 'OPEN') & \
+                    SansLogFilter.LogValue('Moderator_Temp').between(30, 31)
+        jobs = [job._replace(logfilter = logfilter.getTree())
+                for job in self.jobs]
+        results = SansBatch.runJournaledJobs(jobs, self.path,
+                                             processes = 1)
+        self.assertEqual([result.job for result in results], jobs)
+        self.assertEqual([result.status for result in results],
+                         ['failed', 'failed'])
+        journal = SansBatch.QueueJournal(self.path)
+        self.assertEqual([job for job, state, message in journal.read()],
+                         jobs)
+
+        journal.mark(0, SansBatch.DONE)
+        open(os.path.join(self.tempdir, '3325.xml'), 'w').close()
+        results = SansBatch.resumeJobs(self.path, processes = 2)
+        self.assertEqual([result.job for result in results], jobs[1:])
+        self.assertEqual(results[0].status, 'failed')
+
+class ProvenanceTest(unittest.TestCase):
+    """Tests for skipping reductions whose outputs are up to date"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.job = SansBatch.ReductionJob(sansrun = '3333.nxs',
+                  sanstrans = '3328.nxs', bgdrun = '3333.nxs',
+                  bgdtrans = '3331.nxs', directbeam = '3332.raw',
+                  path = os.path.abspath('test_data'),
+                  maskfile = os.path.abspath(os.path.join('test_data',
+                                                 'MASKSANS2D_095B.txt')),
+                  wavlow = 2.0, wavhigh = 14.0, gravity = True,
+                  targetdirectory = self.tempdir, filename = '3333',
+                  outputLOQ = False, outputCanSAS = True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testProvenanceHash(self):
+        provenance = SansBatch.jobProvenance(self.job)
+        self.assertEqual(provenance['runs']['sansrun'][0],
+                         os.path.abspath(os.path.join('test_data',
+                                             'SANS2D00003333.nxs')))
+        self.assertEqual(SansBatch.provenanceHash(provenance),
+                         SansBatch.provenanceHash(
+                                    SansBatch.jobProvenance(self.job)))
+        changed = SansBatch.jobProvenance(self.job._replace(wavhigh = 12.0))
+        self.assertNotEqual(SansBatch.provenanceHash(provenance),
+                            SansBatch.provenanceHash(changed))
+
+    def testIsUpToDate(self):
+        provenance = SansBatch.jobProvenance(self.job)
+        self.assertFalse(SansBatch.isUpToDate(self.job, provenance))
+        open(os.path.join(self.tempdir, '3333.xml'), 'w').close()
+        self.assertFalse(SansBatch.isUpToDate(self.job, provenance))
+        SansBatch.writeProvenance(self.job, provenance)
+        self.assertTrue(SansBatch.isUpToDate(self.job))
+        self.assertFalse(SansBatch.isUpToDate(
+                                   self.job._replace(gravity = False)))
+        os.remove(os.path.join(self.tempdir, '3333.xml'))
+        self.assertFalse(SansBatch.isUpToDate(self.job, provenance))
+
+    def testRunJobSkipsUpToDate(self):
+        open(os.path.join(self.tempdir, '3333.xml'), 'w').close()
+        SansBatch.writeProvenance(self.job,
+                                  SansBatch.jobProvenance(self.job))
+        self.assertEqual(SansBatch.runJob(self.job).status, 'skipped')
+        self.assertNotEqual(SansBatch.runJob(self.job, force = True).status,
+                            'skipped')
+
 # class QueueTests(unittest.TestCase):
 
 if __name__ == '__main__':